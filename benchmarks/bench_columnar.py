@@ -0,0 +1,69 @@
+'''
+Compares the columnar backend (compile_mask) with the row-wise backend
+(compile_predicate) on the same data.
+
+    python benchmarks/bench_columnar.py [rows]
+'''
+import os
+import random
+import sys
+import timeit
+
+import numpy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Run from a checkout without installing jsonquery
+sys.path.insert(0, ROOT)
+
+from jsonquery import compile_mask, compile_predicate  # noqa: E402
+
+QUERY = {
+    'operator': 'and',
+    'value': [
+        {'column': 'age', 'operator': '>=', 'value': 21},
+        {'column': 'age', 'operator': '<', 'value': 65},
+        {
+            'operator': 'or',
+            'value': [
+                {'column': 'name', 'operator': 'like', 'value': 'pat%'},
+                {'column': 'height', 'operator': 'in_',
+                 'value': [150, 160, 170]}
+            ]
+        }
+    ]
+}
+NAMES = ['pat', 'patrick', 'sam', 'samantha', 'joe', 'mary']
+
+
+def make_rows(count, seed=0):
+    rand = random.Random(seed)
+    return [{
+        'name': rand.choice(NAMES),
+        'age': rand.randint(0, 99),
+        'height': rand.choice([150, 160, 170, 180, 190]),
+    } for _ in range(count)]
+
+
+def main(count):
+    rows = make_rows(count)
+    batch = dict((column, numpy.array([row[column] for row in rows]))
+                 for column in ['name', 'age', 'height'])
+    predicate = compile_predicate(QUERY)
+    mask_filter = compile_mask(QUERY)
+    assert (sum(1 for _ in predicate.filter(rows)) ==
+            int(mask_filter.mask(batch).sum()))
+
+    number = 5
+    rowwise = min(timeit.repeat(
+        lambda: sum(1 for _ in predicate.filter(rows)),
+        number=number, repeat=3)) / number
+    columnar = min(timeit.repeat(
+        lambda: mask_filter.mask(batch),
+        number=number, repeat=3)) / number
+    print('rows:     {}'.format(count))
+    print('row-wise: {:.6f}s'.format(rowwise))
+    print('columnar: {:.6f}s ({:.1f}x)'.format(columnar, rowwise / columnar))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,77 @@
+'''
+Times importing jsonquery in a fresh interpreter.
+
+    python benchmarks/bench_import.py [--repeat 10] [--max-seconds 0.1]
+
+Prints as JSON the fastest time to import jsonquery, to import jsonquery and
+evaluate a query in memory, and to import sqlalchemy.orm for comparison,
+along with whether sqlalchemy was loaded.  Exits with status 1 if importing
+jsonquery or evaluating a query in memory loads sqlalchemy, or if the
+import takes longer than --max-seconds.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+{}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds,
+                  'sqlalchemy': 'sqlalchemy' in sys.modules}}))
+'''
+
+CASES = {
+    'import': 'import jsonquery',
+    'in_memory': '\n'.join([
+        'import jsonquery',
+        'tree = jsonquery.parse_tree({"operator": "and", "value": [',
+        '    {"column": "age", "operator": ">=", "value": 18},',
+        '    {"column": "name", "operator": "like", "value": "pat%"}]})',
+        'predicate = jsonquery.compile_predicate(tree)',
+        'predicate.matches({"age": 20, "name": "pat"})',
+    ]),
+    'sqlalchemy': 'import sqlalchemy.orm',
+}
+GUARDED = ['import', 'in_memory']
+
+
+def measure(code, repeat):
+    '''Returns the fastest of repeat fresh runs of code'''
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT.format(code)], env=env, cwd=ROOT)
+        runs.append(json.loads(output))
+    return min(runs, key=lambda run: run['seconds'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='fresh interpreters per case')
+    parser.add_argument('--max-seconds', type=float,
+                        help='fail if importing jsonquery takes longer')
+    args = parser.parse_args(argv)
+
+    results = dict((name, measure(code, args.repeat))
+                   for name, code in CASES.items())
+    print(json.dumps(results, indent=2, sort_keys=True))
+    failed = [name for name in GUARDED if results[name]['sqlalchemy']]
+    for name in failed:
+        sys.stderr.write('{} loaded sqlalchemy\n'.format(name))
+    seconds = results['import']['seconds']
+    if args.max_seconds is not None and seconds > args.max_seconds:
+        sys.stderr.write('import took {:.4f}s\n'.format(seconds))
+        failed.append('import')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
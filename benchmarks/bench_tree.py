@@ -0,0 +1,80 @@
+'''
+Compares json queries with the QueryTree from parse_tree.
+
+    python benchmarks/bench_tree.py [--sizes 100,1000,10000]
+
+For wide and balanced queries of each size, prints as JSON:
+
+    memory      bytes allocated by the json and by the tree
+    serialize   seconds to json.dumps/json.loads and tree.dumps/loads
+    build       seconds per jsonselect() of the json and of the tree
+'''
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Run from a checkout without installing jsonquery
+sys.path.insert(0, ROOT)
+
+from jsonquery import QueryTree, jsonselect, parse_tree  # noqa: E402
+
+from run import UNLIMITED, User, balanced, measure, wide  # noqa: E402
+
+SIZES = [100, 1000, 10000]
+SHAPES = {'wide': wide, 'balanced': balanced}
+
+
+def allocated(build):
+    '''Returns the bytes still allocated by the value build returns'''
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del value
+    return size
+
+
+def run(sizes):
+    results = {}
+    for shape, make in sorted(SHAPES.items()):
+        for size in sizes:
+            text = json.dumps(make(size))
+            query = json.loads(text)
+            tree = parse_tree(query, **UNLIMITED)
+            data = tree.dumps()
+            name = '{}/{}'.format(shape, size)
+            results[name] = {
+                'memory': {
+                    'json': allocated(lambda: json.loads(text)),
+                    'tree': allocated(lambda: QueryTree.loads(data)),
+                },
+                'serialize': {
+                    'json': measure(lambda: json.loads(json.dumps(query))),
+                    'tree': measure(lambda: QueryTree.loads(tree.dumps())),
+                },
+                'build': {
+                    'json': measure(
+                        lambda: jsonselect(User, query, **UNLIMITED)),
+                    'tree': measure(
+                        lambda: jsonselect(User, tree, **UNLIMITED)),
+                },
+            }
+            sys.stderr.write('{:<20} done\n'.format(name))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated query sizes (nodes)')
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    print(json.dumps(run(sizes), indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+'''
+Benchmarks building, compiling and running queries.
+
+    python benchmarks/run.py [--sizes 10,100,1000] [--filter build]
+                             [--save results.json] [--baseline results.json]
+                             [--threshold 1.25]
+
+Three groups of benchmarks are run:
+
+    build/SHAPE/NODES
+        jsonselect() for deep, wide and balanced queries of NODES nodes
+    compile/SHAPE/NODES
+        jsonselect() and compiling the statement to SQLite SQL
+    execute/NAME
+        jsonquery() against a seeded SQLite database, fetching every row
+
+Results are printed as JSON (seconds per call, the fastest of several
+repeats).  --save writes them to a file, and --baseline compares them to a
+saved file, exiting with status 1 if any benchmark is slower than the
+baseline by more than --threshold.  Deep queries that are too deep for
+SQLAlchemy's recursive compiler are reported with an error instead of a
+time.
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Run from a checkout without installing jsonquery
+sys.path.insert(0, ROOT)
+
+from jsonquery import jsonquery, jsonquery_count, jsonselect  # noqa: E402
+
+SIZES = [10, 100, 1000, 10000, 100000]
+SHAPES = ['deep', 'wide', 'balanced']
+UNLIMITED = {'max_breadth': None, 'max_depth': None, 'max_elements': None}
+ROWS = 10000
+NAMES = ['pat', 'patrick', 'sam', 'samantha', 'joe', 'mary']
+
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    age = Column(Integer, index=True)
+    height = Column(Integer)
+
+
+LEAVES = [
+    {'column': 'age', 'operator': '>=', 'value': 21},
+    {'column': 'name', 'operator': 'like', 'value': 'pat%'},
+    {'column': 'height', 'operator': 'in_', 'value': [150, 160, 170]},
+    {'column': 'age', 'operator': '<', 'value': 65},
+]
+
+
+def leaf(index):
+    return dict(LEAVES[index % len(LEAVES)])
+
+
+def deep(nodes):
+    '''Alternating and/or, each with one column node and the next level'''
+    json = leaf(0)
+    for index in range(1, (nodes + 1) // 2):
+        json = {'operator': 'and' if index % 2 else 'or',
+                'value': [leaf(index), json]}
+    return json
+
+
+def wide(nodes):
+    '''One and with nodes - 1 column nodes'''
+    return {'operator': 'and', 'value': [leaf(i) for i in range(nodes - 1)]}
+
+
+def balanced(nodes):
+    '''A binary tree of alternating and/or'''
+    def tree(count, index):
+        if count <= 1:
+            return leaf(index)
+        left = (count - 1) // 2
+        return {'operator': 'and' if index % 2 else 'or', 'value': [
+            tree(left, index + 1), tree(count - 1 - left, index + 1)]}
+    return tree(nodes, 0)
+
+
+def measure(func, min_time=0.2, repeat=3):
+    '''Returns the fastest seconds per call of func'''
+    start = timeit.default_timer()
+    func()
+    once = timeit.default_timer() - start
+    number = max(1, int(min_time / max(once, 1e-9)))
+    times = timeit.repeat(func, number=number, repeat=repeat)
+    return min(times) / number
+
+
+def seed(session, rows):
+    rand = random.Random(0)
+    session.bulk_insert_mappings(User, [{
+        'name': rand.choice(NAMES),
+        'age': rand.randint(0, 99),
+        'height': rand.choice([150, 160, 170, 180, 190]),
+    } for _ in range(rows)])
+    session.commit()
+
+
+def execute_queries():
+    return {
+        'equality': {'column': 'age', 'operator': '==', 'value': 30},
+        'range_like': {'operator': 'and', 'value': [
+            {'column': 'age', 'operator': '>=', 'value': 21},
+            {'column': 'age', 'operator': '<', 'value': 30},
+            {'column': 'name', 'operator': 'like', 'value': 'pat%'}]},
+        'in_100': {'column': 'age', 'operator': 'in_',
+                   'value': list(range(0, 200, 2))},
+        'wide_or_50': {'operator': 'or', 'value': [
+            {'column': 'age', 'operator': '==', 'value': age}
+            for age in range(50)]},
+    }
+
+
+def benchmarks(sizes):
+    '''Yields (name, nodes, func)'''
+    dialect = sqlite.dialect()
+    for shape in SHAPES:
+        for size in sizes:
+            query = globals()[shape](size)
+            yield ('build/{}/{}'.format(shape, size), size,
+                   lambda query=query: jsonselect(User, query, **UNLIMITED))
+            yield ('compile/{}/{}'.format(shape, size), size,
+                   lambda query=query: str(jsonselect(
+                       User, query, **UNLIMITED).compile(dialect=dialect)))
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    seed(session, ROWS)
+    for name, query in sorted(execute_queries().items()):
+        yield ('execute/{}'.format(name), None,
+               lambda query=query: jsonquery(
+                   session, User, query, **UNLIMITED).all())
+        yield ('execute/{}/count'.format(name), None,
+               lambda query=query: jsonquery_count(
+                   session, User, query, **UNLIMITED))
+
+
+def run(sizes, pattern=None):
+    results = {}
+    for name, nodes, func in benchmarks(sizes):
+        if pattern and pattern not in name:
+            continue
+        result = {'nodes': nodes}
+        try:
+            result['seconds'] = measure(func)
+        except RecursionError as error:
+            result['error'] = '{}: {}'.format(type(error).__name__, error)
+        results[name] = result
+        sys.stderr.write('{:<32} {}\n'.format(
+            name, result.get('seconds', result.get('error'))))
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    '''Returns the names of benchmarks slower than baseline * threshold'''
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        before = baseline['results'].get(name, {}).get('seconds')
+        after = result.get('seconds')
+        if before is None or after is None:
+            continue
+        ratio = after / before
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        sys.stderr.write('{:<32} {:>12.6f} {:>12.6f} {:>7.2f}x{}\n'.format(
+            name, before, after, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated query sizes (nodes)')
+    parser.add_argument('--filter', help='only run benchmarks containing this')
+    parser.add_argument('--save', help='write results to this file')
+    parser.add_argument('--baseline', help='compare with a saved file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio that counts as a regression')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run(sizes, args.filter)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  args.threshold)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
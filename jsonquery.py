@@ -1,7 +1,27 @@
-import operator
+import array
+import base64
+import bisect
+import codecs
 import collections
+import contextlib
+import datetime
+import decimal
+import functools
+import hashlib
+import importlib
+import itertools
+import json as jsonlib
+import logging
+import marshal
+import numbers
+import operator
+import re
 import sys
-import sqlalchemy
+import threading
+import time
+import uuid
+import warnings
+from json.decoder import scanstring
 
 PYTHON_VERSION = sys.version_info
 
@@ -12,16 +32,51 @@ else:  # pragma: no cover
     # PYTHON 2k: strings can be str or unicode
     is_string = lambda s: isinstance(s, basestring)  # flake8: noqa
 
+try:  # pragma: no cover
+    from collections.abc import Sequence
+except ImportError:  # pragma: no cover
+    # PYTHON < 3.3: abstract base classes live on collections
+    from collections import Sequence
+
+
+class _LazyModule(object):
+    '''
+    Stands in for a module global until an attribute is first used, then
+    imports the module (and submodules) and replaces itself in globals().
+    Keeps parsing, validation and in-memory evaluation from paying for the
+    SQLAlchemy import.
+    '''
+    def __init__(self, name, *submodules):
+        self._name = name
+        self._submodules = submodules
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        module = importlib.import_module(self._name)
+        for submodule in self._submodules:
+            importlib.import_module(submodule)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self._name)
+
+
+sqlalchemy = _LazyModule('sqlalchemy', 'sqlalchemy.orm')
 DEFAULT_QUERY_CONSTRAINTS = {
     'max_breadth': None,
     'max_depth': None,
-    'max_elements': 64
+    'max_elements': 64,
+    'max_cost': None,
 }
 
 OPERATORS = {}
+OPERATOR_TYPES = {}
+SCHEMAS = {}
 
 
-def register_operator(opstring, func):
+def register_operator(opstring, func, types=None):
     '''
     Registers a function so that the operator can be used in queries.
 
@@ -51,8 +106,30 @@ def register_operator(opstring, func):
 
         See http://docs.sqlalchemy.org/en/rel_0_8/orm/query.html\
             #sqlalchemy.orm.query.Query.filter.
+
+    types (Optional):
+        Tuple of column types (sqlalchemy.types.TypeEngine subclasses) the
+        operator can be used with.  A type can also be given by its name in
+        the sqlalchemy module, such as 'String', so that sqlalchemy isn't
+        imported until the types are checked.  Only checked for models
+        registered with register_model.  Default is None (any type).
     '''
     OPERATORS[opstring] = func
+    OPERATOR_TYPES[opstring] = types
+    _refresh_schemas()
+
+
+def unregister_operator(opstring):
+    '''Removes an operator so that it can no longer be used in queries'''
+    del OPERATORS[opstring]
+    del OPERATOR_TYPES[opstring]
+    _refresh_schemas()
+
+
+def _refresh_schemas():
+    for schema in SCHEMAS.values():
+        schema.refresh()
+
 
 binops = {
     '<': operator.lt,
@@ -70,15 +147,26 @@ attr_funcs = [
     'ilike',
     'in_'
 ]
+attr_types = {
+    'like': ('String',),
+    'ilike': ('String',),
+}
 
 
 def attr_op(op):
-    return lambda col, value: getattr(col, op)(value)
+    def func(col, value):
+        return getattr(col, op)(value)
+    # Lets ModelSchema bind the column's method once instead of per call
+    func.attr = op
+    return func
+
+
 for opstring in attr_funcs:
-    register_operator(opstring, attr_op(opstring))
+    register_operator(opstring, attr_op(opstring), attr_types.get(opstring))
 
 
-def jsonquery(session, model, json, **kwargs):
+def jsonquery(session, model, json, cache=None, optimize=False, bulk_in=None,
+              plan=False, cost_model=None, **kwargs):
     '''
     Returns a query object built from the given json.
     Usage:
@@ -115,6 +203,13 @@ def jsonquery(session, model, json, **kwargs):
                 value: 'pat%'
             }
 
+        Columns: Relationships
+            {
+                column: 'orders.total',
+                operator: '>',
+                value: 100
+            }
+
         Logical operators 'and' and 'or' take an array, while 'not'
         takes a single value.  It is invalid to have a logical operator
         as the value of a subquery.
@@ -128,6 +223,40 @@ def jsonquery(session, model, json, **kwargs):
             String wildcard character is "%", so "pat%" matches "patrick"
             and "patty".  Default escape character is '/'
 
+        Columns of related models are named with a path of relationships.
+        Many-to-one relationships at the start of the path are outer joined
+        once per path; the rest of the path is built as EXISTS subqueries
+        (relationship.any() and .has()), and column nodes under the same
+        'or' share the subquery for a relationship.
+
+        Pages
+            {
+                filter: OBJ,
+                order_by: ['-age', 'name'],
+                limit: 20,
+                after: CURSOR
+            }
+
+        A page wraps a query (filter) to order and limit its rows.  Every
+        key is optional.  Columns in order_by sort ascending, or descending
+        with a leading "-"; the primary key is always appended so the order
+        is total.  after is a cursor from next_cursor() for the last row of
+        the previous page, and is applied as a seek on the order_by columns
+        (WHERE (age, name, id) > (...)) rather than an OFFSET, so every page
+        costs the same to fetch.  Sort columns shouldn't be NULL.
+
+        Pages can also choose what is loaded for each row:
+            {
+                fields: ['name', 'email'],
+                defer: ['bio'],
+                load: {orders: 'selectin', company: 'joined'}
+            }
+
+        fields only loads the given columns (and the primary key and
+        order_by columns); others are loaded when first accessed.  defer
+        skips the given columns.  load picks a LOADERS strategy for each
+        relationship: selectin, joined, subquery, lazy, raise or noload.
+
     max_breadth (Optional):
         Maximum number of elements in a single and/or operator.
         Default is None.
@@ -140,82 +269,3846 @@ def jsonquery(session, model, json, **kwargs):
         Maximum number of constraints and logical operators allowed in a query.
         Default is 64.
 
+    max_cost (Optional):
+        Maximum estimated cost of a query, scored by cost_model.
+        Default is None.
+
+    cost_model (Optional):
+        CostModel that scores the query for max_cost, and can tag the
+        query with a statement timeout.  Default is DEFAULT_COST_MODEL.
+
+    cache (Optional):
+        QueryCache to reuse criteria built for queries of the same shape.
+        Default is None (always build).
+
+    optimize (Optional):
+        Simplify the json with optimize_query before building it.
+        Default is False.
+
+    bulk_in (Optional):
+        BulkIn to choose how large 'in_' lists are sent to the database.
+        Default is None (always as an IN list of literals).
+
+    plan (Optional):
+        Order and/or children by index use with plan_query before building.
+        Default is False.
+
+    '''
+    return _apply(session.query(model), session, model, json, cache=cache,
+                  optimize=optimize, bulk_in=bulk_in, plan=plan,
+                  cost_model=cost_model, **kwargs)
+
+
+def jsonselect(model, json, cache=None, optimize=False, bulk_in=None,
+               plan=False, cost_model=None, **kwargs):
+    '''
+    Returns a select() statement built from the given json, for use with
+    SQLAlchemy's 2.0-style execution (session.execute, connection.execute).
+    Usage:
+        statement = jsonselect(model, json, query_constraints)
+        users = session.execute(statement).scalars().all()
+
+    model, json, cache, optimize, bulk_in, plan, cost_model,
+    query_constraints:
+        See jsonquery.  bulk_in can't use temp tables without a session.
+    '''
+    return _apply(sqlalchemy.select(model), None, model, json, cache=cache,
+                  optimize=optimize, bulk_in=bulk_in, plan=plan,
+                  cost_model=cost_model, **kwargs)
+
+
+def async_jsonquery(session, model, json, **kwargs):
+    '''
+    Runs the query built from the given json on an AsyncSession or
+    AsyncConnection.  Returns an awaitable for the Result.
+    Usage:
+        result = await async_jsonquery(session, model, json)
+        users = result.scalars().all()
+
+    session:
+        sqlalchemy.ext.asyncio.AsyncSession or AsyncConnection
+
+    model, json, cache, optimize, query_constraints:
+        See jsonquery
+    '''
+    return session.execute(jsonselect(model, json, **kwargs))
+
+
+def async_jsonquery_stream(session, model, json, chunk_size=1000, **kwargs):
+    '''
+    Runs the query built from the given json on an AsyncSession or
+    AsyncConnection with a server-side cursor.  Returns an awaitable for
+    the AsyncResult, which fetches chunk_size rows at a time.
+    Usage:
+        result = await async_jsonquery_stream(session, model, json)
+        async for user in result.scalars():
+            export(user)
+
+    chunk_size (Optional):
+        Number of rows fetched at a time.  Default is 1000.
+
+    session, model, json, cache, optimize, query_constraints:
+        See async_jsonquery
+    '''
+    statement = jsonselect(model, json, **kwargs)
+    return session.stream(statement.execution_options(yield_per=chunk_size))
+
+
+def _apply(query, session, model, json, cache=None, optimize=False,
+           bulk_in=None, plan=False, cost_model=None, **kwargs):
+    '''
+    Filters, orders and limits query (a Query or a Select) by the json
+    '''
+    page = None
+    if _is_page(json):
+        page, json = json, json.get('filter')
+    metrics = None
+    if _LISTENERS and json is not None:
+        # Measuring checks the constraints, so queries that would be
+        # rejected aren't walked in full first
+        metrics = QueryMetrics(model, json, dict(
+            DEFAULT_QUERY_CONSTRAINTS, **kwargs))
+    execution_options = {}
+    if json is not None:
+        with _phase(metrics, 'prepare'):
+            json, constraints = _prepare(json, optimize, kwargs)
+            if plan:
+                # Reordering changes element counts, so the planned json
+                # is built with the constraints it was checked against
+                json = plan_query(model, json, **constraints)
+                constraints = dict((key, None) for key in constraints)
+            execution_options = _admit(model, json, kwargs, cost_model)
+        with _phase(metrics, 'build'):
+            if cache is not None:
+                hits = cache.hits
+                criterion, params = cache.criterion(model, json, constraints)
+                query = query.filter(criterion).params(params)
+                if metrics is not None:
+                    metrics.cache_hit = cache.hits > hits
+            else:
+                joins = collections.OrderedDict()
+                query = query.filter(_build(json, model, constraints,
+                                            bulk_in=bulk_in, session=session,
+                                            joins=joins))
+                for alias, onclause in joins.values():
+                    query = query.outerjoin(alias, onclause)
+    if page is not None:
+        query = _paginate(query, model, page)
+        options = _load_options(model, page)
+        if options:
+            query = query.options(*options)
+    if metrics is not None:
+        execution_options[_METRICS_OPTION] = metrics
+    if execution_options:
+        query = query.execution_options(**execution_options)
+    return query
+
+
+def next_cursor(model, json, row):
+    '''
+    Returns the cursor for the page after the one that ends with row.
+    Usage:
+        users = jsonquery(session, User, page).all()
+        if users:
+            page['after'] = next_cursor(User, page, users[-1])
+
+    model, json:
+        The model and page json that row was loaded with
+
+    Sort columns can hold json values (strings, numbers and booleans) or
+    any of the _CURSOR_TYPES (dates, times, Decimal and UUID); other types
+    raise ValueError.
+    '''
+    values = [getattr(row, name) for name, _, _ in _order_by(model, json)]
+    token = jsonlib.dumps(values, separators=(',', ':'),
+                          default=_encode_cursor_value)
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+
+# (tag, type, encode, decode) for cursor values that aren't json.  datetime
+# is a date, so it's checked first.
+_CURSOR_TYPES = [
+    ('$datetime', datetime.datetime, datetime.datetime.isoformat,
+     datetime.datetime.fromisoformat),
+    ('$date', datetime.date, datetime.date.isoformat,
+     datetime.date.fromisoformat),
+    ('$time', datetime.time, datetime.time.isoformat,
+     datetime.time.fromisoformat),
+    ('$decimal', decimal.Decimal, str, decimal.Decimal),
+    ('$uuid', uuid.UUID, str, uuid.UUID),
+]
+_CURSOR_DECODERS = dict((tag, decode) for tag, _, _, decode in _CURSOR_TYPES)
+
+
+def _encode_cursor_value(value):
+    for tag, cls, encode, _ in _CURSOR_TYPES:
+        if isinstance(value, cls):
+            return {tag: encode(value)}
+    raise ValueError("Can't use {} values in a cursor".format(
+        type(value).__name__))
+
+
+def _decode_cursor_value(obj):
+    if len(obj) == 1:
+        tag, value = next(iter(obj.items()))
+        decode = _CURSOR_DECODERS.get(tag)
+        if decode is not None:
+            if not is_string(value):
+                raise ValueError('Invalid cursor')
+            return decode(value)
+    return obj
+
+
+PAGE_KEYS = frozenset(['filter', 'order_by', 'limit', 'after', 'fields',
+                       'defer', 'load'])
+
+
+def _is_page(json):
+    '''
+    True for a page json, False for a query node.  Every query node has an
+    operator, so any other dict must be a non-empty page with only
+    PAGE_KEYS; a typo'd filter such as {"column": ..., "op": ...} raises
+    ValueError instead of matching every row.
+    '''
+    if isinstance(json, QueryTree) or 'operator' in json:
+        return False
+    unknown = set(json) - PAGE_KEYS
+    if not json or unknown:
+        raise ValueError('Invalid query or page (unknown keys: {})'.format(
+            ', '.join(sorted(map(str, unknown)))))
+    return True
+
+
+def _paginate(query, model, page):
+    '''Applies the order, cursor and limit of a page json to query'''
+    order_by = _order_by(model, page)
+    after = page.get('after')
+    if after is not None:
+        query = query.filter(_seek(
+            [column for _, column, _ in order_by],
+            _decode_cursor(after, len(order_by)),
+            [descending for _, _, descending in order_by]))
+    query = query.order_by(*[column.desc() if descending else column
+                             for _, column, descending in order_by])
+    limit = page.get('limit')
+    if limit is not None:
+        if not isinstance(limit, int) or isinstance(limit, bool) or \
+                limit < 0:
+            raise ValueError('Invalid limit ({})'.format(limit))
+        query = query.limit(limit)
+    return query
+
+
+def _order_by(model, page):
+    '''
+    Returns a list of (name, column, descending) for the page's order_by,
+    followed by any primary key columns it doesn't include
+    '''
+    mapper = sqlalchemy.inspect(model)
+    order_by = []
+    for name in page.get('order_by') or []:
+        if not is_string(name):
+            raise ValueError('Invalid order_by ({})'.format(name))
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        order_by.append((name, _column(model, name), descending))
+    names = set(name for name, _, _ in order_by)
+    for column in mapper.primary_key:
+        name = mapper.get_property_by_column(column).key
+        if name not in names:
+            order_by.append((name, getattr(model, name), False))
+    return order_by
+
+
+# Loader functions, or their names in sqlalchemy.orm
+LOADERS = {
+    'selectin': 'selectinload',
+    'joined': 'joinedload',
+    'subquery': 'subqueryload',
+    'lazy': 'lazyload',
+    'raise': 'raiseload',
+    'noload': 'noload',
+}
+
+
+def _load_options(model, page):
+    '''Returns loader options for the fields, defer and load of a page'''
+    options = []
+    fields = page.get('fields')
+    if fields is not None:
+        names = list(fields)
+        if page.get('order_by'):
+            names.extend(name for name, _, _ in _order_by(model, page))
+        options.append(sqlalchemy.orm.load_only(
+            *[_column(model, name) for name in names]))
+    for name in page.get('defer') or []:
+        options.append(sqlalchemy.orm.defer(_column(model, name)))
+    relationships = sqlalchemy.inspect(model).relationships
+    for name, strategy in sorted((page.get('load') or {}).items()):
+        if name not in relationships:
+            raise ValueError('Unknown relationship ({})'.format(name))
+        if strategy not in LOADERS:
+            raise ValueError('Unknown loader ({})'.format(strategy))
+        loader = _lookup(sqlalchemy.orm, LOADERS[strategy])
+        options.append(loader(getattr(model, name)))
+    return options
+
+
+def _decode_cursor(cursor, length):
+    try:
+        values = jsonlib.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'),
+            object_hook=_decode_cursor_value)
+    except (TypeError, ValueError, UnicodeError, AttributeError,
+            decimal.InvalidOperation):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def jsonquery_count(session, model, json, **kwargs):
+    '''
+    Returns the number of rows that match the json, with a single
+    SELECT count(*) against the model's table and no ORM entities loaded.
+    Usage:
+        adults = jsonquery_count(session, model, json)
+
+    A page's order_by, limit and after are ignored; only its filter is used.
+
+    session, model, json, cache, optimize, bulk_in, query_constraints:
+        See jsonquery
+    '''
+    query = sqlalchemy.select(sqlalchemy.func.count()).select_from(model)
+    return session.scalar(_filter(query, session, model, json, **kwargs))
+
+
+def jsonquery_exists(session, model, json, **kwargs):
+    '''
+    Returns True if any row matches the json, with SELECT EXISTS(...) so
+    the database can stop at the first match.
+    Usage:
+        if jsonquery_exists(session, model, json):
+            ...
+
+    session, model, json, cache, optimize, bulk_in, query_constraints:
+        See jsonquery_count
+    '''
+    query = sqlalchemy.select(sqlalchemy.literal(1)).select_from(model)
+    query = _filter(query, session, model, json, **kwargs)
+    return bool(session.scalar(sqlalchemy.select(query.exists())))
+
+
+# Aggregate functions, or their names in sqlalchemy.func
+AGGREGATES = {
+    'count': 'count',
+    'sum': 'sum',
+    'avg': 'avg',
+    'min': 'min',
+    'max': 'max',
+}
+
+
+def _lookup(namespace, value):
+    '''Returns value, or the attribute of namespace it names'''
+    if is_string(value):
+        return getattr(namespace, value)
+    return value
+
+
+def jsonquery_aggregate(session, model, json, aggregates, group_by=None,
+                        **kwargs):
+    '''
+    Returns one row per group of the rows that match the json, with the
+    group_by columns followed by the aggregates in order of their labels,
+    as a list of named tuples.
+    The aggregates are computed by the database in a single GROUP BY.
+    Usage:
+        rows = jsonquery_aggregate(
+            session, model, json, group_by=['name'],
+            aggregates={'total': ['count'], 'oldest': ['max', 'age']})
+        for row in rows:
+            print(row.name, row.total, row.oldest)
+
+    aggregates:
+        Dict of label => [function] or [function, column], where function
+        is a key of AGGREGATES.  ['count'] counts rows.
+
+    group_by (Optional):
+        List of column names to group by.  Default is None (a single row
+        that aggregates all of the matching rows).
+
+    session, model, json, cache, optimize, bulk_in, query_constraints:
+        See jsonquery_count
+    '''
+    columns = [_column(model, name).label(name) for name in group_by or []]
+    for label, spec in sorted(aggregates.items()):
+        if not spec or len(spec) > 2 or spec[0] not in AGGREGATES:
+            raise ValueError('Invalid aggregate ({})'.format(label))
+        args = [_column(model, name) for name in spec[1:]]
+        func = _lookup(sqlalchemy.func, AGGREGATES[spec[0]])
+        columns.append(func(*args).label(label))
+    query = sqlalchemy.select(*columns).select_from(model)
+    query = _filter(query, session, model, json, **kwargs)
+    if group_by:
+        query = query.group_by(*columns[:len(group_by)])
+    return session.execute(query).all()
+
+
+def _filter(query, session, model, json, **kwargs):
+    '''Filters query by the json, or the filter of a page json'''
+    if _is_page(json):
+        json = json.get('filter')
+        if json is None:
+            return query
+    return _apply(query, session, model, json, **kwargs)
+
+
+def _column(model, name):
+    '''Returns the mapped column attribute of model with the given name'''
+    if name not in sqlalchemy.inspect(model).column_attrs:
+        raise ValueError('Unknown column ({})'.format(name))
+    return getattr(model, name)
+
+
+_LISTENERS = []
+_LOCK = threading.Lock()
+_METRICS_OPTION = 'jsonquery_metrics'
+_timer = getattr(time, 'perf_counter', time.time)
+logger = logging.getLogger('jsonquery')
+
+
+def add_listener(listener):
+    '''
+    Calls listener(metrics) with a QueryMetrics each time a query built by
+    jsonquery, jsonselect, jsonquery_count, jsonquery_exists or
+    jsonquery_aggregate is executed.
+    Usage:
+        add_listener(SlowQueryLogger(threshold=0.5))
+
+    Nothing is measured while there are no listeners.  Listeners are
+    called from the thread that executes the query, and exceptions they
+    raise are logged and otherwise ignored.
+    '''
+    _install_events()
+    _LISTENERS.append(listener)
+
+
+def remove_listener(listener):
+    '''Removes a listener added with add_listener'''
+    _LISTENERS.remove(listener)
+
+
+@contextlib.contextmanager
+def instrument(listener=None):
+    '''
+    Adds a listener for the body of a with block.  Without a listener, the
+    QueryMetrics of every query executed in the block are collected in the
+    list it yields.
+    Usage:
+        with instrument() as metrics:
+            jsonquery(session, User, json).all()
+        print(metrics[0].phases)
+    '''
+    collected = []
+    if listener is None:
+        listener = collected.append
+    add_listener(listener)
+    try:
+        yield collected
+    finally:
+        remove_listener(listener)
+
+
+class QueryMetrics(object):
+    '''
+    Measurements for one query, passed to listeners once it's executed
+
+    model:
+        The model queried
+    shape:
+        The query json with every value replaced by '?'
+    nodes, depth, breadth:
+        Number of nodes, deepest nesting and widest and/or of the query
+    phases:
+        Dict of phase => seconds, for 'prepare' (optimize and plan),
+        'build' (validation and building), 'compile' (from execute() until
+        the SQL is sent, which includes compiling or a compiled cache
+        lookup) and 'execute' (until the database returns)
+    cache_hit:
+        True or False when built with a QueryCache, otherwise None
+    sql:
+        The SQL sent to the database
+
+    With constraints (see query_constraints in jsonquery), the json is
+    checked against them as it's measured.
+    '''
+    __slots__ = ('model', 'shape', 'nodes', 'depth', 'breadth', 'phases',
+                 'cache_hit', 'sql', '_started')
+
+    def __init__(self, model, json, constraints=None):
+        self.model = model
+        self.shape, self.nodes, self.depth, self.breadth = _measure(
+            json, constraints)
+        self.phases = {}
+        self.cache_hit = None
+        self.sql = None
+        self._started = None
+
+    @property
+    def total(self):
+        '''Seconds spent in every phase'''
+        return sum(self.phases.values())
+
+    def __repr__(self):
+        return '<QueryMetrics {} nodes={} total={:.6f}s>'.format(
+            self.model.__name__, self.nodes, self.total)
+
+
+class MetricsAdapter(object):
+    '''
+    Base class for listeners that forward QueryMetrics to a metrics system
+    (statsd, Prometheus, ...).  Subclasses implement timing() and gauge().
+    Usage:
+        class StatsdAdapter(MetricsAdapter):
+            def timing(self, name, seconds, tags):
+                statsd.timing(name, seconds * 1000, tags=tags)
+
+            def gauge(self, name, value, tags):
+                statsd.gauge(name, value, tags=tags)
+
+        add_listener(StatsdAdapter())
+    '''
+    prefix = 'jsonquery'
+
+    def __call__(self, metrics):
+        tags = {'model': metrics.model.__name__}
+        if metrics.cache_hit is not None:
+            tags['cache'] = 'hit' if metrics.cache_hit else 'miss'
+        for phase, seconds in metrics.phases.items():
+            self.timing('{}.{}'.format(self.prefix, phase), seconds, tags)
+        self.timing('{}.total'.format(self.prefix), metrics.total, tags)
+        for name in ('nodes', 'depth', 'breadth'):
+            self.gauge('{}.{}'.format(self.prefix, name),
+                       getattr(metrics, name), tags)
+
+    def timing(self, name, seconds, tags):
+        raise NotImplementedError
+
+    def gauge(self, name, value, tags):
+        raise NotImplementedError
+
+
+class SlowQueryLogger(object):
+    '''
+    Listener that logs queries that take longer than threshold seconds
+    (in total, over every phase) to the 'jsonquery' logger, with the
+    query's shape so that queries with different values are grouped.
+    '''
+    def __init__(self, threshold=1.0, logger=logger, level=logging.WARNING):
+        self.threshold = threshold
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, metrics):
+        if metrics.total < self.threshold:
+            return
+        self.logger.log(
+            self.level, 'Slow query on %s (%.3fs, %s nodes): %s',
+            metrics.model.__name__, metrics.total, metrics.nodes,
+            jsonlib.dumps(metrics.shape, sort_keys=True),
+            extra={'jsonquery_metrics': metrics})
+
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+@contextlib.contextmanager
+def _timed(metrics, name):
+    start = _timer()
+    try:
+        yield
+    finally:
+        metrics.phases[name] = _timer() - start
+
+
+def _phase(metrics, name):
+    '''Times the with block as phase name of metrics, if there are any'''
+    if metrics is None:
+        return _NO_PHASE
+    return _timed(metrics, name)
+
+
+def _measure(json, constraints=None):
+    '''
+    Returns (shape, nodes, depth, breadth) of a query json, checked against
+    constraints if there are any
+    '''
+    json = _as_json(json)
+    constraints = constraints or _UNCHECKED
+    stats = [0, 0]
+
+    def leaf(node):
+        return {'column': node['column'], 'operator': node['operator'],
+                'value': '?'}
+
+    def logical(op, children):
+        stats[1] = max(stats[1], len(children))
+        value = children[0] if op == 'not' else children
+        return {'operator': op, 'value': value}
+
+    def count(node):
+        nodes = depth = 0
+        stack = [(node, 1)]
+        while stack:
+            node, level = stack.pop()
+            nodes += 1
+            depth = max(depth, level)
+            value = node['value']
+            if node['operator'] == 'not':
+                stack.append((value, level + 1))
+            elif node['operator'] in ('and', 'or'):
+                stack.extend((child, level + 1) for child in value)
+        return nodes, depth
+
+    shape = _fold(json, constraints, leaf, dict(
+        (op, functools.partial(logical, op)) for op in ('and', 'or', 'not')))
+    nodes, depth = count(json)
+    return shape, nodes, depth, stats[1]
+
+
+_EVENTS = []
+
+
+def _install_events():
+    '''Listens for executions of instrumented queries, once'''
+    with _LOCK:
+        if _EVENTS:
+            return
+        engine = sqlalchemy.engine.Engine
+        sqlalchemy.event.listen(engine, 'before_execute', _before_execute)
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                _before_cursor_execute)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute',
+                                _after_cursor_execute)
+        _EVENTS.append(True)
+
+
+def _metrics(execution_options, statement=None):
+    metrics = execution_options.get(_METRICS_OPTION)
+    if metrics is None and statement is not None:
+        get = getattr(statement, 'get_execution_options', None)
+        if get is not None:
+            metrics = get().get(_METRICS_OPTION)
+    return metrics
+
+
+def _before_execute(conn, clauseelement, multiparams, params,
+                    execution_options):
+    metrics = _metrics(execution_options, clauseelement)
+    if metrics is not None:
+        metrics._started = _timer()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    metrics = context and _metrics(context.execution_options)
+    if metrics is not None:
+        now = _timer()
+        if metrics._started is not None:
+            metrics.phases['compile'] = now - metrics._started
+        metrics._started = now
+        metrics.sql = statement
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    metrics = context and _metrics(context.execution_options)
+    if metrics is None or metrics._started is None:
+        return
+    metrics.phases['execute'] = _timer() - metrics._started
+    metrics._started = None
+    for listener in list(_LISTENERS):
+        try:
+            listener(metrics)
+        except Exception:
+            logger.exception('jsonquery listener %r failed', listener)
+
+
+def jsonquery_batch(session, model, jsons, count=False, optimize=False,
+                    cost_model=None, **kwargs):
+    '''
+    Runs several queries against the same model in a single statement.
+    Returns a list with one result per json, in the same order.
+    Usage:
+        users_per_query = jsonquery_batch(session, model, [json1, json2])
+        counts = jsonquery_batch(session, model, [json1, json2], count=True)
+
+    Rows for every query are selected with one UNION ALL, tagged with the
+    index of the query they belong to.  With count=True, every query is
+    counted with count(CASE WHEN ... ) in one SELECT, and the table is
+    filtered by any of the queries first so indexes can still be used.
+    Identical jsons are only built and run once.
+
+    count (Optional):
+        Return the number of matching rows for each json instead of a list
+        of the matching rows.  Default is False.
+
+    session, model, optimize, cost_model, query_constraints:
+        See jsonquery, but pages aren't supported since they can't be
+        ordered and limited in one statement.  Constraints apply to each
+        json separately; the statement is tagged with the statement
+        timeout of the costliest.
     '''
     constraints = dict(DEFAULT_QUERY_CONSTRAINTS)
     constraints.update(kwargs)
-    count = depth = 0
-    criterion, total_elements = _build(json, count, depth, model, constraints)
-    return session.query(model).filter(criterion)
+    positions = {}
+    unique = []
+    indexes = []
+    for json in jsons:
+        if _is_page(json):
+            raise ValueError("Pages can't be batched")
+        key = _query_key(json, constraints)
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(json)
+        indexes.append(positions[key])
 
+    criteria = []
+    execution_options = {}
+    for json in unique:
+        json, constraints = _prepare(json, optimize, kwargs)
+        options = _admit(model, json, kwargs, cost_model)
+        if options.get('jsonquery_cost', 0) >= execution_options.get(
+                'jsonquery_cost', 0):
+            execution_options = options
+        criteria.append(_build(json, model, constraints))
+    if not criteria:
+        return []
 
-def _build(node, count, depth, model, constraints):
-    count += 1
-    depth += 1
-    value = node['value']
-    _validate_query_constraints(value, count, depth, constraints)
-    logical_operators = {
-        'and': (_build_sql_sequence, sqlalchemy.and_),
-        'or': (_build_sql_sequence, sqlalchemy.or_),
-        'not': (_build_sql_unary, sqlalchemy.not_),
-    }
-    op = node['operator']
-    if op in logical_operators:
-        builder, func = logical_operators[op]
-        return builder(node, count, depth, model, constraints, func)
-    else:
-        return _build_column(node, model), count
+    if count:
+        counts = [sqlalchemy.func.count(sqlalchemy.case((criterion, 1)))
+                  for criterion in criteria]
+        query = session.query(*counts).select_from(model)
+        query = query.filter(sqlalchemy.or_(*criteria))
+        results = list(query.execution_options(**execution_options).one())
+        return [results[index] for index in indexes]
 
+    queries = [
+        session.query(model, sqlalchemy.literal(index).label(_BATCH_TAG))
+        .filter(criterion) for index, criterion in enumerate(criteria)]
+    results = [[] for _ in criteria]
+    query = queries[0].union_all(*queries[1:])
+    for instance, index in query.execution_options(**execution_options):
+        results[index].append(instance)
+    return [list(results[index]) for index in indexes]
 
-def _validate_query_constraints(value, count, depth, constraints):
-        '''Raises if any query constraints are violated'''
-        max_breadth = constraints['max_breadth']
-        max_depth = constraints['max_depth']
-        max_elements = constraints['max_elements']
 
-        if max_depth and depth > max_depth:
-            raise ValueError('Depth limit ({}) exceeded'.format(max_depth))
+_BATCH_TAG = 'jsonquery_batch'
 
-        element_breadth = 1
-        if isinstance(value, collections.Sequence) and not is_string(value):
-            element_breadth = len(value)
 
-        if max_breadth and element_breadth > max_breadth:
-                raise ValueError(
-                    'Breadth limit ({}) exceeded'.format(max_breadth))
+def jsonquery_stream(session, model, json, chunk_size=1000, columns=None,
+                     keyset=False, optimize=False, cost_model=None, **kwargs):
+    '''
+    Yields the rows matching the given json, fetching chunk_size rows at a
+    time so memory use doesn't grow with the size of the result.
+    Usage:
+        for user in jsonquery_stream(session, model, json):
+            export(user)
+        for name, age in jsonquery_stream(session, model, json,
+                                          columns=['name', 'age']):
+            export(name, age)
 
-        count += element_breadth
-        if max_elements and count > max_elements:
-            raise ValueError(
-                'Filter elements limit ({}) exceeded'.format(max_elements))
+    By default the query is run once with Query.yield_per, which asks the
+    driver for a server-side cursor where it has one.  With keyset=True,
+    every chunk is a separate query ordered by primary key that seeks past
+    the last row of the previous chunk; this doesn't keep a cursor (or a
+    transaction) open between chunks, and each chunk costs the same no
+    matter how deep into the result it is.
+
+    chunk_size (Optional):
+        Number of rows fetched at a time.  Default is 1000.
+
+    columns (Optional):
+        List of column names to select, which must be mapped columns of
+        the model.  Rows are then yielded as tuples of those columns
+        instead of model instances, which skips building ORM objects and
+        adding them to the session.  Default is None.
+
+    keyset (Optional):
+        Page through the result by primary key instead of keeping a cursor
+        open.  Default is False.
 
+    session, model, json, optimize, cost_model, query_constraints:
+        See jsonquery.  Pages aren't supported; rows are streamed in
+        primary key order with keyset=True, and in no particular order
+        otherwise.
+    '''
+    if _is_page(json):
+        raise ValueError("Pages can't be streamed")
+    json, constraints = _prepare(json, optimize, kwargs)
+    execution_options = _admit(model, json, kwargs, cost_model)
+    criterion = _build(json, model, constraints)
+    if columns is None:
+        entities = [model]
+    else:
+        entities = [_column(model, column) for column in columns]
+
+    if not keyset:
+        query = session.query(*entities).filter(criterion)
+        query = query.execution_options(**execution_options)
+        for row in query.yield_per(chunk_size):
+            yield row
+        return
+
+    primary_key = list(sqlalchemy.inspect(model).primary_key)
+    width = len(entities)
+    query = session.query(*(entities + primary_key)).filter(criterion)
+    query = query.execution_options(**execution_options)
+    last = None
+    while True:
+        chunk = query
+        if last is not None:
+            chunk = chunk.filter(_seek(primary_key, last))
+        rows = chunk.order_by(*primary_key).limit(chunk_size).all()
+        for row in rows:
+            yield row[0] if columns is None else tuple(row[:width])
+        if len(rows) < chunk_size:
+            return
+        last = tuple(rows[-1][width:])
 
-def _build_sql_sequence(node, count, depth, model, constraints, func):
+
+def _seek(columns, values, descending=None):
     '''
-    func is either sqlalchemy.and_ or sqlalchemy.or_
-    Build each subquery in node['value'], then combine with func(*subqueries)
+    Criterion for rows ordered after values, where descending has a flag
+    for each column (default all ascending)
     '''
-    subqueries = []
-    for value in node['value']:
-        subquery, count = _build(value, count, depth, model, constraints)
-        subqueries.append(subquery)
-    return func(*subqueries), count
+    descending = descending or [False] * len(columns)
+    if len(set(descending)) == 1:
+        # One direction: a row value comparison, which can use an index on
+        # the columns directly
+        if len(columns) == 1:
+            left, right = columns[0], values[0]
+        else:
+            left = sqlalchemy.tuple_(*columns)
+            right = sqlalchemy.tuple_(*values)
+        return left < right if descending[0] else left > right
+
+    # Mixed directions: (a > x) or (a == x and b < y) or ...
+    criteria = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        after = column < value if descending[i] else column > value
+        ties = [c == v for c, v in zip(columns[:i], values[:i])]
+        criteria.append(sqlalchemy.and_(*(ties + [after])))
+    return sqlalchemy.or_(*criteria)
 
 
-def _build_sql_unary(node, count, depth, model, constraints, func):
+def parallel_jsonquery(shards, model, json, executor=None, split_or=True,
+                       max_workers=None, optimize=False, cost_model=None,
+                       **kwargs):
     '''
-    func is sqlalchemy.not_ (may support others)
+    Runs a query on several databases (shards) at once, and the branches of
+    a top-level 'or' as separate queries, on a pool of workers with one
+    connection each.  Returns the matching rows as a list of detached
+    instances, without duplicates.
+    Usage:
+        users = parallel_jsonquery(
+            ['sqlite:///users-0.db', 'sqlite:///users-1.db'], User, json,
+            executor=ProcessPoolExecutor())
+
+    shards:
+        List of session factories (such as a sessionmaker), or database
+        URLs.  Workers create one engine per URL and reuse it.  Process
+        pools need URLs, and a model that can be imported by name.
+
+    executor (Optional):
+        concurrent.futures executor to run the queries on.  Default is a
+        ThreadPoolExecutor with max_workers threads, shut down afterwards.
+
+    split_or (Optional):
+        Run each branch of a top-level 'or' as its own query.  Rows that
+        match more than one branch are only returned once: rows are the
+        same when they come from the same shard with the same primary key.
+        Default is True.
+
+    Rows are in shard order, then in the order of the branches.  Pages
+    aren't supported, since they can't be ordered and limited per shard.
+
+    model, json, optimize, cost_model, query_constraints:
+        See jsonquery.  The constraints apply to the whole json; each
+        query is tagged with the statement timeout for its own branch.
     '''
-    value = node['value']
-    subquery, count = _build(value, count, depth, model, constraints)
-    return func(subquery), count
+    if _is_page(json):
+        raise ValueError("Pages can't be run in parallel")
+    json, constraints = _prepare(json, optimize, kwargs)
+    _fold(json, constraints, _ignore, _IGNORE_LOGICAL)
+    _admit(model, json, kwargs, cost_model)
+    unchecked = dict((key, None) for key in constraints)
+    json = _as_json(json)
 
+    branches = [json]
+    if split_or and json['operator'] == 'or' and len(json['value']) > 1:
+        branches = json['value']
+    tasks = [(index, shard, branch) for index, shard in enumerate(shards)
+             for branch in branches]
 
-def _build_column(node, model):
-    # string => sqlalchemy.orm.attributes.InstrumentedAttribute
-    column = node['column']
-    column = getattr(model, column)
+    owned = executor is None
+    if owned:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers or len(tasks) or 1)
+    try:
+        futures = [executor.submit(_run_shard, shard, model, branch,
+                                   unchecked, cost_model)
+                   for _, shard, branch in tasks]
+        results = [future.result() for future in futures]
+    finally:
+        if owned:
+            executor.shutdown()
 
-    op = node['operator']
-    value = node['value']
+    mapper = sqlalchemy.inspect(model)
+    seen = set()
+    rows = []
+    for (index, _, _), instances in zip(tasks, results):
+        for instance in instances:
+            key = (index, tuple(mapper.primary_key_from_instance(instance)))
+            if key not in seen:
+                seen.add(key)
+                rows.append(instance)
+    return rows
 
-    return OPERATORS[op](column, value)
+
+_ENGINES = {}
+
+
+def _run_shard(shard, model, json, constraints, cost_model=None):
+    '''Returns the detached rows that match json on one shard'''
+    if is_string(shard):
+        with _LOCK:
+            engine = _ENGINES.get(shard)
+            if engine is None:
+                engine = _ENGINES[shard] = sqlalchemy.create_engine(shard)
+        session = sqlalchemy.orm.Session(bind=engine)
+    else:
+        session = shard()
+    try:
+        return jsonquery(session, model, json, cost_model=cost_model,
+                         **constraints).all()
+    finally:
+        session.close()
+
+
+def jsonquery_raw(session, model, data, max_bytes=None, **kwargs):
+    '''
+    Returns a query object built from raw json.
+    Usage:
+        query = jsonquery_raw(session, model, request.body)
+        query = jsonquery_raw(session, model, request.stream,
+                              max_bytes=65536)
+
+    data, max_bytes:
+        See parse_query
+
+    session, model, cache, optimize, query_constraints:
+        See jsonquery
+    '''
+    constraints = dict((key, kwargs[key]) for key in DEFAULT_QUERY_CONSTRAINTS
+                       if key in kwargs)
+    json = parse_query(data, max_bytes=max_bytes, **constraints)
+    return jsonquery(session, model, json, **kwargs)
+
+
+def parse_query(data, max_bytes=None, chunk_size=65536, **kwargs):
+    '''
+    Parses raw json into a query, rejecting queries over the query
+    constraints.
+    Usage:
+        json = parse_query(b'{"column": "age", ...}', max_elements=64)
+        json = parse_query(request.stream, max_bytes=65536)
+
+    data:
+        bytes, str, or a file-like object with a read() method returning
+        either.  bytes are decoded as UTF-8.
+
+    max_bytes (Optional):
+        Maximum size of the raw json, in bytes (or characters, when reading
+        str).  Default is None.
+
+    chunk_size (Optional):
+        Size of each read() from a file-like object.  Default is 65536.
+
+    query_constraints:
+        See jsonquery
+
+    bytes and str are parsed with orjson when it's installed, or the json
+    module, and then validated.
+
+    File-like objects are parsed as they're read, checking the constraints
+    as each token arrives, so a query that's too large is rejected without
+    reading (or holding) the rest of it.  While reading, every json object
+    counts as an element and every level of nested objects as depth, with
+    one extra of each allowed for a page around the query.  The parsed
+    query is then validated exactly like any other json.
+    '''
+    constraints = dict(DEFAULT_QUERY_CONSTRAINTS)
+    constraints.update(kwargs)
+    if hasattr(data, 'read'):
+        json = _StreamParser(data.read, constraints, max_bytes,
+                             chunk_size).parse()
+    else:
+        if max_bytes and len(data) > max_bytes:
+            raise ValueError('Size limit ({}) exceeded'.format(max_bytes))
+        json = _json_loads()(data)
+    if not isinstance(json, dict):
+        raise ValueError('Invalid query')
+    # Check the constraints exactly as building would
+    node = json.get('filter') if _is_page(json) else json
+    if node is not None:
+        _fold(node, constraints, _ignore, _IGNORE_LOGICAL)
+    return json
+
+
+def _ignore(*args):
+    return None
+
+
+_IGNORE_LOGICAL = {
+    'and': _ignore,
+    'or': _ignore,
+    'not': _ignore,
+}
+_JSON_LOADS = []
+
+
+def _json_loads():
+    '''Returns the fastest available function to parse json'''
+    if not _JSON_LOADS:
+        try:
+            import orjson
+            _JSON_LOADS.append(orjson.loads)
+        except ImportError:
+            _JSON_LOADS.append(jsonlib.loads)
+    return _JSON_LOADS[0]
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?')
+_LITERALS = {'true': True, 'false': False, 'null': None}
+# Characters that can follow a complete number or literal
+_SCALAR_END = frozenset(' \t\n\r,]}')
+
+
+def _string_end(buffer, start):
+    '''
+    Returns the index of the first quote at or after start that isn't
+    escaped, or -1
+    '''
+    while True:
+        end = buffer.find('"', start)
+        if end < 0:
+            return end
+        escape = end
+        while buffer[escape - 1] == '\\':
+            escape -= 1
+        if (end - escape) % 2 == 0:
+            return end
+        start = end + 1
+
+
+class _StreamParser(object):
+    '''
+    Incremental json parser that checks the query constraints as tokens
+    are read.  Uses an explicit stack, so nesting depth is limited only by
+    the constraints.
+    '''
+    def __init__(self, read, constraints, max_bytes, chunk_size):
+        self.read = read
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = None
+        # Where the search for the end of an unterminated string resumes
+        self.scanned = 0
+
+        self.max_breadth = constraints['max_breadth']
+        self.max_depth = constraints['max_depth']
+        self.max_elements = constraints['max_elements']
+
+    def fill(self, until=None):
+        '''
+        Appends the next chunk to the unread part of the buffer, or with
+        until, every chunk up to one that contains it.  Returns False at
+        the end of the input.
+        '''
+        chunks = []
+        while not self.eof:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                self.eof = True
+            self.size += len(chunk)
+            if self.max_bytes and self.size > self.max_bytes:
+                raise ValueError(
+                    'Size limit ({}) exceeded'.format(self.max_bytes))
+            if isinstance(chunk, bytes):
+                if self.decoder is None:
+                    self.decoder = codecs.getincrementaldecoder('utf-8')()
+                chunk = self.decoder.decode(chunk, final=self.eof)
+            if chunk:
+                chunks.append(chunk)
+                if until is None or until in chunk:
+                    break
+        if not chunks:
+            return False
+        self.buffer = self.buffer[self.pos:] + ''.join(chunks)
+        self.scanned -= self.pos
+        self.pos = 0
+        return True
+
+    def tokens(self):
+        '''
+        Yields (token, value) where token is one of "{}[]:,", "string" or
+        "scalar"
+        '''
+        while True:
+            buffer = self.buffer
+            pos = _WHITESPACE.match(buffer, self.pos).end()
+            self.pos = pos
+            if pos == len(buffer):
+                if self.fill():
+                    continue
+                return
+            char = buffer[pos]
+            if char in '{}[]:,':
+                self.pos = pos + 1
+                yield char, None
+            elif char == '"':
+                if _string_end(buffer, max(pos + 1, self.scanned)) < 0:
+                    # Unterminated string: read up to the next quote, and
+                    # only search what's new for its end
+                    self.scanned = len(buffer)
+                    if self.fill('"'):
+                        continue
+                    raise ValueError('Invalid json')
+                self.scanned = 0
+                try:
+                    value, self.pos = scanstring(buffer, pos + 1, True)
+                except ValueError:
+                    raise ValueError('Invalid json')
+                yield 'string', value
+            else:
+                match = _NUMBER.match(buffer, pos)
+                end = match.end() if match else pos
+                for literal in _LITERALS:
+                    if buffer.startswith(literal, pos):
+                        end = pos + len(literal)
+                # A token that isn't followed by whitespace or a delimiter
+                # may continue in the next chunk ("12" | ".5", "tr" | "ue")
+                if (end == len(buffer) or buffer[end] not in _SCALAR_END) \
+                        and self.fill():
+                    continue
+                if end == pos:
+                    raise ValueError('Invalid json')
+                text = buffer[pos:end]
+                self.pos = end
+                if text in _LITERALS:
+                    yield 'scalar', _LITERALS[text]
+                elif match.group(1) or match.group(2):
+                    yield 'scalar', float(text)
+                else:
+                    yield 'scalar', int(text)
+
+    def parse(self):
+        # One extra element and level of depth for a page around the query
+        max_elements = self.max_elements and self.max_elements + 1
+        max_depth = self.max_depth and self.max_depth + 1
+        max_breadth = self.max_breadth
+
+        # Each stack entry is [container, key] for objects, where key is
+        # the key waiting for a value, or [container, has_objects] for
+        # arrays
+        stack = []
+        objects = depth = 0
+        state = 'value'
+        root = None
+        for token, value in self.tokens():
+            if token == 'string' and state in ('key', 'key_or_end'):
+                stack[-1][1] = value
+                state = 'colon'
+                continue
+            if token == ':' and state == 'colon':
+                state = 'value'
+                continue
+            if token == ',' and state == 'comma_or_end':
+                state = 'key' if isinstance(stack[-1][0], dict) else 'value'
+                continue
+
+            if token == '{' and state in ('value', 'value_or_end'):
+                objects += 1
+                depth += 1
+                if max_depth and depth > max_depth:
+                    raise ValueError(
+                        'Depth limit ({}) exceeded'.format(self.max_depth))
+                if max_elements and objects > max_elements:
+                    raise ValueError('Filter elements limit ({}) exceeded'
+                                     .format(self.max_elements))
+                stack.append([{}, None])
+                state = 'key_or_end'
+                continue
+            if token == '[' and state in ('value', 'value_or_end'):
+                stack.append([[], False])
+                state = 'value_or_end'
+                continue
+
+            if token in ('string', 'scalar') and \
+                    state in ('value', 'value_or_end'):
+                pass
+            elif token == '}' and state in ('key_or_end', 'comma_or_end') \
+                    and isinstance(stack[-1][0], dict):
+                value = stack.pop()[0]
+                depth -= 1
+            elif token == ']' and state in ('value_or_end', 'comma_or_end') \
+                    and isinstance(stack[-1][0], list):
+                value = stack.pop()[0]
+            else:
+                raise ValueError('Invalid json')
+
+            # value is complete; add it to its container
+            if not stack:
+                root = value
+                state = 'done'
+                continue
+            entry = stack[-1]
+            container = entry[0]
+            state = 'comma_or_end'
+            if isinstance(container, dict):
+                container[entry[1]] = value
+                continue
+            container.append(value)
+            if max_breadth and len(container) > max_breadth:
+                raise ValueError(
+                    'Breadth limit ({}) exceeded'.format(max_breadth))
+            if isinstance(value, dict):
+                entry[1] = True
+            elif not entry[1] and max_elements and \
+                    objects + len(container) > max_elements:
+                # A list of values (in_) counts each value as an element
+                raise ValueError('Filter elements limit ({}) exceeded'
+                                 .format(self.max_elements))
+        if state != 'done':
+            raise ValueError('Invalid json')
+        return root
+
+
+def _prepare(json, optimize, kwargs):
+    '''
+    Returns (json, constraints) to build.  When optimizing, the constraints
+    are checked against the original json during optimization.
+    '''
+    constraints = dict(DEFAULT_QUERY_CONSTRAINTS)
+    constraints.update(kwargs)
+    if optimize:
+        json = optimize_query(json, **constraints)
+        constraints = dict((key, None) for key in constraints)
+    return json, constraints
+
+
+def _admit(model, json, kwargs, cost_model=None):
+    '''
+    Checks the prepared json against the max_cost in kwargs; returns the
+    execution options to tag its query with (see CostModel.admit), or {}
+    when there's no max_cost or cost_model.
+    '''
+    max_cost = kwargs.get('max_cost')
+    if max_cost is None and cost_model is None:
+        return {}
+    return (cost_model or DEFAULT_COST_MODEL).admit(model, json, max_cost)
+
+
+def _build(node, model, constraints, bulk_in=None, session=None, joins=None):
+    '''
+    Returns a criterion for session.query(model).filter().  With a joins
+    dict, many-to-one relationship paths are built against aliases that
+    the caller must outer join (see _relate).  Joins are only used when
+    the query has no 'not', so that they match the same rows as EXISTS.
+    '''
+    if joins is not None and _negates(node):
+        joins = None
+    schema = SCHEMAS.get(model)
+    if schema is not None:
+        leaf = functools.partial(schema.build_column, joins=joins)
+    else:
+        leaf = functools.partial(_build_column, model=model, joins=joins)
+    if bulk_in is not None:
+        if session is not None:
+            session.info.pop(_IN_TABLES_USED, None)
+        leaf = functools.partial(bulk_in.build_column, leaf=leaf, model=model,
+                                 session=session)
+    return _criterion(_fold(node, constraints, leaf, _SQL_LOGICAL))
+
+
+def _negates(node):
+    '''
+    True if a query json or QueryTree has a 'not' anywhere.  Malformed
+    nodes are skipped; _fold rejects them.
+    '''
+    if isinstance(node, QueryTree):
+        return TREE_CODES['not'] in node.codes
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        operator = node.get('operator')
+        if operator == 'not':
+            return True
+        if operator in ('and', 'or') and isinstance(node.get('value'), list):
+            stack.extend(node['value'])
+    return False
+
+
+def _fold(node, constraints, leaf, logical):
+    '''
+    Validates the query constraints and builds the query in a single
+    traversal, using an explicit stack instead of recursion so that deep
+    queries don't hit the interpreter's recursion limit.
+
+    leaf:
+        Function that takes a column node and returns its built value
+    logical:
+        Dict of logical operator => function that takes a list of built
+        children and returns their combined value.  'not' is called with
+        a list of one child.
+
+    Nodes are visited in the same (depth-first, left to right) order as
+    they appear in the json, and the element count for a node includes
+    every node visited before it.  A QueryTree is checked against the
+    constraints from the counts it was parsed with, and folded flat.
+    '''
+    if isinstance(node, QueryTree):
+        node.check(constraints)
+        return node.fold(leaf, logical)
+    max_breadth = constraints['max_breadth']
+    max_depth = constraints['max_depth']
+    max_elements = constraints['max_elements']
+
+    count = 0
+    root = []
+    # Entries are (node, depth, siblings) to visit a node and append its
+    # built value to siblings, or (_COMBINE, func, children, siblings) once
+    # all of a logical operator's children are built.
+    stack = [(node, 1, root)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        entry = pop()
+        if entry[0] is _COMBINE:
+            _, func, children, siblings = entry
+            siblings.append(func(children))
+            continue
+        node, depth, siblings = entry
+        count += 1
+        value = node['value']
+
+        if max_depth and depth > max_depth:
+            raise ValueError('Depth limit ({}) exceeded'.format(max_depth))
+        element_breadth = 1
+        if isinstance(value, Sequence) and not is_string(value):
+            element_breadth = len(value)
+        if max_breadth and element_breadth > max_breadth:
+            raise ValueError(
+                'Breadth limit ({}) exceeded'.format(max_breadth))
+        if max_elements and count + element_breadth > max_elements:
+            raise ValueError(
+                'Filter elements limit ({}) exceeded'.format(max_elements))
+
+        op = node['operator']
+        if op in logical:
+            children = []
+            push((_COMBINE, logical[op], children, siblings))
+            depth += 1
+            if op == 'not':
+                push((value, depth, children))
+            else:
+                for child in reversed(value):
+                    push((child, depth, children))
+        else:
+            siblings.append(leaf(node))
+    return root[0]
+
+
+_COMBINE = object()
+
+
+class ColumnNode(object):
+    '''
+    A column node of a QueryTree.  Fields can be read as attributes or
+    like a dict (node['column']), so it can be passed to anything that
+    takes a column node.
+    '''
+    __slots__ = ('column', 'operator', 'value')
+    __getitem__ = object.__getattribute__
+
+    def __init__(self, column, operator, value):
+        self.column = column
+        self.operator = operator
+        self.value = value
+
+    def __repr__(self):
+        return 'ColumnNode({!r}, {!r}, {!r})'.format(
+            self.column, self.operator, self.value)
+
+    def to_json(self):
+        return {'column': self.column, 'operator': self.operator,
+                'value': self.value}
+
+
+# Interned codes for QueryTree.codes; 0 is a column node
+TREE_CODES = {'and': 1, 'or': 2, 'not': 3}
+_TREE_OPERATORS = [None, 'and', 'or', 'not']
+_TREE_VERSION = 1
+
+
+def parse_tree(json, **kwargs):
+    '''
+    Validates a query json and returns it as a QueryTree, which every
+    function that takes a query json also accepts.
+    Usage:
+        tree = parse_tree(json, query_constraints)
+        query = jsonquery(session, User, tree)
+        cache.set(key, tree.dumps())
+
+    Parse a query once when it's built or run many times: a tree takes a
+    fraction of the memory of the json, is checked against the query
+    constraints without walking it again, and is folded by a flat loop.
+
+    json, query_constraints:
+        See jsonquery
+    '''
+    constraints = dict(DEFAULT_QUERY_CONSTRAINTS)
+    constraints.update(kwargs)
+    if isinstance(json, QueryTree):
+        json.check(constraints)
+        return json
+    codes = array.array('B')
+    arities = array.array('I')
+    leaves = []
+    intern = getattr(sys, 'intern', lambda string: string)
+
+    def leaf(node):
+        column = node['column']
+        op = node['operator']
+        leaves.append(ColumnNode(intern(column) if is_string(column)
+                                 else column, intern(op), node['value']))
+        codes.append(0)
+        arities.append(0)
+
+    def logical(op, children):
+        codes.append(TREE_CODES[op])
+        arities.append(len(children))
+
+    depth, breadth, elements = _tree_counts(json)
+    tree = QueryTree(codes, arities, leaves, depth, breadth, elements)
+    tree.check(constraints)
+    unchecked = dict((key, None) for key in constraints)
+    _fold(json, unchecked, leaf, dict(
+        (op, functools.partial(logical, op)) for op in TREE_CODES))
+    return tree
+
+
+def _tree_counts(json):
+    '''
+    Returns the (depth, breadth, elements) that _fold checks the query
+    constraints against: the deepest node, the longest list, and the
+    largest element count at any node
+    '''
+    depth = breadth = elements = count = 0
+    stack = [(json, 1)]
+    while stack:
+        node, level = stack.pop()
+        count += 1
+        value = node['value']
+        element_breadth = 1
+        if isinstance(value, Sequence) and not is_string(value):
+            element_breadth = len(value)
+        depth = max(depth, level)
+        breadth = max(breadth, element_breadth)
+        elements = max(elements, count + element_breadth)
+        op = node['operator']
+        if op == 'not':
+            stack.append((value, level + 1))
+        elif op in ('and', 'or'):
+            stack.extend((child, level + 1) for child in reversed(value))
+    return depth, breadth, elements
+
+
+class QueryTree(object):
+    '''
+    A parsed query, stored flat in post-order; see parse_tree
+
+    codes:
+        array of one byte per node: 0 for a column node, or the
+        TREE_CODES of a logical operator
+    arities:
+        array of the number of children of each node
+    leaves:
+        list of the ColumnNodes, in order
+    '''
+    __slots__ = ('codes', 'arities', 'leaves', 'depth', 'breadth',
+                 'elements')
+
+    def __init__(self, codes, arities, leaves, depth, breadth, elements):
+        self.codes = codes
+        self.arities = arities
+        self.leaves = leaves
+        self.depth = depth
+        self.breadth = breadth
+        self.elements = elements
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __repr__(self):
+        return '<QueryTree nodes={} depth={}>'.format(
+            len(self.codes), self.depth)
+
+    def __eq__(self, other):
+        return (isinstance(other, QueryTree) and
+                self.codes == other.codes and
+                self.arities == other.arities and
+                [leaf.to_json() for leaf in self.leaves] ==
+                [leaf.to_json() for leaf in other.leaves])
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.codes.tobytes(), self.arities.tobytes(), tuple(
+            (leaf.column, leaf.operator, _freeze(leaf.value))
+            for leaf in self.leaves)))
+
+    def check(self, constraints):
+        '''Raises ValueError if the tree exceeds the query constraints'''
+        max_depth = constraints['max_depth']
+        if max_depth and self.depth > max_depth:
+            raise ValueError('Depth limit ({}) exceeded'.format(max_depth))
+        max_breadth = constraints['max_breadth']
+        if max_breadth and self.breadth > max_breadth:
+            raise ValueError(
+                'Breadth limit ({}) exceeded'.format(max_breadth))
+        max_elements = constraints['max_elements']
+        if max_elements and self.elements > max_elements:
+            raise ValueError(
+                'Filter elements limit ({}) exceeded'.format(max_elements))
+
+    def fold(self, leaf, logical):
+        '''
+        Builds the tree bottom-up without checking constraints.  leaf and
+        logical are the same as for _fold.
+        '''
+        funcs = [None] + [logical[op] for op in _TREE_OPERATORS[1:]]
+        leaves = iter(self.leaves)
+        stack = []
+        push = stack.append
+        for code, arity in zip(self.codes, self.arities):
+            if not code:
+                push(leaf(next(leaves)))
+            elif arity:
+                children = stack[-arity:]
+                del stack[-arity:]
+                push(funcs[code](children))
+            else:
+                push(funcs[code]([]))
+        return stack[0]
+
+    def to_json(self):
+        '''Returns the tree as a query json'''
+        def logical(op, children):
+            return {'operator': op,
+                    'value': children[0] if op == 'not' else children}
+        return self.fold(ColumnNode.to_json, dict(
+            (op, functools.partial(logical, op)) for op in TREE_CODES))
+
+    def dumps(self):
+        '''
+        Returns the tree as bytes, for caching parsed queries.  Only load
+        bytes from a trusted source: see loads().
+        '''
+        return marshal.dumps((
+            _TREE_VERSION, self.codes.tobytes(), self.arities.tobytes(),
+            [(leaf.column, leaf.operator, leaf.value)
+             for leaf in self.leaves],
+            (self.depth, self.breadth, self.elements)))
+
+    @classmethod
+    def loads(cls, data):
+        '''
+        Returns the tree from dumps().  data is unpickled with marshal,
+        which isn't safe against malicious input.
+        '''
+        version, codes, arities, leaves, counts = marshal.loads(data)
+        if version != _TREE_VERSION:
+            raise ValueError('Unknown tree version ({})'.format(version))
+        codes_array = array.array('B')
+        codes_array.frombytes(codes)
+        arities_array = array.array('I')
+        arities_array.frombytes(arities)
+        return cls(codes_array, arities_array,
+                   [ColumnNode(*leaf) for leaf in leaves], *counts)
+
+
+def _as_json(json):
+    '''Returns a query json for a query json or QueryTree'''
+    if isinstance(json, QueryTree):
+        return json.to_json()
+    return json
+
+
+# Operators that are NULL when the column is NULL, so that an outer joined
+# column with no related row matches the same rows as relationship.has()
+_JOINABLE_OPERATORS = frozenset(list(binops) + attr_funcs)
+
+
+def _relate(model, steps, name, op, func, value, joins=None):
+    '''
+    Returns the criterion for a column node on a relationship path.
+
+    When joins is a dict, the leading many-to-one relationships of the path
+    are outer joined once per path prefix: joins[path] is set to
+    (alias, onclause) and the node is built against the alias.  The rest of
+    the path (or all of it, without joins) becomes nested _Exists, which
+    are merged with siblings on the same relationship by the logical
+    operators and built as relationship.any() / relationship.has().
+    func is the operator op bound to the column of the path's last class.
+
+    A missing related row makes a joined node NULL where has() is false,
+    so only nodes that can't match NULL (a built-in operator and a value
+    other than None) are joined.  _build only passes joins when the query
+    has no 'not', where NULL and false match the same rows.
+    '''
+    owner = model
+    start = 0
+    if (joins is not None and value is not None and
+            op in _JOINABLE_OPERATORS):
+        while start < len(steps) and not steps[start][2]:
+            path, key, _, cls = steps[start]
+            joined = joins.get(path)
+            if joined is None:
+                alias = sqlalchemy.orm.aliased(cls)
+                joined = joins[path] = (
+                    alias, getattr(owner, key).of_type(alias))
+            owner = joined[0]
+            start += 1
+    if start == len(steps):
+        column = getattr(owner, name.rsplit('.', 1)[1])
+        return _bind_operator(OPERATORS[op], column)(value)
+    criterion = func(value)
+    for index in reversed(range(start, len(steps))):
+        path, key, uselist, _ = steps[index]
+        parent = owner if index == start else steps[index - 1][3]
+        criterion = _Exists(path, getattr(parent, key), uselist, criterion)
+    return criterion
+
+
+class _Exists(object):
+    '''
+    A relationship.any(criterion) or relationship.has(criterion) that
+    hasn't been built yet, so that siblings on the same path can share it.
+    '''
+    __slots__ = ('path', 'relationship', 'uselist', 'criterion')
+
+    def __init__(self, path, relationship, uselist, criterion):
+        self.path = path
+        self.relationship = relationship
+        self.uselist = uselist
+        self.criterion = criterion
+
+    def build(self):
+        criterion = _criterion(self.criterion)
+        if self.uselist:
+            return self.relationship.any(criterion)
+        return self.relationship.has(criterion)
+
+
+def _criterion(value):
+    '''Builds a criterion that may still be an _Exists'''
+    if isinstance(value, _Exists):
+        return value.build()
+    return value
+
+
+def _merge(op, children):
+    '''
+    Combines children with 'and' or 'or', merging _Exists on the same
+    relationship path into one subquery.  EXISTS(a) OR EXISTS(b) is
+    EXISTS(a OR b) for any relationship, but EXISTS(a) AND EXISTS(b) is only
+    EXISTS(a AND b) when there is at most one related row (many-to-one).
+    Returns an _Exists when everything merges into one, so the parent can
+    keep merging.
+    '''
+    merged = []
+    groups = {}
+    for child in children:
+        if isinstance(child, _Exists) and (op == 'or' or not child.uselist):
+            group = groups.get(child.path)
+            if group is None:
+                group = groups[child.path] = []
+                merged.append(group)
+            group.append(child)
+        else:
+            merged.append(child)
+    for index, child in enumerate(merged):
+        if isinstance(child, list):
+            first = child[0]
+            if len(child) > 1:
+                first = _Exists(first.path, first.relationship, first.uselist,
+                                _merge(op, [each.criterion for each in child]))
+            merged[index] = first
+    if len(merged) == 1:
+        return merged[0]
+    combine = _sql_and if op == 'and' else _sql_or
+    return combine([_criterion(child) for child in merged])
+
+
+def _sql_and(children):
+    if not children:
+        return sqlalchemy.true()
+    return sqlalchemy.and_(*children)
+
+
+def _sql_or(children):
+    if not children:
+        return sqlalchemy.false()
+    return sqlalchemy.or_(*children)
+
+
+def _sql_not(children):
+    return sqlalchemy.not_(_criterion(children[0]))
+
+
+_SQL_LOGICAL = {
+    'and': functools.partial(_merge, 'and'),
+    'or': functools.partial(_merge, 'or'),
+    'not': _sql_not,
+}
+
+
+def _build_column(node, model, joins=None):
+    # string => sqlalchemy.orm.attributes.InstrumentedAttribute
+    column = node['column']
+    op = node['operator']
+    value = node['value']
+
+    if '.' in column:
+        steps, prop = _resolve_path(model, column)
+        func = _bind_operator(OPERATORS[op], getattr(steps[-1][3], prop.key))
+        return _relate(model, steps, column, op, func, value, joins)
+    column = getattr(model, column)
+
+    return OPERATORS[op](column, value)
+
+
+def optimize_query(json, **kwargs):
+    '''
+    Returns an equivalent, simplified copy of the given json.
+    Usage:
+        json = optimize_query(json, query_constraints)
+
+    The json is validated against the query constraints while it's
+    optimized.  The returned json may be wider than the original (nested
+    and/or are flattened into their parent), so it shouldn't be validated
+    against the same constraints again.
+
+    Simplifications:
+        - nested 'and' in 'and' (and 'or' in 'or') are flattened
+        - 'not' of 'not' is removed
+        - duplicate subqueries in an 'and' or 'or' are removed
+        - '==' and 'in_' on the same column in an 'or' merge into one 'in_'
+        - numeric bounds on the same column in an 'and' merge into the
+          tightest bounds, or a single '==' when they meet
+        - an 'and' that can never be true (age > 5 and age < 3), or an 'or'
+          whose subqueries can never be true, becomes false when nothing
+          negates it
+
+    True and false are {operator: 'and', value: []} and
+    {operator: 'or', value: []}.  Every backend builds them as constants.
+    Results follow SQL NULL semantics, so rows match the optimized json
+    exactly when they match the original.
+    '''
+    constraints = dict(DEFAULT_QUERY_CONSTRAINTS)
+    constraints.update(kwargs)
+    json = _as_json(json)
+    optimizer = _Optimizer()
+    node = _fold(json, constraints, optimizer.leaf, {
+        'and': optimizer.and_,
+        'or': optimizer.or_,
+        'not': optimizer.not_,
+    })
+    return optimizer.prune(node)
+
+
+def _true():
+    return {'operator': 'and', 'value': []}
+
+
+def _false():
+    return {'operator': 'or', 'value': []}
+
+
+def _is_constant(node, op):
+    return node['operator'] == op and not node['value']
+
+
+def _freeze(value):
+    '''Returns a hashable version of a json value'''
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def _query_key(json, constraints):
+    '''
+    Returns a hashable version of a query json: a flat tuple of its nodes
+    in post-order, so deep queries are hashed and compared without
+    recursion.  The json is checked against constraints on the way.
+    '''
+    key = []
+
+    def leaf(node):
+        key.append((node['column'], node['operator'],
+                    _freeze(node['value'])))
+
+    def logical(op, children):
+        key.append((op, len(children)))
+    _fold(json, constraints, leaf, dict(
+        (op, functools.partial(logical, op)) for op in TREE_CODES))
+    return tuple(key)
+
+
+def _number(value):
+    '''True for values whose order matches in python and SQL'''
+    return (isinstance(value, (int, float)) and
+            not isinstance(value, bool))
+
+
+class _Optimizer(object):
+    '''
+    Builds optimized nodes bottom-up through _fold.  For every node it
+    builds, the optimizer records a hashable, order-insensitive key used to
+    find duplicates, and whether the node is "never true": false or unknown
+    for every row.
+
+    A never-true node can only be replaced with false where false and
+    unknown (NULL) are treated the same: outside of any 'not'.  The fold
+    can't see that context, so never-true nodes are kept as they are and
+    only pruned by prune() from the root down.
+    '''
+    def __init__(self):
+        # id(node) => (node, key, never_true).  Holding the node keeps its
+        # id from being reused by another node.
+        self.info = {}
+
+    def leaf(self, node):
+        key = ('column', node['column'], node['operator'],
+               _freeze(node['value']))
+        return self._add(node, key, False)
+
+    def and_(self, children):
+        children = self._flatten('and', children)
+        if any(_is_constant(child, 'or') for child in children):
+            return self._constant(_false())
+        children = self._dedupe([child for child in children
+                                 if not _is_constant(child, 'and')])
+        children, contradiction = self._merge_bounds(children)
+        never_true = contradiction or any(
+            self.info[id(child)][2] for child in children)
+        return self._combine('and', children, never_true)
+
+    def or_(self, children):
+        children = self._flatten('or', children)
+        if any(_is_constant(child, 'and') for child in children):
+            return self._constant(_true())
+        children = self._dedupe([child for child in children
+                                 if not _is_constant(child, 'or')])
+        children = self._merge_in(children)
+        never_true = all(self.info[id(child)][2] for child in children)
+        return self._combine('or', children, never_true)
+
+    def not_(self, children):
+        child = children[0]
+        if child['operator'] == 'not':
+            return child['value']
+        if _is_constant(child, 'and'):
+            return self._constant(_false())
+        if _is_constant(child, 'or'):
+            return self._constant(_true())
+        node = {'operator': 'not', 'value': child}
+        return self._add(node, ('not', self.info[id(child)][1]), False)
+
+    def prune(self, root):
+        '''
+        Drops never-true subqueries from the 'or's that aren't under a 'not',
+        and replaces the root with false if it's never true.
+        '''
+        if self.info[id(root)][2]:
+            return _false()
+        stack = [root] if root['operator'] in ('and', 'or') else []
+        while stack:
+            node = stack.pop()
+            if node['operator'] == 'or':
+                node['value'] = [child for child in node['value']
+                                 if not self.info[id(child)][2]]
+            for child in node['value']:
+                if child['operator'] in ('and', 'or'):
+                    stack.append(child)
+        return root
+
+    def _add(self, node, key, never_true):
+        self.info[id(node)] = (node, key, never_true)
+        return node
+
+    def _constant(self, node):
+        key = (node['operator'], frozenset())
+        return self._add(node, key, node['operator'] == 'or')
+
+    def _combine(self, op, children, never_true):
+        if not children:
+            return self._constant(_true() if op == 'and' else _false())
+        if len(children) == 1:
+            return children[0]
+        key = (op, frozenset(self.info[id(child)][1] for child in children))
+        return self._add({'operator': op, 'value': children}, key, never_true)
+
+    @staticmethod
+    def _flatten(op, children):
+        flat = []
+        for child in children:
+            if child['operator'] == op:
+                flat.extend(child['value'])
+            else:
+                flat.append(child)
+        return flat
+
+    def _dedupe(self, children):
+        seen = set()
+        unique = []
+        for child in children:
+            key = self.info[id(child)][1]
+            if key not in seen:
+                seen.add(key)
+                unique.append(child)
+        return unique
+
+    def _merge_in(self, children):
+        '''Merges == and in_ leaves on the same column into one in_'''
+        groups = collections.OrderedDict()
+        for child in children:
+            op = child['operator']
+            value = child['value']
+            if op == 'in_' and isinstance(value, (list, tuple)):
+                groups.setdefault(child['column'], []).append(child)
+            elif op == '==' and value is not None and not isinstance(
+                    value, (list, tuple, dict)):
+                groups.setdefault(child['column'], []).append(child)
+
+        merged = {}
+        for column, leaves in groups.items():
+            if len(leaves) < 2:
+                continue
+            values = []
+            seen = set()
+            for leaf in leaves:
+                value = leaf['value']
+                for item in (value if leaf['operator'] == 'in_' else [value]):
+                    key = _freeze(item)
+                    if key not in seen:
+                        seen.add(key)
+                        values.append(item)
+            merged[id(leaves[0])] = self.leaf(
+                {'column': column, 'operator': 'in_', 'value': values})
+            for leaf in leaves[1:]:
+                merged[id(leaf)] = None
+
+        if not merged:
+            return children
+        result = []
+        for child in children:
+            child = merged.get(id(child), child)
+            if child is not None:
+                result.append(child)
+        return result
+
+    def _merge_bounds(self, children):
+        '''
+        Merges numeric comparisons on the same column into the tightest
+        bounds.  Returns (children, contradiction) where contradiction is
+        True when the bounds on some column can't all hold.  A column whose
+        bounds contradict each other is left unmerged.
+
+        Relationship paths are skipped: each node on a one-to-many path is
+        its own EXISTS, so different related rows can match each bound.
+        Without a model, many-to-one paths can't be told apart and are
+        skipped too.  Merging == and in_ under an 'or' (_merge_in) and
+        dropping duplicates hold for paths as well.
+        '''
+        groups = collections.OrderedDict()
+        for child in children:
+            if (child['operator'] in ('<', '<=', '==', '>=', '>') and
+                    _number(child['value']) and '.' not in child['column']):
+                groups.setdefault(child['column'], []).append(child)
+
+        merged = {}
+        contradiction = False
+        for column, leaves in groups.items():
+            if len(leaves) < 2:
+                continue
+            bounds = _tightest_bounds(leaves)
+            if bounds is None:
+                contradiction = True
+                continue
+            bounds = [self.leaf({'column': column, 'operator': op,
+                                 'value': value}) for op, value in bounds]
+            merged[id(leaves[0])] = bounds
+            for leaf in leaves[1:]:
+                merged[id(leaf)] = []
+
+        if not merged:
+            return children, contradiction
+        result = []
+        for child in children:
+            result.extend(merged.get(id(child), [child]))
+        return result, contradiction
+
+
+def _tightest_bounds(leaves):
+    '''
+    Returns a list of (operator, value) that's equivalent to all of the
+    leaves holding, or None if they can't all hold
+    '''
+    lower = upper = equal = None
+    for leaf in leaves:
+        op = leaf['operator']
+        value = leaf['value']
+        if op == '==':
+            if equal is not None and equal != value:
+                return None
+            equal = value
+        elif op in ('>', '>='):
+            if (lower is None or value > lower[1] or
+                    (value == lower[1] and op == '>')):
+                lower = (op, value)
+        elif (upper is None or value < upper[1] or
+                (value == upper[1] and op == '<')):
+            upper = (op, value)
+
+    if equal is not None:
+        if lower and not _compare(equal, *lower):
+            return None
+        if upper and not _compare(equal, *upper):
+            return None
+        return [('==', equal)]
+    if lower and upper:
+        if lower[1] > upper[1]:
+            return None
+        if lower[1] == upper[1]:
+            if lower[0] == '>=' and upper[0] == '<=':
+                return [('==', lower[1])]
+            return None
+    return [bound for bound in (lower, upper) if bound]
+
+
+def _compare(value, op, bound):
+    return binops[op](value, bound)
+
+
+class NonSargableWarning(UserWarning):
+    '''A column node that can't use an index, from plan_query'''
+
+
+_INVERSE = {
+    '<': '>=',
+    '<=': '>',
+    '>': '<=',
+    '>=': '<',
+    '==': '!=',
+    '!=': '==',
+}
+_EQUALITY = frozenset(['==', 'in_'])
+_RANGE = frozenset(['<', '<=', '>', '>='])
+
+# Lower ranks are placed first
+RANK_UNIQUE = 0
+RANK_INDEX_EQUALITY = 1
+RANK_INDEX_RANGE = 2
+RANK_EQUALITY = 3
+RANK_SCAN = 4
+RANK_NON_SARGABLE = 5
+
+
+def plan_query(model, json, warn=True, **kwargs):
+    '''
+    Returns a copy of the json with the children of each and/or ordered so
+    that the most selective, indexed column nodes come first.  The planned
+    json matches exactly the same rows.
+    Usage:
+        json = plan_query(User, json)
+        query = jsonquery(session, User, json)
+        # or
+        query = jsonquery(session, User, json, plan=True)
+
+    Column nodes are ranked from the model's primary key, unique
+    constraints and Table.indexes (only the first column of an index
+    counts):
+        RANK_UNIQUE             == or in_ on a primary key or unique column
+        RANK_INDEX_EQUALITY     == or in_ on an indexed column
+        RANK_INDEX_RANGE        <, <=, >, >= or a prefix like on an
+                                indexed column
+        RANK_EQUALITY           == or in_ on any other column
+        RANK_SCAN               any other column node, including
+                                relationship paths
+        RANK_NON_SARGABLE       like with a leading wildcard ('%pat'),
+                                and 'not' of anything but a comparison
+    An 'and' ranks as its best child and an 'or' as its worst.  Children
+    with the same rank keep their order.
+
+    'not' of a comparison is rewritten to the inverse comparison
+    (not a < 1 => a >= 1), which is the same under SQL's NULL semantics
+    and can use an index.  Column nodes that can't use an index are
+    reported with a NonSargableWarning unless warn is False.
+
+    query_constraints:
+        See jsonquery
+    '''
+    json = _as_json(json)
+    constraints = dict(DEFAULT_QUERY_CONSTRAINTS)
+    constraints.update(kwargs)
+    planner = _Planner(model, warn)
+    return _fold(json, constraints, planner.column, planner.logical)[1]
+
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+
+def explain_query(session, model, json, **kwargs):
+    '''
+    Plans the json with plan_query and asks the database how it would run
+    the query.  Returns a dict with:
+        json        the planned json
+        sql         the SQL, with literal values
+        plan        list of rows from EXPLAIN (EXPLAIN QUERY PLAN on SQLite)
+        warnings    list of NonSargableWarning messages
+    Usage:
+        report = explain_query(session, User, json)
+        for row in report['plan']:
+            print(row)
+
+    json may be a page.
+
+    session, model, json, query_constraints:
+        See jsonquery
+    '''
+    page = None
+    if _is_page(json):
+        page, json = json, json.get('filter')
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', NonSargableWarning)
+        if json is not None:
+            json = plan_query(model, json, **kwargs)
+            kwargs = dict(kwargs, max_breadth=None, max_depth=None,
+                          max_elements=None)
+    statement = jsonselect(
+        model, json if page is None else dict(page, filter=json), **kwargs)
+    dialect = session.get_bind().dialect
+    sql = str(statement.compile(
+        dialect=dialect, compile_kwargs={'literal_binds': True}))
+    prefix = EXPLAIN_PREFIXES.get(dialect.name, 'EXPLAIN ')
+    rows = session.connection().exec_driver_sql(prefix + sql).all()
+    return {
+        'json': json,
+        'sql': sql,
+        'plan': [tuple(row) for row in rows],
+        'warnings': [str(warning.message) for warning in caught
+                     if issubclass(warning.category, NonSargableWarning)],
+    }
+
+
+def _index_ranks(model):
+    '''Returns a dict of column name => rank of an equality node on it'''
+    mapper = sqlalchemy.inspect(model)
+    table = mapper.local_table
+    ranks = {}
+
+    def add(columns, rank):
+        columns = list(columns)
+        if not columns or columns[0] not in mapper.columns.values():
+            return
+        key = mapper.get_property_by_column(columns[0]).key
+        if len(columns) > 1 and rank == RANK_UNIQUE:
+            rank = RANK_INDEX_EQUALITY
+        ranks[key] = min(rank, ranks.get(key, rank))
+
+    add(table.primary_key.columns, RANK_UNIQUE)
+    for constraint in table.constraints:
+        if isinstance(constraint, sqlalchemy.UniqueConstraint):
+            add(constraint.columns, RANK_UNIQUE)
+    for index in table.indexes:
+        add(index.columns,
+            RANK_UNIQUE if index.unique else RANK_INDEX_EQUALITY)
+    return ranks
+
+
+class _Planner(object):
+    def __init__(self, model, warn):
+        self.ranks = _index_ranks(model)
+        self.warn = warn
+        self.logical = {
+            'and': functools.partial(self.combine, 'and', min),
+            'or': functools.partial(self.combine, 'or', max),
+            'not': self.not_,
+        }
+
+    def column(self, node):
+        '''Returns (rank, node) for a column node'''
+        column = node['column']
+        op = node['operator']
+        value = node['value']
+        if '.' in column:
+            # Relationship paths are EXISTS subqueries, even for ==
+            return RANK_SCAN, node
+        indexed = column in self.ranks
+        if op in ('like', 'ilike') and is_string(value) and \
+                value[:1] in ('%', '_'):
+            if self.warn:
+                warnings.warn(
+                    '{} {!r} on column ({}) has a leading wildcard and '
+                    "can't use an index".format(op, value, column),
+                    NonSargableWarning, stacklevel=4)
+            return RANK_NON_SARGABLE, node
+        if not indexed:
+            return (RANK_EQUALITY if op in _EQUALITY else RANK_SCAN), node
+        if op in _EQUALITY:
+            return self.ranks[column], node
+        if op in _RANGE or op == 'like':
+            return RANK_INDEX_RANGE, node
+        return RANK_SCAN, node
+
+    def combine(self, op, choose, children):
+        children = sorted(children, key=operator.itemgetter(0))
+        nodes = [node for _, node in children]
+        if not children:
+            rank = RANK_UNIQUE if op == 'or' else RANK_SCAN
+        else:
+            rank = choose(rank for rank, _ in children)
+        return rank, {'operator': op, 'value': nodes}
+
+    def not_(self, children):
+        rank, node = children[0]
+        inverse = _INVERSE.get(node['operator'])
+        # NOT EXISTS(a < 1) isn't EXISTS(a >= 1), so paths aren't inverted
+        if inverse is not None and '.' not in node['column']:
+            return self.column(dict(node, operator=inverse))
+        return RANK_NON_SARGABLE, {'operator': 'not', 'value': node}
+
+
+class CostModel(object):
+    '''
+    Estimates what a query will cost the database, so that expensive
+    queries can be rejected before they run (the max_cost constraint) and
+    tagged with a statement timeout.
+    Usage:
+        cost_model = CostModel(weights={'ilike': 8}, seconds_per_cost=0.01)
+        query = jsonquery(session, User, json, max_cost=100,
+                          cost_model=cost_model)
+
+    A column node costs:
+        weights[operator] * column_weights[column]
+            (+ in_value_weight for each value of an in_)
+        * scan_weight unless an index can be used: the column is the first
+          column of the primary key, a unique constraint or an index, and
+          the operator isn't != or a like with a leading wildcard
+        * path_weight for relationship paths ("relationship.column")
+    and/or cost the sum of their children, and not costs not_weight times
+    its child.  Subclass and override column() or combine() to score
+    queries differently.
+
+    weights (Optional):
+        Dict of operator => weight, over DEFAULT_WEIGHTS.
+    column_weights (Optional):
+        Dict of column name => weight, for wide text or json columns.
+    seconds_per_cost (Optional):
+        When set, queries are tagged with a statement timeout of
+        cost * seconds_per_cost, up to max_timeout seconds.  See
+        statement_timeouts for applying the tag on PostgreSQL.
+
+    The cost and timeout of a query are in its execution_options, as
+    'jsonquery_cost' and 'jsonquery_timeout'.
+    '''
+    DEFAULT_WEIGHTS = {'like': 2, 'ilike': 4}
+
+    def __init__(self, weights=None, column_weights=None, scan_weight=10,
+                 in_value_weight=0.01, path_weight=5, not_weight=2,
+                 seconds_per_cost=None, max_timeout=None):
+        self.weights = dict(self.DEFAULT_WEIGHTS)
+        self.weights.update(weights or {})
+        self.column_weights = dict(column_weights or {})
+        self.scan_weight = scan_weight
+        self.in_value_weight = in_value_weight
+        self.path_weight = path_weight
+        self.not_weight = not_weight
+        self.seconds_per_cost = seconds_per_cost
+        self.max_timeout = max_timeout
+        self._indexes = {}
+
+    def cost(self, model, json):
+        '''Returns the estimated cost of the query json against model'''
+        indexes = self._indexes.get(model)
+        if indexes is None:
+            indexes = self._indexes[model] = _index_ranks(model)
+        constraints = dict((key, None) for key in DEFAULT_QUERY_CONSTRAINTS)
+        logical = dict((op, functools.partial(self.combine, op))
+                       for op in ('and', 'or', 'not'))
+        return _fold(json, constraints,
+                     functools.partial(self.column, indexes=indexes), logical)
+
+    def column(self, node, indexes):
+        '''
+        Returns the cost of a column node.  indexes is a dict with the
+        names of the model's indexed columns as keys.
+        '''
+        column = node['column']
+        op = node['operator']
+        value = node['value']
+        cost = self.weights.get(op, 1) * self.column_weights.get(column, 1)
+        if op == 'in_' and isinstance(value, (list, tuple)):
+            cost += self.in_value_weight * len(value)
+        indexed = column in indexes and op != '!=' and not (
+            op in ('like', 'ilike') and is_string(value) and
+            value[:1] in ('%', '_'))
+        if not indexed:
+            cost *= self.scan_weight
+        if '.' in column:
+            cost *= self.path_weight
+        return cost
+
+    def combine(self, op, costs):
+        '''Returns the cost of a logical operator from its children's'''
+        if op == 'not':
+            return costs[0] * self.not_weight
+        return sum(costs)
+
+    def timeout(self, cost):
+        '''Returns the statement timeout (seconds) for a cost, or None'''
+        if self.seconds_per_cost is None:
+            return None
+        timeout = cost * self.seconds_per_cost
+        if self.max_timeout is not None:
+            timeout = min(timeout, self.max_timeout)
+        return timeout
+
+    def admit(self, model, json, max_cost=None):
+        '''
+        Raises ValueError if the query costs more than max_cost, otherwise
+        returns the execution options to tag the query with
+        '''
+        cost = self.cost(model, json)
+        if max_cost is not None and cost > max_cost:
+            raise ValueError('Query cost ({:g}) exceeds limit ({:g})'.format(
+                cost, max_cost))
+        options = {'jsonquery_cost': cost}
+        timeout = self.timeout(cost)
+        if timeout is not None:
+            options['jsonquery_timeout'] = timeout
+        return options
+
+
+DEFAULT_COST_MODEL = CostModel()
+
+
+def statement_timeouts(engine):
+    '''
+    Applies the statement timeout a CostModel tags queries with, by running
+    SET LOCAL statement_timeout before each tagged query on a PostgreSQL
+    engine.  The timeout lasts until the end of the transaction.
+    Usage:
+        statement_timeouts(engine)
+    '''
+    if engine.dialect.name != 'postgresql':
+        raise ValueError('Statement timeouts need a PostgreSQL engine')
+    sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                            _set_statement_timeout)
+
+
+def _set_statement_timeout(conn, cursor, statement, parameters, context,
+                           executemany):
+    timeout = context and context.execution_options.get('jsonquery_timeout')
+    if timeout is not None:
+        cursor.execute('SET LOCAL statement_timeout = {:d}'.format(
+            int(timeout * 1000)))
+
+
+def register_model(model):
+    '''
+    Introspects a model once so that queries against it don't have to.
+    Returns the model's ModelSchema.
+    Usage:
+        register_model(User)
+        query = jsonquery(session, User, json)
+
+    Queries against a registered model resolve columns and operators with
+    a couple of dict lookups per column node, and reject unknown columns,
+    and operators that don't apply to a column's type (see the types
+    argument to register_operator), with a ValueError before the column
+    node is built.
+
+    Columns of related models can be queried with a path of relationships
+    ("relationship.column", "relationship.relationship.column", ...) up to
+    MAX_PATH_LENGTH relationships long; see jsonquery.
+    '''
+    schema = SCHEMAS[model] = ModelSchema(model)
+    return schema
+
+
+def unregister_model(model):
+    '''Removes a model's ModelSchema'''
+    del SCHEMAS[model]
+
+
+MAX_PATH_LENGTH = 3
+
+
+class ModelSchema(object):
+    '''
+    Column and operator tables for a model; see register_model
+
+    columns:
+        Dict of column name => column object, including relationship
+        paths ("relationship.column").  Paths through more than one
+        relationship are added the first time they're queried.
+    operators:
+        Dict of column name => frozenset of operators valid for the column
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.columns = {}
+        self.operators = {}
+        self._types = {}
+        self._paths = {}
+        self._dispatch = {}
+
+        mapper = sqlalchemy.inspect(model)
+        for prop in mapper.column_attrs:
+            self._add(prop.key, getattr(model, prop.key), prop.columns[0])
+        for relationship in mapper.relationships:
+            for prop in relationship.mapper.column_attrs:
+                self._add_path('{}.{}'.format(relationship.key, prop.key))
+        self.refresh()
+
+    def _add(self, name, column, table_column):
+        self.columns[name] = column
+        self._types[name] = table_column.type
+
+    def _add_path(self, name):
+        steps, prop = _resolve_path(self.model, name)
+        self._add(name, getattr(steps[-1][3], prop.key), prop.columns[0])
+        self._paths[name] = steps
+
+    def refresh(self):
+        '''Rebuilds the operator tables from the registered operators'''
+        self.operators = {}
+        self._dispatch = {}
+        for name in list(self.columns):
+            self._refresh_column(name)
+
+    def _refresh_column(self, name):
+        column = self.columns[name]
+        dispatch = {}
+        for opstring, func in OPERATORS.items():
+            if _type_matches(self._types[name], OPERATOR_TYPES[opstring]):
+                dispatch[opstring] = _bind_operator(func, column)
+        self._dispatch[name] = dispatch
+        self.operators[name] = frozenset(dispatch)
+        return dispatch
+
+    def build_column(self, node, joins=None):
+        '''
+        Returns the criterion for a column node.  joins is passed to
+        _relate for relationship paths.
+        '''
+        column = node['column']
+        op = node['operator']
+        dispatch = self._dispatch.get(column)
+        if dispatch is None and '.' in column:
+            self._add_path(column)
+            dispatch = self._refresh_column(column)
+        try:
+            func = dispatch[op]
+        except (KeyError, TypeError):
+            if dispatch is None:
+                raise ValueError('Unknown column ({})'.format(column))
+            raise ValueError('Operator ({}) not supported for column ({})'
+                             .format(op, column))
+        steps = self._paths.get(column)
+        if steps is None:
+            return func(node['value'])
+        return _relate(self.model, steps, column, op, func, node['value'],
+                       joins)
+
+
+def _type_matches(column_type, types):
+    if types is None:
+        return True
+    types = tuple(_lookup(sqlalchemy, type_) for type_ in types)
+    if isinstance(column_type, sqlalchemy.types.TypeDecorator):
+        column_type = column_type.impl_instance
+    return isinstance(column_type, types)
+
+
+def _bind_operator(func, column):
+    '''Returns func with the column bound, as a function of the value'''
+    attr = getattr(func, 'attr', None)
+    if attr is not None:
+        return getattr(column, attr)
+    return functools.partial(func, column)
+
+
+def _resolve_path(model, name):
+    '''
+    Returns (steps, prop) for a relationship path "a.b.column", where steps
+    has a (path, key, uselist, class) tuple for each relationship and prop
+    is the column property of the last relationship's class
+    '''
+    keys = name.split('.')
+    if len(keys) - 1 > MAX_PATH_LENGTH:
+        raise ValueError('Path ({}) is longer than {} relationships'.format(
+            name, MAX_PATH_LENGTH))
+    mapper = sqlalchemy.inspect(model)
+    steps = []
+    for index, key in enumerate(keys[:-1]):
+        if key not in mapper.relationships:
+            raise ValueError('Unknown column ({})'.format(name))
+        relationship = mapper.relationships[key]
+        mapper = relationship.mapper
+        steps.append(('.'.join(keys[:index + 1]), key, relationship.uselist,
+                      mapper.class_))
+    if keys[-1] not in mapper.column_attrs:
+        raise ValueError('Unknown column ({})'.format(name))
+    return tuple(steps), mapper.column_attrs[keys[-1]]
+
+
+IN_STRATEGIES = {}
+
+
+class BulkIn(object):
+    '''
+    Chooses how large 'in_' lists are sent to the database.
+    Usage:
+        bulk_in = BulkIn(threshold=1000)
+        query = jsonquery(session, model, json, bulk_in=bulk_in)
+
+    Lists of up to threshold values are always a plain IN of literals.
+    Larger lists use the strategy, one of:
+
+        auto
+            array on PostgreSQL, temp_table for lists over
+            temp_table_threshold when there's a session, inline otherwise
+        inline
+            An expanding bind parameter whose values are rendered into the
+            SQL when it's executed: the statement is still cached, and
+            there's no driver limit on the number of parameters
+        expanding
+            An expanding bind parameter, with one parameter per value
+        array
+            column = ANY(:values) with a single array parameter
+            (PostgreSQL)
+        chunked
+            IN lists of chunk_size values joined with OR, for databases
+            that limit the size of one IN list
+        temp_table
+            The values are inserted into a temporary table on the
+            session's connection, and the column is matched with
+            IN (SELECT value FROM ...).  Each connection keeps one table
+            per column type (more when a query has several lists of the
+            same type), which is cleared and refilled each time a query
+            is built.  The values are loaded when the query is built, so
+            run it before building the next query on the same session.
+
+    Each value in an 'in_' list counts towards max_breadth and max_elements,
+    so large lists also need those constraints raised.
+
+    Strategies are functions (column, values, bulk_in, session) in
+    IN_STRATEGIES, and may be added to.  Queries built through a QueryCache
+    or on a relationship path ("relationship.column") don't use BulkIn.
+    '''
+    def __init__(self, threshold=1000, strategy='auto', chunk_size=1000,
+                 temp_table_threshold=None):
+        if strategy != 'auto' and strategy not in IN_STRATEGIES:
+            raise ValueError('Unknown strategy ({})'.format(strategy))
+        self.threshold = threshold
+        self.strategy = strategy
+        self.chunk_size = chunk_size
+        self.temp_table_threshold = temp_table_threshold
+
+    def choose(self, size, session=None):
+        '''Returns the name of the strategy for a list of size values'''
+        if size <= self.threshold:
+            return 'literal'
+        if self.strategy != 'auto':
+            return self.strategy
+        if session is not None:
+            if session.get_bind().dialect.name == 'postgresql':
+                return 'array'
+            if (self.temp_table_threshold is not None and
+                    size > self.temp_table_threshold):
+                return 'temp_table'
+        return 'inline'
+
+    def criterion(self, column, values, session=None):
+        '''Returns the criterion for column.in_(values)'''
+        strategy = IN_STRATEGIES[self.choose(len(values), session)]
+        return strategy(column, list(values), self, session)
+
+    def build_column(self, node, leaf, model, session=None):
+        '''Builds a column node, using criterion() for large in_ lists'''
+        value = node['value']
+        column = node['column']
+        if (node['operator'] != 'in_' or '.' in column or
+                not isinstance(value, (list, tuple)) or
+                len(value) <= self.threshold):
+            return leaf(node)
+        schema = SCHEMAS.get(model)
+        if schema is not None and 'in_' not in schema.operators.get(
+                column, ()):
+            # Let the schema raise its ValueError
+            return leaf(node)
+        return self.criterion(_column(model, column), value, session)
+
+
+def _in_literal(column, values, bulk_in, session):
+    return column.in_(values)
+
+
+def _in_expanding(column, values, bulk_in, session):
+    return column.in_(sqlalchemy.bindparam(None, values, expanding=True))
+
+
+def _in_inline(column, values, bulk_in, session):
+    return column.in_(sqlalchemy.bindparam(
+        None, values, expanding=True, literal_execute=True))
+
+
+def _in_array(column, values, bulk_in, session):
+    array = sqlalchemy.bindparam(
+        None, values, type_=sqlalchemy.ARRAY(column.type))
+    return column == sqlalchemy.any_(array)
+
+
+def _in_chunked(column, values, bulk_in, session):
+    size = bulk_in.chunk_size
+    return sqlalchemy.or_(*[column.in_(values[i:i + size])
+                            for i in range(0, len(values), size)])
+
+
+_TEMP_TABLES = itertools.count()
+# connection.info: column type => [Table], reused for every query on the
+# (pooled) DBAPI connection
+_IN_TABLES = 'jsonquery_in_tables'
+# session.info: names of the tables used by the query being built
+_IN_TABLES_USED = 'jsonquery_in_tables_used'
+
+
+def _in_temp_table(column, values, bulk_in, session):
+    if session is None:
+        raise ValueError('temp_table strategy requires a session')
+    connection = session.connection()
+    key = str(column.type.compile(dialect=connection.dialect))
+    tables = connection.info.setdefault(_IN_TABLES, {}).setdefault(key, [])
+    used = session.info.setdefault(_IN_TABLES_USED, set())
+    for table in tables:
+        if table.name not in used:
+            break
+    else:
+        table = sqlalchemy.Table(
+            'jsonquery_in_{}'.format(next(_TEMP_TABLES)),
+            sqlalchemy.MetaData(), sqlalchemy.Column('value', column.type),
+            prefixes=['TEMPORARY'], postgresql_on_commit='DELETE ROWS')
+        tables.append(table)
+    used.add(table.name)
+    # The table may have been rolled back with the transaction that
+    # created it
+    table.create(connection, checkfirst=True)
+    connection.execute(table.delete())
+    connection.execute(table.insert(), [{'value': value} for value in values])
+    return column.in_(sqlalchemy.select(table.c.value))
+
+
+IN_STRATEGIES.update({
+    'literal': _in_literal,
+    'expanding': _in_expanding,
+    'inline': _in_inline,
+    'array': _in_array,
+    'chunked': _in_chunked,
+    'temp_table': _in_temp_table,
+})
+
+
+def compile_query(model, json, optimize=False, cost_model=None, **kwargs):
+    '''
+    Returns a CompiledQuery built from the given json.
+    Usage:
+        plan = compile_query(model, json, query_constraints)
+        rows = plan.query(session).all()
+        rows = plan.query(session, jq_0=21).all()
+
+    The json is validated and built once; columns are resolved and
+    operators looked up at compile time.  Literal values are replaced with
+    bind parameters named jq_0, jq_1, ... in the order they appear in the
+    json (depth-first, list elements in order), so the same plan can run
+    against any session with any set of values.  max_cost is checked
+    against the json's own values.
+
+    model, json, optimize, cost_model, query_constraints:
+        See jsonquery
+    '''
+    json, constraints = _prepare(json, optimize, kwargs)
+    json = _as_json(json)
+    options = _admit(model, json, kwargs, cost_model)
+    values = []
+    try:
+        _shape(json, values)
+        json = _template(json, iter(range(len(values))))
+    except _Uncacheable:
+        values = []
+    criterion = _build(json, model, constraints)
+    return CompiledQuery(model, criterion, _params(values), options)
+
+
+class CompiledQuery(object):
+    '''
+    A validated, built query that isn't bound to a session.
+
+    model:
+        SQLAlchemy model the query selects
+    criterion:
+        Criterion to be passed to session.query(model).filter()
+    params:
+        Default bind parameter values, taken from the json literals
+    options (Optional):
+        Execution options for each query, such as a CostModel's tags
+    '''
+    __slots__ = ('_model', '_criterion', '_params', '_options')
+
+    def __init__(self, model, criterion, params, options=None):
+        self._model = model
+        self._criterion = criterion
+        self._params = params
+        self._options = options or {}
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def criterion(self):
+        return self._criterion
+
+    @property
+    def params(self):
+        return dict(self._params)
+
+    def bind(self, **params):
+        '''Returns a copy of the plan with new default parameter values'''
+        return CompiledQuery(self._model, self._criterion,
+                             self._merge(params), self._options)
+
+    def query(self, session, **params):
+        '''
+        Returns a query object for the plan on the given session.
+        Keyword arguments override the plan's parameter values.
+        '''
+        query = session.query(self._model).filter(self._criterion)
+        if self._options:
+            query = query.execution_options(**self._options)
+        return query.params(self._merge(params))
+
+    def _merge(self, params):
+        unknown = set(params) - set(self._params)
+        if unknown:
+            raise ValueError('Unknown parameters: {}'.format(
+                ', '.join(sorted(unknown))))
+        merged = dict(self._params)
+        merged.update(params)
+        return merged
+
+
+PYTHON_OPERATORS = {}
+
+
+def register_python_operator(opstring, factory):
+    '''
+    Registers a function so that the operator can be used in queries
+    evaluated in memory (see compile_predicate).
+
+    opstring:
+        The string used to reference this function in json queries
+
+    factory:
+        Function that takes the value from the json and returns a test.
+        The test takes the column's value from an object and returns True,
+        False, or None when the result is unknown (SQL NULL).  The factory
+        is called once per query, so expensive setup (regex compilation,
+        building sets) should happen there rather than in the test.
+
+        Example: Adding the >= operator
+            def ge(value):
+                def test(column):
+                    if column is None:
+                        return None
+                    return column >= value
+                return test
+            register_python_operator('>=', ge)
+    '''
+    PYTHON_OPERATORS[opstring] = factory
+
+
+def python_binop(func):
+    '''Returns a factory for a comparison with SQL NULL semantics'''
+    def factory(value):
+        if value is None:
+            # Comparing against NULL is unknown for every row
+            return lambda column: None
+
+        def test(column):
+            if column is None:
+                return None
+            return func(column, value)
+        return test
+    return factory
+
+
+def _is_null(value):
+    if value is None:
+        return lambda column: column is None
+    return python_binop(operator.eq)(value)
+
+
+def _is_not_null(value):
+    if value is None:
+        return lambda column: column is not None
+    return python_binop(operator.ne)(value)
+
+
+def like_regex(pattern, flags=0):
+    '''
+    Compiles a SQL LIKE pattern into a regex.
+    "%" matches any sequence of characters and "_" matches one character.
+    '''
+    parts = []
+    for char in pattern:
+        if char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return re.compile(''.join(parts) + r'\Z', flags | re.DOTALL)
+
+
+def python_like(flags=0):
+    '''Returns a factory for like with the given regex flags'''
+    def factory(value):
+        match = like_regex(value, flags).match
+
+        def test(column):
+            if column is None:
+                return None
+            return match(column) is not None
+        return test
+    return factory
+
+
+def _python_in(value):
+    try:
+        values = frozenset(value)
+    except TypeError:
+        values = list(value)
+    has_null = None in values
+
+    def test(column):
+        if column is None:
+            return None
+        if column in values:
+            return True
+        # x IN (..., NULL) is unknown rather than false when x isn't found
+        return None if has_null else False
+    return test
+
+
+for opstring, func in binops.items():
+    register_python_operator(opstring, python_binop(func))
+register_python_operator('==', _is_null)
+register_python_operator('!=', _is_not_null)
+register_python_operator('like', python_like())
+register_python_operator('ilike', python_like(re.IGNORECASE))
+register_python_operator('in_', _python_in)
+
+
+def compile_predicate(json, getter=None, optimize=False, **kwargs):
+    '''
+    Returns a Predicate that evaluates the given json against python
+    objects, without a database.
+    Usage:
+        predicate = compile_predicate(json, query_constraints)
+        predicate.matches({'age': 21, 'name': 'Pat'})
+        adults = list(predicate.filter(rows))
+
+    The json is validated and compiled into closures once; evaluating a row
+    doesn't walk the json again.  Comparisons follow SQL semantics: None
+    is NULL, so comparisons against it are unknown and rows are only
+    matched when the whole query is true.
+
+    getter (Optional):
+        Function that takes an object and a column name and returns the
+        column's value.  Default reads keys from dicts and attributes from
+        everything else; missing columns are None.
+
+    json, optimize, query_constraints:
+        See jsonquery
+    '''
+    json, constraints = _prepare(json, optimize, kwargs)
+    getter = getter or _get
+    test = _fold(json, constraints,
+                 lambda leaf: _python_column(leaf, getter), _PYTHON_LOGICAL)
+    return Predicate(test)
+
+
+class Predicate(object):
+    '''A compiled in-memory query; see compile_predicate'''
+    __slots__ = ('_test',)
+
+    def __init__(self, test):
+        self._test = test
+
+    def __call__(self, obj):
+        return self.matches(obj)
+
+    def matches(self, obj):
+        '''True if the object matches the query'''
+        return self._test(obj) is True
+
+    def filter(self, iterable):
+        '''Yields the objects in iterable that match the query'''
+        test = self._test
+        for obj in iterable:
+            if test(obj) is True:
+                yield obj
+
+
+def _get(obj, column):
+    if isinstance(obj, dict):
+        return obj.get(column)
+    return getattr(obj, column, None)
+
+
+def _python_and(children):
+    children = tuple(children)
+
+    def test(obj):
+        result = True
+        for child in children:
+            child_result = child(obj)
+            if child_result is False:
+                return False
+            if child_result is None:
+                result = None
+        return result
+    return test
+
+
+def _python_or(children):
+    children = tuple(children)
+
+    def test(obj):
+        result = False
+        for child in children:
+            child_result = child(obj)
+            if child_result is True:
+                return True
+            if child_result is None:
+                result = None
+        return result
+    return test
+
+
+def _python_not(children):
+    child = children[0]
+
+    def test(obj):
+        result = child(obj)
+        return None if result is None else not result
+    return test
+
+
+_PYTHON_LOGICAL = {
+    'and': _python_and,
+    'or': _python_or,
+    'not': _python_not,
+}
+
+
+def _python_column(node, getter):
+    column = node['column']
+    test = PYTHON_OPERATORS[node['operator']](node['value'])
+    return lambda obj: test(getter(obj, column))
+
+
+Change = collections.namedtuple('Change', ['entered', 'left'])
+
+
+class SubscriptionManager(object):
+    '''
+    Tracks which standing queries (subscriptions) rows match as the rows
+    change, without re-running the queries.
+    Usage:
+        manager = SubscriptionManager()
+        manager.subscribe('adults', {'column': 'age', 'operator': '>=',
+                                     'value': 18})
+        change = manager.insert({'id': 1, 'age': 20})
+        change.entered  # set(['adults'])
+        change = manager.update({'id': 1, 'age': 10})
+        change.left     # set(['adults'])
+
+    Each subscription is compiled with compile_predicate and indexed by a
+    column node every matching row must satisfy: == and in_ values in a
+    dict, and numeric <, <=, >, >= bounds in sorted lists.  A change is
+    only tested against the subscriptions its values can match, plus any
+    whose queries can't be indexed (no such column node, as in a 'not' or
+    an 'or' with an unindexable branch).
+
+    Matches are tracked for the rows the manager has seen: subscribe
+    before streaming changes, or insert() the existing rows.
+
+    key (Optional):
+        Function that returns a row's identity.  Default is the row's 'id'.
+
+    getter (Optional):
+        See compile_predicate
+    '''
+    def __init__(self, key=None, getter=None):
+        self.getter = getter or _get
+        self.key = key or (lambda row: self.getter(row, 'id'))
+        self._subscriptions = {}
+        self._equal = {}
+        self._ranges = {}
+        self._unindexed = set()
+        self._matches = {}
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def __contains__(self, key):
+        return key in self._subscriptions
+
+    def subscribe(self, key, json, **kwargs):
+        '''
+        Adds (or replaces) the subscription key for the query json.
+        kwargs are passed to compile_predicate.
+        '''
+        if key in self._subscriptions:
+            self.unsubscribe(key)
+        predicate = compile_predicate(json, getter=self.getter, **kwargs)
+        constraints = dict((name, None) for name in DEFAULT_QUERY_CONSTRAINTS)
+        terms = _fold(json, constraints, _subscription_terms,
+                      _SUBSCRIPTION_LOGICAL)
+        if terms is not None:
+            # in_ [1, 1] and x == 1 or (x == 1 and ...) repeat terms
+            terms = list(collections.OrderedDict.fromkeys(terms))
+        if terms is None:
+            self._unindexed.add(key)
+        else:
+            for kind, column, value in terms:
+                if kind == '==':
+                    self._equal.setdefault(column, {}).setdefault(
+                        value, set()).add(key)
+                else:
+                    self._ranges.setdefault((kind, column), _RangeIndex()) \
+                        .add(value, key)
+        self._subscriptions[key] = (predicate, terms)
+
+    def unsubscribe(self, key):
+        '''Removes the subscription key'''
+        _, terms = self._subscriptions.pop(key)
+        if terms is None:
+            self._unindexed.discard(key)
+        for kind, column, value in terms or ():
+            if kind == '==':
+                keys = self._equal[column][value]
+                keys.discard(key)
+                if not keys:
+                    del self._equal[column][value]
+            else:
+                self._ranges[(kind, column)].remove(value, key)
+        for matches in self._matches.values():
+            matches.discard(key)
+
+    def matches(self, row):
+        '''Returns the set of subscriptions the row matches'''
+        subscriptions = self._subscriptions
+        return set(key for key in self._candidates(row)
+                   if subscriptions[key][0].matches(row))
+
+    def insert(self, row):
+        '''Adds a row; returns a Change with the subscriptions it entered'''
+        return self.update(row)
+
+    def update(self, row):
+        '''
+        Replaces a row with its new values; returns a Change with the
+        subscriptions it entered and left
+        '''
+        key = self.key(row)
+        before = self._matches.get(key, set())
+        after = self.matches(row)
+        if after:
+            self._matches[key] = after
+        else:
+            self._matches.pop(key, None)
+        return Change(after - before, before - after)
+
+    def delete(self, row):
+        '''Removes a row; returns a Change with the subscriptions it left'''
+        return Change(set(), self._matches.pop(self.key(row), set()))
+
+    def _candidates(self, row):
+        candidates = set(self._unindexed)
+        getter = self.getter
+        for column, index in self._equal.items():
+            value = getter(row, column)
+            try:
+                candidates.update(index.get(value, ()))
+            except TypeError:
+                pass
+        for (kind, column), index in self._ranges.items():
+            value = getter(row, column)
+            # Decimal (from Numeric columns) isn't an int or float, but
+            # compares with the bounds
+            if isinstance(value, numbers.Number) and \
+                    not isinstance(value, bool):
+                try:
+                    candidates.update(index.candidates(kind, value))
+                except TypeError:
+                    pass
+        return candidates
+
+
+class _RangeIndex(object):
+    '''Sorted bounds of one column, for subscriptions on < or >'''
+    def __init__(self):
+        self.bounds = []
+        self.keys = []
+
+    def add(self, bound, key):
+        index = bisect.bisect_right(self.bounds, bound)
+        self.bounds.insert(index, bound)
+        self.keys.insert(index, key)
+
+    def remove(self, bound, key):
+        index = bisect.bisect_left(self.bounds, bound)
+        while self.keys[index] != key:
+            index += 1
+        del self.bounds[index]
+        del self.keys[index]
+
+    def candidates(self, kind, value):
+        '''Keys whose bound a value could satisfy (> or <)'''
+        if kind == '>':
+            return self.keys[:bisect.bisect_right(self.bounds, value)]
+        return self.keys[bisect.bisect_left(self.bounds, value):]
+
+
+def _subscription_terms(node):
+    '''
+    Returns a list of (kind, column, value) where a row that matches the
+    column node matches at least one, or None if there's no such list
+    '''
+    column = node['column']
+    op = node['operator']
+    value = node['value']
+    if op == '==':
+        # == None is IS NULL
+        values = [value]
+    elif op == 'in_' and isinstance(value, (list, tuple)):
+        # NULL is never IN a list
+        values = [each for each in value if each is not None]
+    elif op in ('>', '>=', '<', '<=') and _number(value):
+        return [(op[0], column, value)]
+    else:
+        return None
+    try:
+        terms = [('==', column, each) for each in values]
+        set(terms)
+    except TypeError:
+        return None
+    return terms
+
+
+def _subscription_and(children):
+    '''Any child's terms will do; prefer equality, then fewer terms'''
+    best = None
+    for terms in children:
+        if terms is None:
+            continue
+        rank = (any(kind != '==' for kind, _, _ in terms), len(terms))
+        if best is None or rank < best[0]:
+            best = rank, terms
+    return None if best is None else best[1]
+
+
+def _subscription_or(children):
+    terms = []
+    for child in children:
+        if child is None:
+            return None
+        terms.extend(child)
+    return terms
+
+
+_SUBSCRIPTION_LOGICAL = {
+    'and': _subscription_and,
+    'or': _subscription_or,
+    'not': lambda children: None,
+}
+
+
+ARRAY_OPERATORS = {}
+
+
+def register_array_operator(opstring, factory):
+    '''
+    Registers a function so that the operator can be used in queries
+    evaluated over columnar batches (see compile_mask).
+
+    opstring:
+        The string used to reference this function in json queries
+
+    factory:
+        Function that takes the value from the json and returns a test.
+        The test takes a numpy array of a column's non-null values and
+        returns a boolean array of the same length.  It may instead return
+        a (true, false) pair of boolean arrays when some results are
+        unknown (SQL NULL); positions in neither array are unknown.
+
+        Example: Adding the >= operator
+            register_array_operator('>=', lambda value: lambda a: a >= value)
+    '''
+    ARRAY_OPERATORS[opstring] = factory
+
+
+def array_binop(func):
+    '''Returns a factory for an elementwise comparison'''
+    return lambda value: lambda array: func(array, value)
+
+
+def array_like(lower=False):
+    '''
+    Returns a factory for like that matches every element of an array.
+    Plain prefix, suffix and substring patterns use numpy.char; anything
+    else falls back to a regex compiled once per query.
+    '''
+    def factory(pattern):
+        import numpy
+        char = numpy.char
+        if lower:
+            pattern = pattern.lower()
+        body = pattern.strip('%')
+        prefix = pattern[:len(pattern) - len(pattern.lstrip('%'))]
+        suffix = pattern[len(pattern.rstrip('%')):]
+        if '%' in body or '_' in body:
+            regex = like_regex(pattern)
+            match = numpy.frompyfunc(
+                lambda s: regex.match(s) is not None, 1, 1)
+
+            def test(array):
+                return match(array).astype(bool)
+        elif prefix and suffix:
+            def test(array):
+                return char.find(array, body) >= 0
+        elif suffix:
+            def test(array):
+                return char.startswith(array, body)
+        elif prefix:
+            def test(array):
+                return char.endswith(array, body)
+        else:
+            def test(array):
+                return array == body
+
+        def strings(array):
+            array = array.astype(str)
+            return test(char.lower(array) if lower else array)
+        return strings
+    return factory
+
+
+def _array_in(value):
+    import numpy
+    values = [v for v in value if v is not None]
+    has_null = len(values) != len(value)
+
+    def test(array):
+        found = numpy.isin(array, values)
+        if has_null:
+            # x IN (..., NULL) is unknown rather than false when x isn't found
+            return found, numpy.zeros_like(found)
+        return found
+    return test
+
+
+for opstring, func in binops.items():
+    register_array_operator(opstring, array_binop(func))
+register_array_operator('like', array_like())
+register_array_operator('ilike', array_like(lower=True))
+register_array_operator('in_', _array_in)
+
+
+def compile_mask(json, optimize=False, **kwargs):
+    '''
+    Returns a MaskFilter that evaluates the given json over columnar
+    batches with numpy, one array operation per node instead of one python
+    call per row.
+    Usage:
+        mask_filter = compile_mask(json, query_constraints)
+        mask = mask_filter.mask({'age': ages, 'name': names})
+        adults = mask_filter.filter(batch)
+
+    A batch is anything that returns a column for batch[column_name]:
+    dicts of lists or arrays, numpy structured arrays, DataFrames, or
+    Arrow tables.  Comparisons follow SQL semantics: None (and NaN in
+    float columns) is NULL, and rows are only matched when the whole query
+    is true.  Requires numpy.
+
+    json, optimize, query_constraints:
+        See jsonquery
+    '''
+    json, constraints = _prepare(json, optimize, kwargs)
+    evaluate = _fold(json, constraints, _mask_column, _MASK_LOGICAL)
+    return MaskFilter(evaluate)
+
+
+class MaskFilter(object):
+    '''A compiled columnar query; see compile_mask'''
+    __slots__ = ('_evaluate',)
+
+    def __init__(self, evaluate):
+        self._evaluate = evaluate
+
+    def mask(self, batch):
+        '''Returns a boolean array, True for rows that match the query'''
+        import numpy
+        true, _ = self._evaluate(numpy, batch, _batch_length(batch))
+        return true
+
+    def filter(self, batch):
+        '''
+        Returns the rows of batch that match the query.
+        Dicts are filtered column by column into a dict of arrays; other
+        batches are indexed with the mask.
+        '''
+        import numpy
+        mask = self.mask(batch)
+        if isinstance(batch, dict):
+            return dict((column, numpy.asarray(values)[mask])
+                        for column, values in batch.items())
+        return batch[mask]
+
+
+def _batch_length(batch):
+    if isinstance(batch, dict):
+        return len(next(iter(batch.values()))) if batch else 0
+    return len(batch)
+
+
+# Each node compiles to a function (numpy, batch, length) -> (true, false)
+# where true and false are boolean masks of rows for which the node is true
+# and false.  Rows in neither are unknown (SQL NULL).  false is None when no
+# row is unknown, to skip the extra mask work for non-null data.
+def _mask_and(evaluators):
+    evaluators = tuple(evaluators)
+
+    def evaluate(numpy, batch, length):
+        true = numpy.ones(length, dtype=bool)
+        false = None
+        for child in evaluators:
+            child_true, child_false = child(numpy, batch, length)
+            if false is None and child_false is not None:
+                false = ~true
+            if false is not None:
+                false |= ~child_true if child_false is None else child_false
+            true &= child_true
+        return true, false
+    return evaluate
+
+
+def _mask_or(evaluators):
+    evaluators = tuple(evaluators)
+
+    def evaluate(numpy, batch, length):
+        true = numpy.zeros(length, dtype=bool)
+        false = None
+        for child in evaluators:
+            child_true, child_false = child(numpy, batch, length)
+            if false is None and child_false is not None:
+                false = ~true
+            if false is not None:
+                false &= ~child_true if child_false is None else child_false
+            true |= child_true
+        return true, false
+    return evaluate
+
+
+def _mask_not(children):
+    child = children[0]
+
+    def evaluate(numpy, batch, length):
+        true, false = child(numpy, batch, length)
+        if false is None:
+            return ~true, None
+        return false, true
+    return evaluate
+
+
+_MASK_LOGICAL = {
+    'and': _mask_and,
+    'or': _mask_or,
+    'not': _mask_not,
+}
+
+
+def _mask_column(node):
+    column = node['column']
+    op = node['operator']
+    value = node['value']
+    if value is None and op in binops:
+        # == None and != None render as IS NULL / IS NOT NULL, any other
+        # comparison against NULL is unknown
+        def evaluate(numpy, batch, length):
+            nulls = _array_nulls(numpy, numpy.asarray(batch[column]))
+            if nulls is None:
+                nulls = numpy.zeros(length, dtype=bool)
+            if op == '==':
+                return nulls, None
+            if op == '!=':
+                return ~nulls, None
+            empty = numpy.zeros(length, dtype=bool)
+            return empty, empty.copy()
+        return evaluate
+
+    test = ARRAY_OPERATORS[op](value)
+
+    def evaluate(numpy, batch, length):
+        array = numpy.asarray(batch[column])
+        nulls = _array_nulls(numpy, array)
+        if nulls is None or not nulls.any():
+            result = test(array)
+            if isinstance(result, tuple):
+                return result
+            return numpy.asarray(result, dtype=bool), None
+        valid = ~nulls
+        true = numpy.zeros(length, dtype=bool)
+        false = numpy.zeros(length, dtype=bool)
+        result = test(array[valid])
+        if isinstance(result, tuple):
+            true[valid], false[valid] = result
+        else:
+            result = numpy.asarray(result, dtype=bool)
+            true[valid] = result
+            false[valid] = ~result
+        return true, false
+    return evaluate
+
+
+def _array_nulls(numpy, array):
+    '''Returns a mask of null values, or None if the array can't hold any'''
+    if array.dtype.kind == 'O':
+        return numpy.equal(array, None)
+    if array.dtype.kind == 'f':
+        return numpy.isnan(array)
+    return None
+
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class _Uncacheable(Exception):
+    '''Raised when a literal can't be extracted as a bind parameter'''
+
+
+class QueryCache(object):
+    '''
+    Bounded LRU cache of criteria, keyed on the structural shape of a query.
+
+    Two queries share a shape when they use the same operators, columns,
+    nesting and list lengths, and differ only in literal values.  The first
+    query of a shape is built (and validated) with its literals replaced by
+    bind parameters; every later query of that shape reuses the criterion
+    and only supplies new parameter values.  Since the criterion is the same
+    object, SQLAlchemy's compiled statement cache is hit as well.
+
+    Usage:
+        cache = QueryCache(maxsize=512)
+        query = jsonquery(session, model, json, cache=cache)
+        cache.info()  # CacheInfo(hits=..., misses=..., ...)
+
+    Operator functions receive a sqlalchemy.sql.expression.BindParameter
+    instead of the literal value when a query is built for the cache.
+    Queries whose values can't be bound (dicts, nested lists) are built
+    directly and not cached.
+    '''
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def info(self):
+        '''Returns a CacheInfo of the current counters'''
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._entries))
+
+    def clear(self):
+        '''Drops all entries and resets the counters'''
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def criterion(self, model, json, constraints):
+        '''
+        Returns (criterion, params) for the given query, where params is a
+        dict of bind parameter values to pass to Query.params()
+        '''
+        json = _as_json(json)
+        values = []
+        try:
+            shape = _shape(json, values)
+        except _Uncacheable:
+            return _build(json, model, constraints), {}
+        key = (model, tuple(sorted(constraints.items())), shape)
+        params = _params(values)
+
+        with self._lock:
+            criterion = self._entries.pop(key, None)
+            if criterion is not None:
+                self.hits += 1
+                self._entries[key] = criterion
+                return criterion, params
+            self.misses += 1
+
+        template = _template(json, iter(range(len(values))))
+        criterion = _build(template, model, constraints)
+        with self._lock:
+            self._entries[key] = criterion
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return criterion, params
+
+
+def _param_name(index):
+    return 'jq_{}'.format(index)
+
+
+def _params(values):
+    return dict((_param_name(i), v) for i, v in enumerate(values))
+
+
+def _is_literal(value):
+    return value is not None and not isinstance(value, (dict, list, tuple))
+
+
+def _shape(node, values):
+    '''
+    Returns a hashable description of the node with its literals removed:
+    a flat tuple of its nodes in post-order, so deep queries are hashed and
+    compared without recursion.  Literals are appended to values in the
+    order _template binds them.
+    '''
+    shape = []
+
+    def leaf(node):
+        column = node['column']
+        op = node['operator']
+        value = node['value']
+        if value is None:
+            # == None and != None render as IS NULL / IS NOT NULL
+            shape.append((column, op, None))
+        elif isinstance(value, (list, tuple)):
+            if not all(_is_literal(v) for v in value):
+                raise _Uncacheable
+            values.extend(value)
+            shape.append((column, op, len(value)))
+        elif not _is_literal(value):
+            raise _Uncacheable
+        else:
+            values.append(value)
+            shape.append((column, op, -1))
+
+    def logical(op, children):
+        shape.append((op, len(children)))
+    _fold(node, _UNCHECKED, leaf, dict(
+        (op, functools.partial(logical, op)) for op in TREE_CODES))
+    return tuple(shape)
+
+
+def _template(node, indexes):
+    '''Returns a copy of node with literals replaced by bind parameters'''
+    def leaf(node):
+        value = node['value']
+        if isinstance(value, (list, tuple)):
+            value = [_bindparam(next(indexes)) for _ in value]
+        elif value is not None:
+            value = _bindparam(next(indexes))
+        template = dict(node)
+        template['value'] = value
+        return template
+
+    def logical(op, children):
+        return {'operator': op,
+                'value': children[0] if op == 'not' else children}
+    return _fold(node, _UNCHECKED, leaf, dict(
+        (op, functools.partial(logical, op)) for op in TREE_CODES))
+
+
+_UNCHECKED = dict((key, None) for key in DEFAULT_QUERY_CONSTRAINTS)
+
+
+def _bindparam(index):
+    return sqlalchemy.bindparam(_param_name(index))
+
+
+class LocalStore(object):
+    '''
+    In-process store for a ResultCache: a bounded LRU dict whose entries
+    expire after a ttl.  Other stores (memcached, redis, ...) implement
+    the same get, set, incr and clear methods.
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Returns the value for key, or None if it's missing or expired'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= _monotonic():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        '''Stores value for ttl seconds (forever if ttl is None)'''
+        expires = None if ttl is None else _monotonic() + ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def incr(self, key):
+        '''Adds one to the integer at key (0 if missing), and returns it'''
+        with self._lock:
+            _, value = self._entries.pop(key, (None, 0))
+            self._entries[key] = (None, value + 1)
+            return value + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class ResultCache(object):
+    '''
+    Caches the rows of repeated, identical queries, and drops them when the
+    tables they read are changed through a bound session.
+    Usage:
+        cache = ResultCache(ttl=30)
+        cache.bind(Session)
+        users = cache.query(session, User, json)
+
+    Results are keyed on the model, the query json (so a page's fields
+    and other options are part of the key), the query constraints and a
+    generation number for every table the query reads: the model's
+    tables, the tables of relationship paths and of relationships loaded
+    by the page.  Changing a table starts a new generation, so older
+    results are never read again and age out of the store.
+
+    Rows are stored as SQLAlchemy FrozenResults and merged into the
+    querying session without loading them again.
+
+    ttl (Optional):
+        Seconds a result is kept.  Changes made outside of bound sessions
+        (other processes, Core statements) are seen once it expires.
+        Default is 60.
+
+    maxsize (Optional):
+        Number of results kept by the default LocalStore.  Default is 1024.
+
+    store (Optional):
+        Where results and table generations are kept; see LocalStore.
+        Default is a LocalStore of maxsize entries.
+    '''
+    def __init__(self, ttl=60, maxsize=1024, store=None):
+        self.ttl = ttl
+        self.store = store if store is not None else LocalStore(maxsize)
+        self.hits = self.misses = 0
+
+    def bind(self, target):
+        '''
+        Invalidates tables when a Session (class), sessionmaker or session
+        flushes or commits changes to them
+        '''
+        listen = sqlalchemy.event.listen
+        listen(target, 'after_flush', self._after_flush)
+        listen(target, 'after_commit', self._after_commit)
+        listen(target, 'after_rollback', self._after_rollback)
+        listen(target, 'do_orm_execute', self._do_orm_execute)
+
+    def query(self, session, model, json, **kwargs):
+        '''
+        Returns the list of rows that match json, from the cache if the
+        same query was run since its tables last changed.
+        kwargs are passed to jsonselect.
+        '''
+        statement = jsonselect(model, json, **kwargs)
+        key = self._key(model, json, kwargs)
+        frozen = self.store.get(key)
+        if frozen is not None:
+            self.hits += 1
+            result = sqlalchemy.orm.loading.merge_frozen_result(
+                session, statement, frozen, load=False)
+            return result().scalars().all()
+        self.misses += 1
+        frozen = session.execute(statement).freeze()
+        self.store.set(key, frozen, self.ttl)
+        return frozen().scalars().all()
+
+    def invalidate(self, *tables):
+        '''
+        Drops cached results that read any of the tables (Tables, table
+        names or models)
+        '''
+        for table in tables:
+            if not is_string(table):
+                if not isinstance(table, sqlalchemy.Table):
+                    table = sqlalchemy.inspect(table).local_table
+                table = table.name
+            self.store.incr(_generation_key(table))
+
+    def clear(self):
+        '''Drops every cached result and resets the counters'''
+        self.store.clear()
+        self.hits = self.misses = 0
+
+    def _key(self, model, json, kwargs):
+        tables = sorted(_read_tables(model, json))
+        generations = [self.store.get(_generation_key(table)) or 0
+                       for table in tables]
+        key = jsonlib.dumps([
+            model.__module__, model.__name__, _canonical(json), tables,
+            generations,
+            sorted(kwargs.items())], sort_keys=True, default=repr)
+        return 'jsonquery:result:' + hashlib.sha1(
+            key.encode('utf-8')).hexdigest()
+
+    def _after_flush(self, session, flush_context):
+        tables = session.info.setdefault(_CHANGED_TABLES, set())
+        for instance in itertools.chain(
+                session.new, session.dirty, session.deleted):
+            for table in sqlalchemy.inspect(instance).mapper.tables:
+                tables.add(table.name)
+        # Other sessions can't see the changes until they're committed,
+        # but this one can
+        self.invalidate(*tables)
+
+    def _after_commit(self, session):
+        self.invalidate(*session.info.pop(_CHANGED_TABLES, ()))
+
+    def _after_rollback(self, session):
+        # Results cached between a flush and the rollback hold rows that
+        # no longer exist
+        self.invalidate(*session.info.pop(_CHANGED_TABLES, ()))
+
+    def _do_orm_execute(self, state):
+        if not (state.is_update or state.is_delete or state.is_insert):
+            return
+        tables = state.session.info.setdefault(_CHANGED_TABLES, set())
+        for mapper in state.all_mappers:
+            tables.update(table.name for table in mapper.tables)
+        self.invalidate(*tables)
+
+
+_CHANGED_TABLES = 'jsonquery_changed_tables'
+
+
+def _canonical(json):
+    '''Returns a query or page json, with any QueryTree as json'''
+    if _is_page(json) and 'filter' in json:
+        return dict(json, filter=_as_json(json['filter']))
+    return _as_json(json)
+
+
+def _generation_key(table):
+    return 'jsonquery:generation:' + table
+
+
+def _read_tables(model, json):
+    '''Returns the set of names of the tables a query json reads'''
+    mapper = sqlalchemy.inspect(model)
+    tables = set(table.name for table in mapper.tables)
+
+    def leaf(node):
+        if '.' in node['column']:
+            steps, _ = _resolve_path(model, node['column'])
+            for _, _, _, cls in steps:
+                tables.update(
+                    table.name for table in sqlalchemy.inspect(cls).tables)
+
+    page = json
+    if _is_page(json):
+        for name in json.get('load') or {}:
+            if name in mapper.relationships:
+                tables.update(table.name for table in
+                              mapper.relationships[name].mapper.tables)
+        json = page.get('filter')
+    if json is not None:
+        constraints = dict((key, None) for key in DEFAULT_QUERY_CONSTRAINTS)
+        _fold(json, constraints, leaf, _IGNORE_LOGICAL)
+    return tables
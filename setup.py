@@ -12,7 +12,7 @@ with open(os.path.join(HERE, 'CHANGES.rst')) as changes_file:
 CHANGES = re.sub(r'\(\s*:(issue|pr|sha):.*?\)', '', CHANGES)
 
 REQUIREMENTS = [
-    'sqlalchemy'
+    'sqlalchemy>=1.4'
 ]
 
 TEST_REQUIREMENTS = [
@@ -31,13 +31,13 @@ if __name__ == "__main__":
             'License :: OSI Approved :: MIT License',
             'Operating System :: OS Independent',
             'Programming Language :: Python',
-            'Programming Language :: Python :: 2',
-            'Programming Language :: Python :: 2.6',
-            'Programming Language :: Python :: 2.7',
             'Programming Language :: Python :: 3',
-            'Programming Language :: Python :: 3.2',
-            'Programming Language :: Python :: 3.3',
-            'Programming Language :: Python :: 3.4',
+            'Programming Language :: Python :: 3.7',
+            'Programming Language :: Python :: 3.8',
+            'Programming Language :: Python :: 3.9',
+            'Programming Language :: Python :: 3.10',
+            'Programming Language :: Python :: 3.11',
+            'Programming Language :: Python :: 3.12',
             'Topic :: Software Development :: Libraries',
             'Topic :: Software Development :: Libraries :: Python Modules'
         ],
@@ -50,6 +50,7 @@ if __name__ == "__main__":
         include_package_data=True,
         py_modules=['jsonquery'],
         packages=find_packages(exclude=('tests',)),
+        python_requires='>=3.7',
         install_requires=REQUIREMENTS,
         tests_require=REQUIREMENTS + TEST_REQUIREMENTS,
     )
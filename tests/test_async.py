@@ -0,0 +1,73 @@
+import asyncio
+import json
+import pytest
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import declarative_base
+from jsonquery import async_jsonquery, async_jsonquery_stream, jsonselect
+
+asyncio_ext = pytest.importorskip('sqlalchemy.ext.asyncio')
+pytest.importorskip('aiosqlite')
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    age = Column(Integer)
+
+
+def run(test):
+    async def setup_and_run():
+        engine = asyncio_ext.create_async_engine("sqlite+aiosqlite://")
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        try:
+            async with asyncio_ext.AsyncSession(engine) as session:
+                session.add_all([User(name=str(age), age=age)
+                                 for age in range(10)])
+                await session.commit()
+                await test(engine, session)
+        finally:
+            await engine.dispose()
+    asyncio.run(setup_and_run())
+
+
+JSON = jsonify({'column': 'age', 'value': 7, 'operator': '>='})
+
+
+def test_jsonselect():
+    statement = jsonselect(User, JSON)
+    assert 'users.age >= ' in str(statement)
+
+
+def test_async_session():
+    async def test(engine, session):
+        result = await async_jsonquery(session, User, JSON)
+        assert sorted(user.age for user in result.scalars()) == [7, 8, 9]
+    run(test)
+
+
+def test_async_connection():
+    async def test(engine, session):
+        async with engine.connect() as connection:
+            result = await async_jsonquery(connection, User, JSON)
+            assert sorted(row.age for row in result) == [7, 8, 9]
+    run(test)
+
+
+def test_async_stream():
+    async def test(engine, session):
+        page = jsonify({'filter': JSON, 'order_by': ['-age']})
+        result = await async_jsonquery_stream(
+            session, User, page, chunk_size=2)
+        ages = [user.age async for user in result.scalars()]
+        assert ages == [9, 8, 7]
+    run(test)
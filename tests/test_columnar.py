@@ -0,0 +1,106 @@
+import json
+import pytest
+from jsonquery import compile_mask, compile_predicate
+
+numpy = pytest.importorskip('numpy')
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+ROWS = [
+    {'name': 'pat', 'age': 10, 'height': 150.0},
+    {'name': 'patrick', 'age': 21, 'height': float('nan')},
+    {'name': 'sam', 'age': None, 'height': 180.0},
+    {'name': None, 'age': 30, 'height': 170.0},
+    {'name': 'Pattie', 'age': 21, 'height': 160.0},
+]
+
+
+class TestMask():
+
+    def setup_method(self, method):
+        self.batch = {
+            'name': numpy.array([row['name'] for row in ROWS], dtype=object),
+            'age': numpy.array([row['age'] for row in ROWS], dtype=object),
+            'height': numpy.array([row['height'] for row in ROWS]),
+        }
+
+    def assert_same_as_predicate(self, json):
+        '''The mask must match exactly the rows the predicate matches'''
+        json = jsonify(json)
+        # NaN is NULL for the columnar backend
+        rows = [dict(row, height=None if row['height'] != row['height']
+                     else row['height']) for row in ROWS]
+        expected = [compile_predicate(json).matches(row) for row in rows]
+        actual = compile_mask(json).mask(self.batch)
+        assert expected == actual.tolist()
+
+    def test_binops(self):
+        for op in ['<', '<=', '==', '!=', '>=', '>']:
+            self.assert_same_as_predicate(
+                {'column': 'age', 'value': 21, 'operator': op})
+            self.assert_same_as_predicate(
+                {'column': 'height', 'value': 160, 'operator': op})
+
+    def test_null(self):
+        for op in ['==', '!=', '<']:
+            self.assert_same_as_predicate(
+                {'column': 'name', 'value': None, 'operator': op})
+
+    def test_like(self):
+        for pattern in ['pat', 'pat%', '%ick', '%at%', '_a_', 'p%k', '%']:
+            self.assert_same_as_predicate(
+                {'column': 'name', 'value': pattern, 'operator': 'like'})
+            self.assert_same_as_predicate(
+                {'column': 'name', 'value': pattern.upper(),
+                 'operator': 'ilike'})
+
+    def test_in(self):
+        self.assert_same_as_predicate(
+            {'column': 'age', 'value': [10, 30], 'operator': 'in_'})
+        self.assert_same_as_predicate(
+            {'column': 'age', 'value': [10, None], 'operator': 'in_'})
+
+    def test_logical_with_nulls(self):
+        self.assert_same_as_predicate({
+            'operator': 'not',
+            'value': {
+                'operator': 'or',
+                'value': [
+                    {'column': 'age', 'value': 20, 'operator': '>'},
+                    {'column': 'height', 'value': 160, 'operator': '<'}
+                ]
+            }
+        })
+        self.assert_same_as_predicate({
+            'operator': 'not',
+            'value': {
+                'operator': 'and',
+                'value': [
+                    {'column': 'name', 'value': 'pat%', 'operator': 'like'},
+                    {'column': 'height', 'value': 200, 'operator': '<'}
+                ]
+            }
+        })
+
+    def test_filter_dict(self):
+        json = jsonify({'column': 'age', 'value': 21, 'operator': '=='})
+        result = compile_mask(json).filter(self.batch)
+        assert result['name'].tolist() == ['patrick', 'Pattie']
+
+    def test_filter_structured_array(self):
+        batch = numpy.array([(1, 10), (2, 20), (3, 30)],
+                            dtype=[('id', int), ('age', int)])
+        json = jsonify({'column': 'age', 'value': 20, 'operator': '>='})
+        assert compile_mask(json).filter(batch)['id'].tolist() == [2, 3]
+
+    def test_constraints(self):
+        json = jsonify({
+            'operator': 'and',
+            'value': [{'column': 'age', 'value': 10, 'operator': '=='}]
+        })
+        with pytest.raises(ValueError):
+            compile_mask(json, max_elements=1)
@@ -0,0 +1,124 @@
+import json
+import pytest
+from sqlalchemy import Column, Integer, String, Text, create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from jsonquery import (
+    jsonquery, jsonquery_batch, jsonquery_count, jsonquery_stream,
+    compile_query, parallel_jsonquery, CostModel, DEFAULT_COST_MODEL,
+    statement_timeouts)
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+def leaf(column, operator, value):
+    return {'column': column, 'operator': operator, 'value': value}
+
+
+@pytest.fixture()
+def user_setup(request):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+        name = Column(String, index=True)
+        bio = Column(Text)
+        age = Column(Integer)
+    engine = create_engine("sqlite://", echo=True)
+    Base.metadata.create_all(engine)
+
+    request.cls.model = User
+    request.cls.engine = engine
+    request.cls.session = sessionmaker(bind=engine)()
+
+
+@pytest.mark.usefixtures("user_setup")
+class TestCost():
+
+    def cost(self, json, cost_model=DEFAULT_COST_MODEL):
+        return cost_model.cost(self.model, jsonify(json))
+
+    def test_column_costs(self):
+        assert self.cost(leaf('id', '==', 1)) == 1
+        assert self.cost(leaf('age', '==', 1)) == 10
+        assert self.cost(leaf('name', 'like', 'pat%')) == 2
+        assert self.cost(leaf('name', 'like', '%pat')) == 20
+        assert self.cost(leaf('name', 'ilike', '%pat')) == 40
+        assert self.cost(leaf('id', '!=', 1)) == 10
+        assert self.cost(leaf('id', 'in_', list(range(100)))) == 2
+
+    def test_logical_costs(self):
+        assert self.cost({'operator': 'and', 'value': [
+            leaf('id', '==', 1), leaf('age', '>', 1)]}) == 11
+        assert self.cost({'operator': 'not', 'value':
+                          leaf('id', '==', 1)}) == 2
+        assert self.cost({'operator': 'or', 'value': []}) == 0
+
+    def test_expensive_few_cheap_many(self):
+        expensive = {'operator': 'or', 'value': [
+            leaf('bio', 'ilike', '%word{}%'.format(i)) for i in range(10)]}
+        cheap = {'operator': 'or', 'value': [
+            leaf('id', '==', i) for i in range(60)]}
+        assert self.cost(expensive) > self.cost(cheap)
+        jsonquery(self.session, self.model, jsonify(cheap), max_cost=100)
+        with pytest.raises(ValueError):
+            jsonquery(self.session, self.model, jsonify(expensive),
+                      max_cost=100)
+        with pytest.raises(ValueError):
+            jsonquery_count(self.session, self.model, jsonify(expensive),
+                            max_cost=100, optimize=True)
+
+    def test_every_entry_point(self, tmpdir):
+        json = jsonify(leaf('bio', 'ilike', '%x%'))
+        shard = 'sqlite:///{}'.format(tmpdir.join('shard.db'))
+        self.model.metadata.create_all(create_engine(shard))
+        shards = [shard]
+        runs = [
+            lambda **kwargs: jsonquery(
+                self.session, self.model, json, **kwargs).all(),
+            lambda **kwargs: jsonquery_batch(
+                self.session, self.model, [json], **kwargs),
+            lambda **kwargs: jsonquery_batch(
+                self.session, self.model, [json], count=True, **kwargs),
+            lambda **kwargs: list(jsonquery_stream(
+                self.session, self.model, json, **kwargs)),
+            lambda **kwargs: list(jsonquery_stream(
+                self.session, self.model, json, keyset=True, **kwargs)),
+            lambda **kwargs: compile_query(
+                self.model, json, **kwargs).query(self.session).all(),
+            lambda **kwargs: parallel_jsonquery(
+                shards, self.model, json, **kwargs),
+        ]
+        for run in runs:
+            with pytest.raises(ValueError):
+                run(max_cost=1)
+            with pytest.raises(ValueError):
+                run(max_cost=1, optimize=True)
+            run(max_cost=1000)
+        cost_model = CostModel(seconds_per_cost=0.5)
+        plan = compile_query(self.model, json, cost_model=cost_model)
+        options = plan.query(self.session).get_execution_options()
+        assert options['jsonquery_timeout'] == 20
+
+    def test_weights(self):
+        cost_model = CostModel(weights={'==': 3}, column_weights={'bio': 5})
+        assert self.cost(leaf('id', '==', 1), cost_model) == 3
+        assert self.cost(leaf('bio', '==', 'x'), cost_model) == 150
+
+    def test_tags(self):
+        cost_model = CostModel(seconds_per_cost=0.5, max_timeout=10)
+        query = jsonquery(self.session, self.model,
+                          jsonify(leaf('age', '==', 1)), cost_model=cost_model)
+        options = query.get_execution_options()
+        assert options['jsonquery_cost'] == 10
+        assert options['jsonquery_timeout'] == 5
+        assert cost_model.timeout(100) == 10
+        query.all()
+
+    def test_statement_timeouts_postgresql_only(self):
+        with pytest.raises(ValueError):
+            statement_timeouts(self.engine)
@@ -0,0 +1,33 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = '''
+import json, sys
+import jsonquery
+loaded = ['sqlalchemy' in sys.modules]
+tree = jsonquery.parse_tree(jsonquery.parse_query(
+    '{"operator": "or", "value": ['
+    '{"column": "age", "operator": ">=", "value": 18},'
+    '{"column": "name", "operator": "like", "value": "pat%"}]}'))
+predicate = jsonquery.compile_predicate(tree)
+assert predicate.matches({"age": 20, "name": "sam"})
+jsonquery.optimize_query(tree)
+manager = jsonquery.SubscriptionManager()
+manager.subscribe("adults", tree)
+assert manager.matches({"age": 20, "name": "sam"}) == set(["adults"])
+loaded.append('sqlalchemy' in sys.modules)
+jsonquery.sqlalchemy.select
+loaded.append(type(jsonquery.sqlalchemy).__name__)
+print(json.dumps(loaded))
+'''
+
+
+def test_in_memory_without_sqlalchemy():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT], env=env, cwd=ROOT)
+    assert json.loads(output) == [False, False, 'module']
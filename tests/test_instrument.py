@@ -0,0 +1,128 @@
+import json
+import logging
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from jsonquery import (
+    jsonquery, jsonquery_count, add_listener, remove_listener, instrument,
+    MetricsAdapter, QueryCache, SlowQueryLogger)
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+QUERY = jsonify({'operator': 'or', 'value': [
+    {'column': 'age', 'value': 10, 'operator': '>'},
+    {'operator': 'not', 'value': {
+        'column': 'name', 'value': 'pat', 'operator': '=='}}]})
+SHAPE = {'operator': 'or', 'value': [
+    {'column': 'age', 'value': '?', 'operator': '>'},
+    {'operator': 'not', 'value': {
+        'column': 'name', 'value': '?', 'operator': '=='}}]}
+
+
+@pytest.fixture()
+def user_setup(request):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        age = Column(Integer)
+    engine = create_engine("sqlite://", echo=True)
+    Base.metadata.create_all(engine)
+
+    request.cls.model = User
+    request.cls.session = sessionmaker(bind=engine)()
+
+
+@pytest.mark.usefixtures("user_setup")
+class TestInstrument():
+
+    def test_metrics(self):
+        with instrument() as collected:
+            jsonquery(self.session, self.model, QUERY).all()
+            jsonquery_count(self.session, self.model, QUERY)
+        assert len(collected) == 2
+        metrics = collected[0]
+        assert metrics.model is self.model
+        assert metrics.shape == SHAPE
+        assert (metrics.nodes, metrics.depth, metrics.breadth) == (4, 3, 2)
+        assert set(metrics.phases) == set(
+            ['prepare', 'build', 'compile', 'execute'])
+        assert metrics.total == sum(metrics.phases.values())
+        assert metrics.cache_hit is None
+        assert 'WHERE users.age > ?' in metrics.sql
+        assert 'count(*)' in collected[1].sql
+
+    def test_constraints_checked_first(self):
+        # Measuring the node without a column would fail with a KeyError
+        json = jsonify({'operator': 'and', 'value': [
+            {'column': 'age', 'value': i, 'operator': '>'}
+            for i in range(64)] + [{'value': 1, 'operator': '=='}]})
+        with instrument() as collected:
+            with pytest.raises(ValueError):
+                jsonquery(self.session, self.model, json)
+        assert collected == []
+
+    def test_cache_hit(self):
+        cache = QueryCache()
+        with instrument() as collected:
+            for _ in range(2):
+                jsonquery(self.session, self.model, QUERY, cache=cache).all()
+        assert [metrics.cache_hit for metrics in collected] == [False, True]
+
+    def test_not_instrumented(self):
+        query = jsonquery(self.session, self.model, QUERY)
+        assert 'jsonquery_metrics' not in query._execution_options
+        with instrument() as collected:
+            query.all()
+        assert collected == []
+
+    def test_slow_query_logger(self, caplog):
+        with instrument(SlowQueryLogger(threshold=0)):
+            with caplog.at_level(logging.WARNING, logger='jsonquery'):
+                jsonquery(self.session, self.model, QUERY).all()
+        records = [record for record in caplog.records
+                   if record.name == 'jsonquery']
+        assert len(records) == 1
+        assert json.dumps(SHAPE, sort_keys=True) in records[0].getMessage()
+        caplog.clear()
+        with instrument(SlowQueryLogger(threshold=60)):
+            with caplog.at_level(logging.WARNING, logger='jsonquery'):
+                jsonquery(self.session, self.model, QUERY).all()
+        assert not [record for record in caplog.records
+                    if record.name == 'jsonquery']
+
+    def test_adapter(self):
+        class Adapter(MetricsAdapter):
+            def __init__(self):
+                self.timings = {}
+                self.gauges = {}
+
+            def timing(self, name, seconds, tags):
+                self.timings[name] = seconds
+
+            def gauge(self, name, value, tags):
+                self.gauges[name] = value
+        adapter = Adapter()
+        add_listener(adapter)
+        try:
+            jsonquery(self.session, self.model, QUERY).all()
+        finally:
+            remove_listener(adapter)
+        assert 'jsonquery.build' in adapter.timings
+        assert 'jsonquery.total' in adapter.timings
+        assert adapter.gauges['jsonquery.nodes'] == 4
+
+    def test_listener_errors_logged(self, caplog):
+        def broken(metrics):
+            raise RuntimeError('broken')
+        with instrument(broken):
+            with caplog.at_level(logging.ERROR, logger='jsonquery'):
+                jsonquery(self.session, self.model, QUERY).all()
+        assert 'broken' in caplog.text
@@ -1,9 +1,20 @@
+import datetime
+import decimal
 import json
+import sys
+import uuid
 import pytest
-from sqlalchemy import Column, Integer, String, create_engine, and_, or_, not_
+import sqlalchemy
+from sqlalchemy import (
+    Column, Date, DateTime, Integer, Numeric, String, Uuid, create_engine,
+    and_, or_, not_)
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from jsonquery import jsonquery
+from jsonquery import (
+    jsonquery, jsonquery_batch, jsonquery_stream, compile_query, next_cursor,
+    jsonquery_count, jsonquery_exists, jsonquery_aggregate, QueryCache,
+    BulkIn, parse_query, register_model, register_operator,
+    unregister_model, unregister_operator)
 
 
 def jsonify(dict):
@@ -111,6 +122,63 @@ class TestQuery():
         with pytest.raises(ValueError):
             jsonquery(self.session, self.model, json, max_breadth=1).one()
 
+    def test_element_limit_counts_list_values(self):
+        json = jsonify({
+            'operator': 'and',
+            'value': [
+                {'column': 'age', 'value': [1, 2, 3], 'operator': 'in_'}
+            ]
+        })
+        jsonquery(self.session, self.model, json, max_elements=5)
+        with pytest.raises(ValueError):
+            jsonquery(self.session, self.model, json, max_elements=4)
+
+    def test_deep_query(self):
+        self.add_user(age=10)
+        json = {'column': 'age', 'value': 10, 'operator': '=='}
+        depth = sys.getrecursionlimit() + 100
+        for _ in range(depth):
+            json = {'operator': 'and', 'value': [json]}
+
+        with pytest.raises(ValueError):
+            jsonquery(self.session, self.model, json,
+                      max_elements=None, max_depth=depth)
+        # Building doesn't recurse; compiling very deep SQL is left to the
+        # caller, so only the build is checked here
+        jsonquery(self.session, self.model, json,
+                  max_elements=None, max_depth=depth + 1)
+        cache = QueryCache()
+        for _ in range(2):
+            jsonquery(self.session, self.model, json, cache=cache,
+                      max_elements=None, max_depth=depth + 1)
+        assert cache.hits == 1
+        plan = compile_query(self.model, json, max_elements=None,
+                             max_depth=depth + 1)
+        assert plan.params == {'jq_0': 10}
+        with pytest.raises(ValueError):
+            jsonquery_batch(self.session, self.model, [json, json],
+                            max_elements=None, max_depth=depth)
+
+    def test_wide_query_builds_each_node_once(self):
+        # Timings live in benchmarks/run.py (build/wide/N); this only checks
+        # that every node is built once into one flat or
+        built = []
+
+        def eq(column, value):
+            built.append(value)
+            return column == value
+        register_operator('counted==', eq)
+        try:
+            json = {'operator': 'or', 'value': [
+                {'column': 'age', 'value': i, 'operator': 'counted=='}
+                for i in range(20000)]}
+            query = jsonquery(self.session, self.model, json,
+                              max_elements=None)
+        finally:
+            unregister_operator('counted==')
+        assert built == list(range(20000))
+        assert len(query.whereclause.clauses) == 20000
+
     def test_basic_and(self):
         self.add_user(age=10)
 
@@ -215,3 +283,366 @@ class TestQuery():
         expected_users = self.query.filter(not_(self.model.age == 10)).all()
         assert 2 == len(actual_users) == len(expected_users)
         assert set(actual_users) == set(expected_users)
+
+    def test_cache_reuses_shape(self):
+        self.add_user(age=10, name='pat')
+        self.add_user(age=20, name='sam')
+        cache = QueryCache()
+
+        def json(age, name):
+            return jsonify({
+                'operator': 'and',
+                'value': [
+                    {'column': 'age', 'value': age, 'operator': '>='},
+                    {'column': 'name', 'value': name, 'operator': 'like'}
+                ]
+            })
+
+        first = jsonquery(self.session, self.model, json(5, 'pat'),
+                          cache=cache).all()
+        second = jsonquery(self.session, self.model, json(15, 's%'),
+                           cache=cache).all()
+        assert [user.name for user in first] == ['pat']
+        assert [user.name for user in second] == ['sam']
+        assert cache.info()[:3] == (1, 1, 0)
+
+    def test_cache_shape_includes_list_arity(self):
+        self.add_user(age=10)
+        self.add_user(age=20)
+        self.add_user(age=30)
+        cache = QueryCache()
+
+        def json(ages):
+            return jsonify({'column': 'age', 'value': ages, 'operator': 'in_'})
+
+        assert 1 == jsonquery(self.session, self.model, json([10]),
+                              cache=cache).count()
+        assert 2 == jsonquery(self.session, self.model, json([10, 30]),
+                              cache=cache).count()
+        assert 1 == jsonquery(self.session, self.model, json([20]),
+                              cache=cache).count()
+        assert cache.info()[:3] == (1, 2, 0)
+
+    def test_cache_null_is_structural(self):
+        self.add_user(age=10)
+        self.add_user(name='pat')
+        cache = QueryCache()
+
+        json = jsonify({'column': 'age', 'value': None, 'operator': '=='})
+        user = jsonquery(self.session, self.model, json, cache=cache).one()
+        assert user.name == 'pat'
+        json = jsonify({'column': 'age', 'value': 10, 'operator': '=='})
+        user = jsonquery(self.session, self.model, json, cache=cache).one()
+        assert user.age == 10
+        assert cache.info()[:3] == (0, 2, 0)
+
+    def test_cache_eviction(self):
+        cache = QueryCache(maxsize=1)
+        for column in ['age', 'height', 'age']:
+            json = jsonify({'column': column, 'value': 1, 'operator': '=='})
+            jsonquery(self.session, self.model, json, cache=cache).all()
+        assert cache.info() == (0, 3, 2, 1, 1)
+
+    def test_cache_validates_constraints(self):
+        cache = QueryCache()
+        json = jsonify({
+            'operator': 'and',
+            'value': [{'column': 'age', 'value': 10, 'operator': '=='}]
+        })
+        jsonquery(self.session, self.model, json, cache=cache).all()
+        with pytest.raises(ValueError):
+            jsonquery(self.session, self.model, json, cache=cache,
+                      max_elements=1).all()
+
+    def test_compiled_query(self):
+        self.add_user(age=10, name='pat')
+        self.add_user(age=20, name='sam')
+
+        json = jsonify({
+            'operator': 'or',
+            'value': [
+                {'column': 'age', 'value': 10, 'operator': '=='},
+                {'column': 'name', 'value': 'sam', 'operator': '=='}
+            ]
+        })
+        plan = compile_query(self.model, json)
+        assert plan.params == {'jq_0': 10, 'jq_1': 'sam'}
+        assert 2 == plan.query(self.session).count()
+
+        user = plan.query(self.session, jq_1='nobody').one()
+        assert user.name == 'pat'
+        user = plan.bind(jq_0=0).query(self.session).one()
+        assert user.name == 'sam'
+
+        with pytest.raises(ValueError):
+            plan.query(self.session, jq_9=1)
+
+    def test_compiled_query_validates(self):
+        json = jsonify({
+            'operator': 'and',
+            'value': [{'column': 'age', 'value': 10, 'operator': '=='}]
+        })
+        with pytest.raises(ValueError):
+            compile_query(self.model, json, max_depth=1)
+
+    def test_batch(self):
+        self.add_user(age=10, name='pat')
+        self.add_user(age=20, name='sam')
+        self.add_user(age=30, name='pam')
+        jsons = [
+            jsonify({'column': 'age', 'value': 15, 'operator': '>'}),
+            jsonify({'column': 'name', 'value': 'nobody', 'operator': '=='}),
+            jsonify({'column': 'name', 'value': 'pa%', 'operator': 'like'}),
+            jsonify({'column': 'age', 'value': 15, 'operator': '>'}),
+        ]
+        results = jsonquery_batch(self.session, self.model, jsons)
+        assert [sorted(user.name for user in users) for users in results] == [
+            ['pam', 'sam'], [], ['pam', 'pat'], ['pam', 'sam']]
+        assert results[0] is not results[3]
+
+        counts = jsonquery_batch(self.session, self.model, jsons, count=True)
+        assert counts == [2, 0, 2, 2]
+        assert jsonquery_batch(self.session, self.model, []) == []
+
+    def test_batch_validates_each_query(self):
+        jsons = [
+            jsonify({'column': 'age', 'value': 15, 'operator': '>'}),
+            jsonify({'column': 'age', 'value': [1, 2], 'operator': 'in_'}),
+        ]
+        with pytest.raises(ValueError):
+            jsonquery_batch(self.session, self.model, jsons, max_breadth=1)
+
+    def test_batch_rejects_pages(self):
+        page = jsonify({'filter': {'column': 'age', 'value': 1,
+                                   'operator': '>'}, 'limit': 1})
+        with pytest.raises(ValueError):
+            jsonquery_batch(self.session, self.model, [page])
+
+    def test_stream_rejects_pages(self):
+        page = jsonify({'filter': {'column': 'age', 'value': 1,
+                                   'operator': '>'}, 'limit': 1})
+        for keyset in [False, True]:
+            with pytest.raises(ValueError):
+                list(jsonquery_stream(self.session, self.model, page,
+                                      keyset=keyset))
+
+    def test_stream(self):
+        for age in range(10):
+            self.add_user(age=age, name=str(age))
+        json = jsonify({'column': 'age', 'value': 3, 'operator': '>='})
+
+        users = list(jsonquery_stream(self.session, self.model, json,
+                                      chunk_size=2))
+        assert sorted(user.age for user in users) == list(range(3, 10))
+
+        rows = list(jsonquery_stream(self.session, self.model, json,
+                                     chunk_size=2, columns=['name', 'age']))
+        assert sorted(tuple(row) for row in rows) == [
+            (str(age), age) for age in range(3, 10)]
+        for column in ['missing', 'metadata', '__table__']:
+            with pytest.raises(ValueError):
+                list(jsonquery_stream(self.session, self.model, json,
+                                      columns=[column]))
+
+    def test_stream_keyset(self):
+        for age in range(10):
+            self.add_user(age=age, name=str(age))
+        json = jsonify({'column': 'age', 'value': 3, 'operator': '>='})
+
+        for chunk_size in [1, 3, 7, 100]:
+            users = list(jsonquery_stream(self.session, self.model, json,
+                                          chunk_size=chunk_size, keyset=True))
+            assert [user.age for user in users] == list(range(3, 10))
+
+        rows = list(jsonquery_stream(self.session, self.model, json,
+                                     chunk_size=3, columns=['name'],
+                                     keyset=True))
+        assert rows == [(str(age),) for age in range(3, 10)]
+
+    def pages(self, page):
+        pages = []
+        while True:
+            users = jsonquery(self.session, self.model, page).all()
+            if not users:
+                return pages
+            pages.append([(user.age, user.name) for user in users])
+            page['after'] = next_cursor(self.model, page, users[-1])
+
+    def test_page(self):
+        for age, name in [(1, 'a'), (2, 'b'), (2, 'c'), (3, 'd'), (4, 'e')]:
+            self.add_user(age=age, name=name)
+        page = jsonify({
+            'filter': {'column': 'age', 'value': 1, 'operator': '>'},
+            'order_by': ['-age'],
+            'limit': 2
+        })
+        assert self.pages(page) == [
+            [(4, 'e'), (3, 'd')], [(2, 'b'), (2, 'c')]]
+
+    def test_page_mixed_order(self):
+        for age, name in [(1, 'a'), (2, 'b'), (2, 'c'), (3, 'd'), (2, 'e')]:
+            self.add_user(age=age, name=name)
+        page = jsonify({'order_by': ['age', '-name'], 'limit': 2})
+        assert self.pages(page) == [
+            [(1, 'a'), (2, 'e')], [(2, 'c'), (2, 'b')], [(3, 'd')]]
+
+    def test_page_without_limit(self):
+        for age in [3, 1, 2]:
+            self.add_user(age=age)
+        users = jsonquery(self.session, self.model,
+                          jsonify({'order_by': ['age']})).all()
+        assert [user.age for user in users] == [1, 2, 3]
+
+    def test_page_invalid_cursor(self):
+        page = jsonify({'order_by': ['age'], 'after': 'garbage'})
+        with pytest.raises(ValueError):
+            jsonquery(self.session, self.model, page)
+        page['after'] = next_cursor(self.model, {}, self.model(id=1))
+        with pytest.raises(ValueError):
+            jsonquery(self.session, self.model, page)
+
+    def test_page_keys_validated(self):
+        self.add_user(age=20)
+        for page in [{}, {'column': 'age', 'op': '>', 'value': 10},
+                     {'filter': None, 'limits': 1}]:
+            with pytest.raises(ValueError):
+                jsonquery(self.session, self.model, jsonify(page))
+            with pytest.raises(ValueError):
+                jsonquery_count(self.session, self.model, jsonify(page))
+            with pytest.raises(ValueError):
+                parse_query(json.dumps(page))
+        for limit in [True, -1, 1.5]:
+            with pytest.raises(ValueError):
+                jsonquery(self.session, self.model, {'limit': limit})
+        assert jsonquery_count(self.session, self.model, {'limit': 1}) == 1
+
+    def test_page_order_by_validated(self):
+        for order_by in [['missing'], ['-missing'], [1]]:
+            with pytest.raises(ValueError):
+                jsonquery(self.session, self.model,
+                          jsonify({'order_by': order_by}))
+
+    def test_bulk_in(self):
+        for age in range(10):
+            self.add_user(age=age)
+        json = jsonify({
+            'column': 'age', 'value': list(range(0, 5000, 2)),
+            'operator': 'in_'})
+        for strategy in ['inline', 'expanding', 'chunked', 'temp_table']:
+            bulk_in = BulkIn(threshold=100, strategy=strategy)
+            users = jsonquery(self.session, self.model, json, bulk_in=bulk_in,
+                              max_breadth=None, max_elements=None)
+            assert sorted(user.age for user in users) == [0, 2, 4, 6, 8]
+        self.session.rollback()
+
+    def test_bulk_in_temp_tables_reused(self):
+        for age in range(10):
+            self.add_user(age=age, height=age * 10)
+        bulk_in = BulkIn(threshold=10, strategy='temp_table')
+        json = jsonify({'operator': 'and', 'value': [
+            {'column': 'age', 'value': list(range(0, 50, 2)),
+             'operator': 'in_'},
+            {'column': 'height', 'value': list(range(0, 500, 20)),
+             'operator': 'in_'}]})
+        count = sqlalchemy.text(
+            "SELECT count(*) FROM sqlite_temp_master WHERE type = 'table'")
+        for end in ['rollback', 'commit', 'commit', 'rollback', 'commit']:
+            users = jsonquery(self.session, self.model, json, bulk_in=bulk_in,
+                              max_breadth=None, max_elements=None)
+            assert sorted(user.age for user in users) == [0, 2, 4, 6, 8]
+            assert self.session.execute(count).scalar() == 2
+            getattr(self.session, end)()
+        assert self.session.execute(count).scalar() == 2
+
+    def test_bulk_in_validates_columns(self):
+        bulk_in = BulkIn(threshold=1, strategy='inline')
+        for registered in [False, True]:
+            if registered:
+                register_model(self.model)
+            try:
+                for column in ['nope', 'metadata']:
+                    json = jsonify({'column': column, 'value': [1, 2],
+                                    'operator': 'in_'})
+                    with pytest.raises(ValueError):
+                        jsonquery(self.session, self.model, json,
+                                  bulk_in=bulk_in)
+            finally:
+                if registered:
+                    unregister_model(self.model)
+
+    def test_bulk_in_choose(self):
+        bulk_in = BulkIn(threshold=10, temp_table_threshold=100)
+        assert bulk_in.choose(10) == 'literal'
+        assert bulk_in.choose(1000) == 'inline'
+        assert bulk_in.choose(50, self.session) == 'inline'
+        assert bulk_in.choose(1000, self.session) == 'temp_table'
+        with pytest.raises(ValueError):
+            BulkIn(strategy='unknown')
+
+    def test_count_exists(self):
+        for age in [10, 20, 30]:
+            self.add_user(age=age)
+        json = jsonify({'column': 'age', 'value': 15, 'operator': '>'})
+        assert jsonquery_count(self.session, self.model, json) == 2
+        assert jsonquery_exists(self.session, self.model, json)
+        json['value'] = 30
+        assert jsonquery_count(self.session, self.model, json) == 0
+        assert not jsonquery_exists(self.session, self.model, json)
+        page = jsonify({'order_by': ['age'], 'limit': 1})
+        assert jsonquery_count(self.session, self.model, page) == 3
+        assert jsonquery_exists(
+            self.session, self.model, {'operator': 'and', 'value': []})
+
+    def test_aggregate(self):
+        for name, age in [('a', 10), ('a', 20), ('b', 30), ('c', 5)]:
+            self.add_user(name=name, age=age)
+        json = jsonify({'column': 'age', 'value': 5, 'operator': '>'})
+        rows = jsonquery_aggregate(
+            self.session, self.model, json, group_by=['name'],
+            aggregates={'total': ['count'], 'oldest': ['max', 'age']})
+        assert sorted((row.name, row.total, row.oldest) for row in rows) == [
+            ('a', 2, 20), ('b', 1, 30)]
+        rows = jsonquery_aggregate(self.session, self.model, json,
+                                   aggregates={'sum': ['sum', 'age']})
+        assert rows[0].sum == 60
+        for aggregates in [{'x': ['len', 'age']}, {'x': ['max', 'query']},
+                           {'x': []}]:
+            with pytest.raises(ValueError):
+                jsonquery_aggregate(self.session, self.model, json,
+                                    aggregates=aggregates)
+
+
+def test_page_cursor_types():
+    Base = declarative_base()
+
+    class Event(Base):
+        __tablename__ = 'events'
+        id = Column(Uuid, primary_key=True)
+        at = Column(DateTime)
+        day = Column(Date)
+        price = Column(Numeric(10, 2))
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    start = datetime.datetime(2020, 1, 1, 12, 30)
+    for i in range(5):
+        session.add(Event(id=uuid.uuid4(), at=start + datetime.timedelta(
+            hours=i), day=datetime.date(2020, 1, 1 + i % 2),
+            price=decimal.Decimal('1.25') * (i % 3)))
+    session.commit()
+    expected = session.query(Event).order_by(Event.at).all()
+    for order_by in [['at'], ['-day', 'price'], ['price', '-at']]:
+        page = {'order_by': order_by, 'limit': 2}
+        rows = []
+        while True:
+            events = jsonquery(session, Event, page).all()
+            if not events:
+                break
+            rows.extend(events)
+            page['after'] = next_cursor(Event, page, events[-1])
+        assert sorted(rows, key=lambda event: event.at) == expected
+
+    class Value(object):
+        pass
+    with pytest.raises(ValueError):
+        next_cursor(Event, {'order_by': ['at']}, Event(id=Value(), at=Value()))
@@ -0,0 +1,180 @@
+import json
+import random
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from jsonquery import jsonquery, compile_predicate, optimize_query
+
+TRUE = {'operator': 'and', 'value': []}
+FALSE = {'operator': 'or', 'value': []}
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+def leaf(column, operator, value):
+    return {'column': column, 'operator': operator, 'value': value}
+
+
+@pytest.fixture()
+def user_setup(request):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        email = Column(String)
+        age = Column(Integer)
+        height = Column(Integer)
+    engine = create_engine("sqlite://", echo=True)
+    Base.metadata.create_all(engine)
+
+    request.cls.model = User
+    request.cls.engine = engine
+    request.cls.session = sessionmaker(bind=engine)()
+
+
+class TestOptimize():
+
+    def test_flatten(self):
+        json = jsonify({'operator': 'and', 'value': [
+            leaf('age', '>', 1),
+            {'operator': 'and', 'value': [
+                leaf('name', '==', 'a'), leaf('height', '!=', 2)]}
+        ]})
+        assert optimize_query(json) == {'operator': 'and', 'value': [
+            leaf('age', '>', 1), leaf('name', '==', 'a'),
+            leaf('height', '!=', 2)]}
+
+    def test_double_not(self):
+        json = jsonify({'operator': 'not', 'value': {
+            'operator': 'not', 'value': leaf('age', '>', 1)}})
+        assert optimize_query(json) == leaf('age', '>', 1)
+
+    def test_dedupe(self):
+        json = jsonify({'operator': 'or', 'value': [
+            {'operator': 'and', 'value': [
+                leaf('name', 'like', 'a%'), leaf('age', '!=', 3)]},
+            {'operator': 'and', 'value': [
+                leaf('age', '!=', 3), leaf('name', 'like', 'a%')]},
+        ]})
+        assert optimize_query(json) == {'operator': 'and', 'value': [
+            leaf('name', 'like', 'a%'), leaf('age', '!=', 3)]}
+
+    def test_merge_in(self):
+        json = jsonify({'operator': 'or', 'value': [
+            leaf('age', '==', 1), leaf('name', '==', 'a'),
+            leaf('age', 'in_', [2, 1]), leaf('age', '==', 3),
+            leaf('age', '==', None)]})
+        assert optimize_query(json) == {'operator': 'or', 'value': [
+            leaf('age', 'in_', [1, 2, 3]), leaf('name', '==', 'a'),
+            leaf('age', '==', None)]}
+
+    def test_merge_bounds(self):
+        json = jsonify({'operator': 'and', 'value': [
+            leaf('age', '>=', 1), leaf('age', '>', 3), leaf('age', '<', 10),
+            leaf('age', '<=', 10), leaf('height', '>=', 5),
+            leaf('height', '<=', 5)]})
+        assert optimize_query(json) == {'operator': 'and', 'value': [
+            leaf('age', '>', 3), leaf('age', '<', 10),
+            leaf('height', '==', 5)]}
+
+    def test_contradiction(self):
+        json = jsonify({'operator': 'and', 'value': [
+            leaf('age', '>', 5), leaf('age', '<', 3)]})
+        assert optimize_query(json) == FALSE
+        json = jsonify({'operator': 'and', 'value': [
+            leaf('age', '==', 5), leaf('age', '==', 6)]})
+        assert optimize_query(json) == FALSE
+
+    def test_contradiction_in_or(self):
+        json = jsonify({'operator': 'or', 'value': [
+            leaf('name', '==', 'a'),
+            {'operator': 'and', 'value': [
+                leaf('age', '>', 5), leaf('age', '<', 3)]}]})
+        assert optimize_query(json) == {'operator': 'or', 'value': [
+            leaf('name', '==', 'a')]}
+
+    def test_contradiction_under_not_is_kept(self):
+        '''not (age > 5 and age < 3) is unknown, not true, for NULL ages'''
+        contradiction = {'operator': 'and', 'value': [
+            leaf('age', '>', 5), leaf('age', '<', 3)]}
+        json = jsonify({'operator': 'not', 'value': contradiction})
+        assert optimize_query(json) == json
+
+    def test_strings_are_not_merged(self):
+        '''String ordering depends on the database collation'''
+        json = jsonify({'operator': 'and', 'value': [
+            leaf('name', '>', 'b'), leaf('name', '<', 'B')]})
+        assert optimize_query(json) == json
+
+    def test_constants(self):
+        json = jsonify({'operator': 'or', 'value': [
+            leaf('age', '==', 1),
+            {'operator': 'not', 'value': FALSE}]})
+        assert optimize_query(json) == TRUE
+        json = jsonify({'operator': 'and', 'value': [
+            leaf('age', '==', 1), TRUE]})
+        assert optimize_query(json) == leaf('age', '==', 1)
+
+    def test_constraints(self):
+        json = jsonify({'operator': 'and', 'value': [leaf('age', '==', 1)]})
+        with pytest.raises(ValueError):
+            optimize_query(json, max_elements=1)
+
+    def test_equivalent_to_original(self):
+        '''Random queries match the same rows before and after optimizing'''
+        rand = random.Random(0)
+        values = [None, 1, 2, 3]
+        rows = [{'age': a, 'height': h} for a in values for h in values]
+
+        def random_node(depth):
+            if depth > 3 or rand.random() < 0.3:
+                op = rand.choice(['<', '<=', '==', '!=', '>=', '>', 'in_'])
+                value = rand.choice(values)
+                if op == 'in_':
+                    value = rand.sample(values, 2)
+                return leaf(rand.choice(['age', 'height']), op, value)
+            op = rand.choice(['and', 'or', 'not'])
+            if op == 'not':
+                return {'operator': op, 'value': random_node(depth + 1)}
+            return {'operator': op, 'value': [
+                random_node(depth + 1) for _ in range(rand.randint(0, 4))]}
+
+        for _ in range(500):
+            json = random_node(0)
+            original = compile_predicate(json, max_elements=None)
+            optimized = compile_predicate(
+                json, optimize=True, max_elements=None)
+            for row in rows:
+                assert original.matches(row) == optimized.matches(row), json
+
+
+@pytest.mark.usefixtures("user_setup")
+class TestOptimizedQuery():
+
+    def test_jsonquery(self):
+        for age in [1, 5, 10, None]:
+            self.session.add(self.model(age=age))
+        self.session.commit()
+        json = jsonify({'operator': 'or', 'value': [
+            leaf('age', '==', 1), leaf('age', '==', 10),
+            {'operator': 'and', 'value': [
+                leaf('age', '>', 5), leaf('age', '<', 3)]}]})
+        users = jsonquery(self.session, self.model, json, optimize=True).all()
+        assert sorted(user.age for user in users) == [1, 10]
+
+    def test_false(self):
+        self.session.add(self.model(age=1))
+        self.session.commit()
+        json = jsonify({'operator': 'and', 'value': [
+            leaf('age', '>', 5), leaf('age', '<', 3)]})
+        query = jsonquery(self.session, self.model, json, optimize=True)
+        assert query.all() == []
+        json = jsonify({'operator': 'not', 'value': json})
+        query = jsonquery(self.session, self.model, json, optimize=True)
+        assert len(query.all()) == 1
@@ -0,0 +1,73 @@
+import json
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+from jsonquery import parallel_jsonquery
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    age = Column(Integer)
+
+
+QUERY = jsonify({'operator': 'or', 'value': [
+    {'column': 'age', 'value': 3, 'operator': '<'},
+    {'column': 'age', 'value': 1, 'operator': '>'}]})
+
+
+@pytest.fixture()
+def shards(tmpdir):
+    urls = []
+    for shard in range(2):
+        url = 'sqlite:///{}'.format(tmpdir.join('shard{}.db'.format(shard)))
+        engine = create_engine(url)
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add_all([User(name='{}-{}'.format(shard, age), age=age)
+                         for age in range(5)])
+        session.commit()
+        session.close()
+        engine.dispose()
+        urls.append(url)
+    return urls
+
+
+def names(users):
+    return sorted(user.name for user in users)
+
+
+def test_threads(shards):
+    factories = [sessionmaker(bind=create_engine(url)) for url in shards]
+    users = parallel_jsonquery(factories, User, QUERY)
+    assert len(users) == 10
+    assert names(users) == names(parallel_jsonquery(
+        factories, User, QUERY, split_or=False))
+    users = parallel_jsonquery(factories, User, jsonify(
+        {'column': 'age', 'value': 4, 'operator': '=='}))
+    assert names(users) == ['0-4', '1-4']
+
+
+def test_processes(shards):
+    with ProcessPoolExecutor(2) as executor:
+        users = parallel_jsonquery(shards, User, QUERY, executor=executor)
+    assert names(users) == names(
+        parallel_jsonquery(shards, User, QUERY, max_workers=1))
+    assert len(users) == 10
+
+
+def test_validated(shards):
+    with pytest.raises(ValueError):
+        parallel_jsonquery(shards, User, QUERY, max_elements=2)
+    with pytest.raises(ValueError):
+        parallel_jsonquery(shards, User, {'filter': QUERY})
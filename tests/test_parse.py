@@ -0,0 +1,151 @@
+import io
+import json
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from jsonquery import jsonquery_raw, parse_query
+
+QUERY = {
+    'operator': 'and',
+    'value': [
+        {'column': 'name', 'operator': 'like', 'value': 'pät%'},
+        {'column': 'age', 'operator': 'in_', 'value': [1, -2.5, 3e2]},
+        {'operator': 'not', 'value': {
+            'column': 'email', 'operator': '==', 'value': None}},
+        {'column': 'height', 'operator': '!=', 'value': True},
+    ]
+}
+
+
+class Reader(object):
+    '''File-like object over a generator of chunks, counting reads'''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.reads = 0
+
+    def read(self, size):
+        self.reads += 1
+        return next(self.chunks, b'')
+
+
+def stream(text, chunk_size):
+    data = text.encode('utf-8')
+    return io.BytesIO(data), chunk_size
+
+
+class TestParse():
+
+    def test_bytes_and_str(self):
+        text = json.dumps(QUERY)
+        assert parse_query(text) == QUERY
+        assert parse_query(text.encode('utf-8')) == QUERY
+
+    def test_stream(self):
+        text = json.dumps(QUERY, indent=4)
+        for chunk_size in [1, 2, 3, 7, 100]:
+            data = io.BytesIO(text.encode('utf-8'))
+            assert parse_query(data, chunk_size=chunk_size) == QUERY
+        assert parse_query(io.StringIO(text), chunk_size=5) == QUERY
+
+    def test_every_chunk_size(self):
+        text = json.dumps({'operator': 'or', 'value': [
+            {'column': 'age', 'operator': 'in_',
+             'value': [12345.5, 1234e5, -0.00025, 123456789, True, None]},
+            {'column': 'height', 'operator': '>=', 'value': 1.5e-10},
+            {'column': 'name', 'operator': '!=', 'value': False},
+            {'column': 'name', 'operator': 'in_',
+             'value': ['a"b', 'c\\', '\\"d\\\\"', 'e\u00e9"\n' * 5]}]})
+        expected = json.loads(text)
+        for chunk_size in range(1, len(text) + 1):
+            assert parse_query(io.StringIO(text),
+                               chunk_size=chunk_size) == expected
+            data = io.BytesIO(text.encode('utf-8'))
+            assert parse_query(data, chunk_size=chunk_size) == expected
+
+    def test_stream_page(self):
+        page = {'filter': QUERY, 'order_by': ['-age'], 'limit': 10}
+        data = io.BytesIO(json.dumps(page).encode('utf-8'))
+        assert parse_query(data, chunk_size=4) == page
+
+    def test_invalid(self):
+        for text in ['', '{', '{"a" 1}', '{"a": 1,}', '[1]', '{"a": tru}',
+                     '{"a": 1} 2', '{"a": "\\x"}', '{"a": 01}']:
+            with pytest.raises(ValueError):
+                parse_query(io.BytesIO(text.encode('utf-8')), chunk_size=2)
+            with pytest.raises(ValueError):
+                parse_query(text)
+
+    def test_constraints(self):
+        text = json.dumps(QUERY)
+        for constraints in [{'max_elements': 6}, {'max_depth': 2},
+                            {'max_breadth': 3}]:
+            with pytest.raises(ValueError):
+                parse_query(text, **constraints)
+            with pytest.raises(ValueError):
+                parse_query(io.StringIO(text), **constraints)
+        parse_query(io.StringIO(text), max_elements=10, max_depth=3,
+                    max_breadth=4)
+
+    def test_max_bytes(self):
+        text = json.dumps(QUERY)
+        with pytest.raises(ValueError):
+            parse_query(text, max_bytes=10)
+        with pytest.raises(ValueError):
+            parse_query(io.StringIO(text), max_bytes=10, chunk_size=4)
+
+    def test_rejects_early(self):
+        '''An oversized query is rejected without reading all of it'''
+        def chunks():
+            yield b'{"operator": "or", "value": ['
+            for i in range(100000):
+                yield b'{"column": "age", "operator": "==", "value": 1},'
+            yield b'{"column": "age", "operator": "==", "value": 1}]}'
+        reader = Reader(chunks())
+        with pytest.raises(ValueError):
+            parse_query(reader, max_elements=64)
+        assert reader.reads < 100
+
+        def values():
+            yield b'{"column": "age", "operator": "in_", "value": ['
+            for i in range(100000):
+                yield b'1,'
+            yield b'1]}'
+        reader = Reader(values())
+        with pytest.raises(ValueError):
+            parse_query(reader, max_elements=64)
+        assert reader.reads < 100
+
+
+@pytest.fixture()
+def user_setup(request):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        email = Column(String)
+        age = Column(Integer)
+        height = Column(Integer)
+    engine = create_engine("sqlite://", echo=True)
+    Base.metadata.create_all(engine)
+
+    request.cls.model = User
+    request.cls.engine = engine
+    request.cls.session = sessionmaker(bind=engine)()
+
+
+@pytest.mark.usefixtures("user_setup")
+class TestRawQuery():
+
+    def test_jsonquery_raw(self):
+        self.session.add_all([self.model(age=10), self.model(age=20)])
+        self.session.commit()
+        data = io.BytesIO(b'{"column": "age", "operator": ">", "value": 15}')
+        user = jsonquery_raw(self.session, self.model, data).one()
+        assert user.age == 20
+        with pytest.raises(ValueError):
+            jsonquery_raw(self.session, self.model,
+                          b'{"operator": "and", "value": []}', max_breadth=-1,
+                          max_elements=0, max_depth=0)
@@ -0,0 +1,124 @@
+import json
+import warnings
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from jsonquery import (
+    jsonquery, compile_predicate, explain_query, plan_query,
+    NonSargableWarning)
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+def leaf(column, operator, value):
+    return {'column': column, 'operator': operator, 'value': value}
+
+
+@pytest.fixture()
+def user_setup(request):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        email = Column(String, unique=True)
+        age = Column(Integer, index=True)
+        height = Column(Integer)
+    engine = create_engine("sqlite://", echo=True)
+    Base.metadata.create_all(engine)
+
+    request.cls.model = User
+    request.cls.session = sessionmaker(bind=engine)()
+
+
+@pytest.mark.usefixtures("user_setup")
+class TestPlan():
+
+    def plan(self, json):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NonSargableWarning)
+            return plan_query(self.model, jsonify(json))
+
+    def test_order(self):
+        json = {'operator': 'and', 'value': [
+            leaf('name', 'like', '%at'),
+            leaf('height', '>', 10),
+            leaf('height', '==', 10),
+            leaf('age', '>', 10),
+            leaf('age', '==', 10),
+            leaf('email', '==', 'pat@example.com'),
+            leaf('id', 'in_', [1, 2]),
+        ]}
+        planned = self.plan(json)
+        assert planned['value'] == [
+            json['value'][index] for index in [5, 6, 4, 3, 2, 1, 0]]
+
+    def test_logical_rank(self):
+        json = {'operator': 'or', 'value': [
+            {'operator': 'and', 'value': [
+                leaf('height', '>', 1), leaf('id', '==', 1)]},
+            {'operator': 'or', 'value': [
+                leaf('age', '==', 1), leaf('height', '>', 1)]},
+            leaf('age', '<', 4),
+        ]}
+        planned = self.plan(json)
+        assert planned['value'][0] == {'operator': 'and', 'value': [
+            leaf('id', '==', 1), leaf('height', '>', 1)]}
+        assert planned['value'][1] == leaf('age', '<', 4)
+
+    def test_not_inverted(self):
+        json = {'operator': 'not', 'value': leaf('age', '<', 10)}
+        assert self.plan(json) == leaf('age', '>=', 10)
+        json = {'operator': 'not', 'value': leaf('name', 'like', 'p%')}
+        assert self.plan(json) == json
+
+    def test_same_rows(self):
+        for age, height in [(1, None), (None, 5), (10, 10), (20, 1)]:
+            self.session.add(self.model(age=age, height=height))
+        self.session.commit()
+        json = jsonify({'operator': 'or', 'value': [
+            {'operator': 'not', 'value': leaf('age', '<', 10)},
+            {'operator': 'and', 'value': [
+                leaf('height', '>', 2), leaf('id', '>', 1)]}]})
+        expected = set(jsonquery(self.session, self.model, json))
+        assert len(expected) == 3
+        assert set(jsonquery(
+            self.session, self.model, json, plan=True)) == expected
+        predicate = compile_predicate(self.plan(json))
+        assert set(predicate.filter(self.session.query(self.model))) == \
+            expected
+
+    def test_planned_constraints(self):
+        # Moving the in_ after the 14 primary key ranges would count 66
+        # elements; the json is only checked as it was written
+        json = jsonify({'operator': 'and', 'value': [
+            leaf('height', 'in_', list(range(50)))] + [
+            leaf('id', '>', i) for i in range(14)]})
+        assert self.plan(json)['value'][-1]['column'] == 'height'
+        assert jsonquery(self.session, self.model, json, plan=True).all() \
+            == []
+        explain_query(self.session, self.model, json)
+        json['value'][0]['value'] = list(range(63))
+        with pytest.raises(ValueError):
+            jsonquery(self.session, self.model, json, plan=True)
+
+    def test_leading_wildcard_warns(self):
+        with pytest.warns(NonSargableWarning):
+            plan_query(self.model, leaf('name', 'like', '%at'))
+
+    def test_explain(self):
+        json = jsonify({'operator': 'and', 'value': [
+            leaf('name', 'like', '%at'), leaf('age', '==', 10)]})
+        report = explain_query(self.session, self.model, json)
+        assert report['json']['value'][0] == leaf('age', '==', 10)
+        assert len(report['warnings']) == 1
+        assert 'users.age = 10' in report['sql']
+        assert any('ix_users_age' in str(row) for row in report['plan'])
+        report = explain_query(self.session, self.model, jsonify(
+            {'filter': leaf('id', '==', 1), 'order_by': ['age'], 'limit': 1}))
+        assert 'LIMIT 1' in report['sql']
@@ -0,0 +1,124 @@
+import json
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from jsonquery import jsonquery, compile_predicate
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+@pytest.fixture()
+def user_setup(request):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        email = Column(String)
+        age = Column(Integer)
+        height = Column(Integer)
+    engine = create_engine("sqlite://", echo=True)
+    Base.metadata.create_all(engine)
+
+    request.cls.model = User
+    request.cls.engine = engine
+    request.cls.session = sessionmaker(bind=engine)()
+
+
+@pytest.mark.usefixtures("user_setup")
+class TestPredicate():
+
+    def setup_method(self, method):
+        self.rows = [
+            {'name': 'pat', 'age': 10, 'height': 150},
+            {'name': 'patrick', 'age': 21, 'height': None},
+            {'name': 'sam', 'age': None, 'height': 180},
+            {'name': None, 'age': 30, 'height': 170},
+        ]
+
+    def assert_same_as_sql(self, json):
+        '''The predicate must match exactly the rows the database matches'''
+        json = jsonify(json)
+        for row in self.rows:
+            self.session.add(self.model(**row))
+        self.session.commit()
+
+        expected = set(user.name for user in
+                       jsonquery(self.session, self.model, json).all())
+        predicate = compile_predicate(json)
+        assert expected == set(row['name'] for row in
+                               predicate.filter(self.rows))
+        users = self.session.query(self.model).all()
+        assert expected == set(user.name for user in users
+                               if predicate.matches(user))
+
+    def test_binops(self):
+        for op in ['<', '<=', '==', '!=', '>=', '>']:
+            self.session.query(self.model).delete()
+            self.assert_same_as_sql(
+                {'column': 'age', 'value': 21, 'operator': op})
+
+    def test_null(self):
+        self.assert_same_as_sql(
+            {'column': 'age', 'value': None, 'operator': '=='})
+
+    def test_not_null(self):
+        self.assert_same_as_sql(
+            {'column': 'age', 'value': None, 'operator': '!='})
+
+    def test_like(self):
+        self.assert_same_as_sql(
+            {'column': 'name', 'value': 'pat%', 'operator': 'like'})
+
+    def test_like_single_character(self):
+        self.assert_same_as_sql(
+            {'column': 'name', 'value': '_a_', 'operator': 'like'})
+
+    def test_ilike(self):
+        self.assert_same_as_sql(
+            {'column': 'name', 'value': '%A%', 'operator': 'ilike'})
+
+    def test_in(self):
+        self.assert_same_as_sql(
+            {'column': 'age', 'value': [10, 30], 'operator': 'in_'})
+
+    def test_not_with_nulls(self):
+        self.assert_same_as_sql({
+            'operator': 'not',
+            'value': {
+                'operator': 'or',
+                'value': [
+                    {'column': 'age', 'value': 20, 'operator': '>'},
+                    {'column': 'height', 'value': 160, 'operator': '<'}
+                ]
+            }
+        })
+
+    def test_and(self):
+        self.assert_same_as_sql({
+            'operator': 'and',
+            'value': [
+                {'column': 'name', 'value': 'pat%', 'operator': 'like'},
+                {'column': 'height', 'value': 200, 'operator': '<'}
+            ]
+        })
+
+    def test_constraints(self):
+        json = jsonify({
+            'operator': 'and',
+            'value': [{'column': 'age', 'value': 10, 'operator': '=='}]
+        })
+        with pytest.raises(ValueError):
+            compile_predicate(json, max_elements=1)
+
+    def test_custom_getter(self):
+        json = jsonify({'column': 'age', 'value': 10, 'operator': '=='})
+        predicate = compile_predicate(
+            json, getter=lambda obj, column: obj[1])
+        assert predicate(('pat', 10))
+        assert not predicate(('sam', 11))
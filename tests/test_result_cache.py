@@ -0,0 +1,133 @@
+import json
+import time
+import pytest
+import sqlalchemy
+from sqlalchemy import Column, ForeignKey, Integer, String, create_engine
+from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from jsonquery import LocalStore, ResultCache
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+QUERY = jsonify({'column': 'age', 'value': 10, 'operator': '>'})
+
+
+@pytest.fixture()
+def user_setup(request):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        age = Column(Integer)
+        orders = relationship('Order')
+
+    class Order(Base):
+        __tablename__ = 'orders'
+        id = Column(Integer, primary_key=True)
+        total = Column(Integer)
+        user_id = Column(Integer, ForeignKey('users.id'))
+    engine = create_engine("sqlite://", echo=True)
+    Base.metadata.create_all(engine)
+
+    Session = sessionmaker(bind=engine)
+    cache = ResultCache()
+    cache.bind(Session)
+    session = Session()
+    session.add_all([User(name='pat', age=20, orders=[Order(total=5)]),
+                     User(name='sam', age=5)])
+    session.commit()
+
+    request.cls.User = User
+    request.cls.Order = Order
+    request.cls.Session = Session
+    request.cls.session = session
+    request.cls.cache = cache
+
+
+@pytest.mark.usefixtures("user_setup")
+class TestResultCache():
+
+    def names(self, json, session=None):
+        users = self.cache.query(session or self.Session(), self.User, json)
+        return sorted(user.name for user in users)
+
+    def test_hits(self):
+        assert self.names(QUERY) == ['pat']
+        assert self.names(QUERY) == ['pat']
+        assert self.names(jsonify(
+            {'column': 'age', 'value': 1, 'operator': '>'})) == ['pat', 'sam']
+        assert (self.cache.hits, self.cache.misses) == (1, 2)
+
+    def test_merged_into_session(self):
+        self.names(QUERY)
+        session = self.Session()
+        users = self.cache.query(session, self.User, QUERY)
+        assert users[0] in session
+        assert not session.dirty
+        assert users[0].name == 'pat'
+
+    def test_invalidated_by_commit(self):
+        assert self.names(QUERY) == ['pat']
+        other = self.Session()
+        other.query(self.User).filter_by(name='sam').one().age = 30
+        other.flush()
+        assert self.names(QUERY, other) == ['pat', 'sam']
+        other.commit()
+        assert self.names(QUERY) == ['pat', 'sam']
+
+    def test_invalidated_by_rollback(self):
+        other = self.Session()
+        other.add(self.User(name='joe', age=40))
+        other.flush()
+        assert self.names(QUERY, other) == ['joe', 'pat']
+        other.rollback()
+        assert self.names(QUERY) == ['pat']
+
+    def test_related_tables(self):
+        json = jsonify({'column': 'orders.total', 'value': 1,
+                        'operator': '>'})
+        assert self.names(json) == ['pat']
+        self.session.add(self.Order(total=50, user_id=2))
+        self.session.commit()
+        assert self.names(json) == ['pat', 'sam']
+
+    def test_bulk_update(self):
+        assert self.names(QUERY) == ['pat']
+        session = self.Session()
+        session.execute(sqlalchemy.update(self.User).values(age=50))
+        session.commit()
+        assert self.names(QUERY) == ['pat', 'sam']
+
+    def test_invalidate(self):
+        assert self.names(QUERY) == ['pat']
+        with self.session.bind.begin() as connection:
+            connection.execute(sqlalchemy.update(self.User.__table__)
+                               .values(age=50))
+        assert self.names(QUERY) == ['pat']
+        self.cache.invalidate(self.User)
+        assert self.names(QUERY) == ['pat', 'sam']
+
+    def test_fields_in_key(self):
+        page = jsonify({'filter': QUERY, 'fields': ['name']})
+        assert self.names(page) == ['pat']
+        assert self.names(QUERY) == ['pat']
+        assert self.cache.misses == 2
+
+
+def test_local_store():
+    store = LocalStore(maxsize=2)
+    store.set('a', 1)
+    store.set('b', 2, ttl=0.01)
+    assert store.get('a') == 1
+    store.set('c', 3)
+    assert store.get('b') is None and store.evictions == 1
+    store.set('d', 4, ttl=0.001)
+    time.sleep(0.01)
+    assert store.get('d') is None
+    assert store.incr('n') == 1 and store.incr('n') == 2
@@ -0,0 +1,273 @@
+import json
+import pytest
+import sqlalchemy
+from sqlalchemy import Column, ForeignKey, Integer, String, create_engine
+from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from jsonquery import (
+    jsonquery, jsonquery_batch, jsonquery_stream, compile_query, plan_query,
+    QueryCache, register_model, register_operator, unregister_model,
+    unregister_operator)
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+@pytest.fixture()
+def order_setup(request):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        age = Column(Integer)
+        orders = relationship('Order', back_populates='user')
+
+    class Order(Base):
+        __tablename__ = 'orders'
+        id = Column(Integer, primary_key=True)
+        total = Column(Integer)
+        user_id = Column(Integer, ForeignKey('users.id'))
+        user = relationship('User', back_populates='orders')
+        items = relationship('Item', back_populates='order')
+
+    class Item(Base):
+        __tablename__ = 'items'
+        id = Column(Integer, primary_key=True)
+        price = Column(Integer)
+        order_id = Column(Integer, ForeignKey('orders.id'))
+        order = relationship('Order', back_populates='items')
+    engine = create_engine("sqlite://", echo=True)
+    Base.metadata.create_all(engine)
+
+    request.cls.User = User
+    request.cls.Order = Order
+    request.cls.Item = Item
+    request.cls.session = sessionmaker(bind=engine)()
+    register_model(User)
+    register_model(Order)
+    register_model(Item)
+    yield
+    unregister_model(User)
+    unregister_model(Order)
+    unregister_model(Item)
+
+
+@pytest.mark.usefixtures("order_setup")
+class TestSchema():
+
+    def setup_users(self):
+        pat = self.User(name='pat', age=10, orders=[
+            self.Order(total=5, items=[
+                self.Item(price=2), self.Item(price=3)]),
+            self.Order(total=50, items=[self.Item(price=50)])])
+        sam = self.User(name='sam', age=20, orders=[self.Order(total=7)])
+        self.session.add_all([pat, sam, self.User(name='joe', age=30)])
+        self.session.commit()
+
+    def names(self, json):
+        users = jsonquery(self.session, self.User, jsonify(json)).all()
+        return sorted(user.name for user in users)
+
+    def test_columns(self):
+        self.setup_users()
+        assert self.names(
+            {'column': 'age', 'value': 20, 'operator': '>='}) == ['joe', 'sam']
+        assert self.names(
+            {'column': 'name', 'value': 'pat', 'operator': 'like'}) == ['pat']
+
+    def test_unknown_column(self):
+        with pytest.raises(ValueError):
+            self.names({'column': 'missing', 'value': 1, 'operator': '=='})
+
+    def test_operator_type(self):
+        with pytest.raises(ValueError):
+            self.names({'column': 'age', 'value': '1%', 'operator': 'like'})
+        with pytest.raises(ValueError):
+            self.names({'column': 'age', 'value': 1, 'operator': 'missing'})
+
+    def test_operator_tables(self):
+        schema = register_model(self.User)
+        assert 'like' in schema.operators['name']
+        assert 'like' not in schema.operators['age']
+        assert '>=' in schema.operators['orders.total']
+
+    def test_register_operator_refreshes(self):
+        self.setup_users()
+        json = {'column': 'age', 'value': 10, 'operator': 'is_not'}
+        register_operator('is_not', lambda column, value: column != value)
+        try:
+            assert self.names(json) == ['joe', 'sam']
+        finally:
+            unregister_operator('is_not')
+        with pytest.raises(ValueError):
+            self.names(json)
+
+    def test_one_to_many(self):
+        self.setup_users()
+        assert self.names({
+            'column': 'orders.total', 'value': 6, 'operator': '>'
+        }) == ['pat', 'sam']
+        assert self.names({
+            'operator': 'not',
+            'value': {'column': 'orders.total', 'value': 10, 'operator': '<'}
+        }) == ['joe']
+
+    def test_many_to_one(self):
+        self.setup_users()
+        orders = jsonquery(self.session, self.Order, jsonify({
+            'column': 'user.name', 'value': 'pat', 'operator': '=='
+        })).all()
+        assert sorted(order.total for order in orders) == [5, 50]
+
+    def test_paths(self):
+        self.setup_users()
+        assert self.names({
+            'column': 'orders.items.price', 'value': 40, 'operator': '>'
+        }) == ['pat']
+        items = jsonquery(self.session, self.Item, jsonify({
+            'operator': 'and', 'value': [
+                {'column': 'order.user.name', 'value': 'pat',
+                 'operator': '=='},
+                {'column': 'order.total', 'value': 10, 'operator': '<'}]
+        })).all()
+        assert sorted(item.price for item in items) == [2, 3]
+        items = jsonquery(self.session, self.Item, jsonify({
+            'column': 'order.user.orders.total', 'value': 50, 'operator': '=='
+        })).all()
+        assert len(items) == 3
+        unregister_model(self.Item)
+        try:
+            assert jsonquery(self.session, self.Item, jsonify({
+                'column': 'order.user.age', 'value': 10, 'operator': '=='
+            })).count() == 3
+        finally:
+            register_model(self.Item)
+
+    def test_path_joins_shared(self):
+        json = jsonify({'operator': 'or', 'value': [
+            {'column': 'order.user.name', 'value': 'pat', 'operator': '=='},
+            {'column': 'order.user.age', 'value': 10, 'operator': '>'},
+            {'column': 'order.total', 'value': 10, 'operator': '<'}]})
+        sql = str(jsonquery(self.session, self.Item, json))
+        assert sql.count('JOIN') == 2
+        assert 'EXISTS' not in sql
+
+    def test_path_entry_points(self):
+        self.session.add_all([
+            self.Order(total=1, user=self.User(name='pat', age=10)),
+            self.Order(total=2),
+            self.Order(total=3, user=self.User(name='sam'))])
+        self.session.commit()
+
+        def user_age(operator, value):
+            return {'column': 'user.age', 'value': value, 'operator': operator}
+        queries = [
+            user_age('>', 5),
+            {'operator': 'not', 'value': user_age('>', 5)},
+            user_age('==', None),
+            user_age('!=', None),
+            {'operator': 'or', 'value': [
+                user_age('in_', [10, 20]), {'operator': 'not', 'value':
+                                            user_age('<', 50)}]},
+            {'operator': 'and', 'value': [
+                user_age('==', None),
+                {'column': 'user.name', 'value': 's%', 'operator': 'like'}]},
+        ]
+        for query in queries:
+            json = jsonify(query)
+
+            def totals(orders):
+                return sorted(order.total for order in orders)
+            expected = totals(jsonquery(self.session, self.Order, json))
+            assert totals(jsonquery(self.session, self.Order, json,
+                                    cache=QueryCache())) == expected
+            assert totals(compile_query(self.Order, json).query(
+                self.session)) == expected
+            assert totals(jsonquery_batch(
+                self.session, self.Order, [json])[0]) == expected
+            assert totals(jsonquery_stream(
+                self.session, self.Order, json)) == expected
+        assert self.session.query(self.Order).count() == 3
+        assert totals(jsonquery(self.session, self.Order, jsonify(
+            {'operator': 'not', 'value': user_age('>', 5)}))) == [2, 3]
+        assert totals(jsonquery(self.session, self.Order, jsonify(
+            user_age('==', None)))) == [3]
+
+    def test_path_exists_merged(self):
+        self.setup_users()
+        json = jsonify({'operator': 'or', 'value': [
+            {'column': 'orders.total', 'value': 5, 'operator': '=='},
+            {'column': 'orders.items.price', 'value': 50, 'operator': '=='},
+            {'column': 'orders.total', 'value': 7, 'operator': '=='}]})
+        assert str(jsonquery(self.session, self.User, json)).count(
+            'EXISTS') == 2
+        assert self.names(json) == ['pat', 'sam']
+        # Different orders can match each side of an and
+        json = jsonify({'operator': 'and', 'value': [
+            {'column': 'orders.total', 'value': 5, 'operator': '=='},
+            {'column': 'orders.total', 'value': 50, 'operator': '=='}]})
+        assert str(jsonquery(self.session, self.User, json)).count(
+            'EXISTS') == 2
+        assert self.names(json) == ['pat']
+
+    def test_path_bounds_not_merged(self):
+        self.setup_users()
+        for query in [
+            {'operator': 'and', 'value': [
+                {'column': 'orders.total', 'value': 40, 'operator': '>'},
+                {'column': 'orders.total', 'value': 6, 'operator': '<'}]},
+            {'operator': 'and', 'value': [
+                {'column': 'orders.total', 'value': 50, 'operator': '>='},
+                {'column': 'orders.total', 'value': 5, 'operator': '<='}]}]:
+            assert self.names(query) == ['pat']
+            users = jsonquery(self.session, self.User, jsonify(query),
+                              optimize=True)
+            assert sorted(user.name for user in users) == ['pat']
+
+    def test_path_not_planned(self):
+        self.setup_users()
+        json = jsonify({'operator': 'not', 'value': {
+            'column': 'orders.total', 'value': 6, 'operator': '<'}})
+        assert self.names(json) == ['joe', 'sam']
+        assert plan_query(self.User, json) == json
+        users = jsonquery(self.session, self.User, json, plan=True)
+        assert sorted(user.name for user in users) == ['joe', 'sam']
+        json = jsonify({'operator': 'and', 'value': [
+            {'column': 'orders.total', 'value': 5, 'operator': '=='},
+            {'column': 'name', 'value': 'pat', 'operator': '=='}]})
+        assert plan_query(self.User, json)['value'] == json['value'][::-1]
+
+    def test_path_validated(self):
+        for column in ['orders.missing', 'missing.total',
+                       'orders.user.orders.user.name']:
+            with pytest.raises(ValueError):
+                self.names({'column': column, 'value': 1, 'operator': '=='})
+
+    def test_page_fields(self):
+        self.setup_users()
+        self.session.expunge_all()
+        users = jsonquery(self.session, self.User, jsonify(
+            {'fields': ['name'], 'load': {'orders': 'selectin'}})).all()
+        assert sqlalchemy.inspect(users[0]).unloaded == set(['age'])
+        self.session.expunge_all()
+        users = jsonquery(self.session, self.User, jsonify(
+            {'fields': ['name'], 'order_by': ['-age']})).all()
+        assert [user.name for user in users] == ['joe', 'sam', 'pat']
+        assert sqlalchemy.inspect(users[0]).unloaded == set(['orders'])
+        self.session.expunge_all()
+        users = jsonquery(self.session, self.User, jsonify(
+            {'defer': ['age'], 'load': {'orders': 'raise'}})).all()
+        assert 'age' in sqlalchemy.inspect(users[0]).unloaded
+        with pytest.raises(sqlalchemy.exc.InvalidRequestError):
+            users[0].orders
+
+    def test_page_fields_validated(self):
+        for page in [{'fields': ['missing']}, {'defer': ['orders']},
+                     {'load': {'name': 'joined'}},
+                     {'load': {'orders': 'eager'}}]:
+            with pytest.raises(ValueError):
+                jsonquery(self.session, self.User, jsonify(page))
@@ -0,0 +1,123 @@
+import decimal
+import random
+from jsonquery import SubscriptionManager, compile_predicate
+
+
+def leaf(column, operator, value):
+    return {'column': column, 'operator': operator, 'value': value}
+
+
+def test_enter_and_leave():
+    manager = SubscriptionManager()
+    manager.subscribe('adults', leaf('age', '>=', 18))
+    manager.subscribe('pats', leaf('name', '==', 'pat'))
+    change = manager.insert({'id': 1, 'age': 20, 'name': 'sam'})
+    assert change == (set(['adults']), set())
+    change = manager.update({'id': 1, 'age': 20, 'name': 'pat'})
+    assert change == (set(['pats']), set())
+    change = manager.update({'id': 1, 'age': None, 'name': 'pat'})
+    assert change == (set(), set(['adults']))
+    assert manager.delete({'id': 1}) == (set(), set(['pats']))
+    assert manager.delete({'id': 1}) == (set(), set())
+
+
+def test_candidates():
+    manager = SubscriptionManager()
+    for name in ['pat', 'sam', 'joe']:
+        manager.subscribe(name, {'operator': 'and', 'value': [
+            leaf('age', '>', 10), leaf('name', '==', name)]})
+    manager.subscribe('young', leaf('age', '<', 10))
+    manager.subscribe('in', leaf('height', 'in_', [150, 160]))
+    manager.subscribe('either', {'operator': 'or', 'value': [
+        leaf('name', '==', 'sue'), leaf('age', '>', 50)]})
+    manager.subscribe('not', {'operator': 'not', 'value': leaf(
+        'name', '==', 'pat')})
+    assert manager._candidates({'name': 'pat', 'age': 5}) == set(
+        ['pat', 'young', 'not'])
+    assert manager._candidates({'name': 'sue', 'height': 160}) == set(
+        ['either', 'in', 'not'])
+    assert manager._candidates({'age': 60}) == set(['either', 'not'])
+    assert manager.matches({'name': 'pat', 'age': 11}) == set(['pat'])
+
+
+def test_unsubscribe():
+    manager = SubscriptionManager()
+    manager.subscribe('a', leaf('age', '>', 1))
+    manager.subscribe('b', leaf('age', '>', 1))
+    manager.insert({'id': 1, 'age': 5})
+    manager.unsubscribe('a')
+    assert 'a' not in manager and len(manager) == 1
+    assert manager.delete({'id': 1}) == (set(), set(['b']))
+    manager.subscribe('b', leaf('age', '<', 1))
+    assert manager.matches({'age': 5}) == set()
+
+
+def test_duplicate_terms():
+    manager = SubscriptionManager()
+    manager.subscribe('in', leaf('x', 'in_', [1, 1]))
+    manager.subscribe('or', {'operator': 'or', 'value': [
+        leaf('x', '==', 1), {'operator': 'and', 'value': [
+            leaf('x', '==', 1), leaf('y', '==', 2)]},
+        leaf('z', '>', 1), leaf('z', '>=', 1)]})
+    assert manager.matches({'x': 1}) == set(['in', 'or'])
+    manager.subscribe('in', leaf('x', 'in_', [2, 2]))
+    manager.unsubscribe('or')
+    assert manager.matches({'x': 1, 'z': 5}) == set()
+    assert manager.matches({'x': 2}) == set(['in'])
+    manager.unsubscribe('in')
+    assert len(manager) == 0
+
+
+def test_decimal_values():
+    manager = SubscriptionManager()
+    manager.subscribe('pricey', leaf('price', '>', 5))
+    manager.subscribe('cheap', leaf('price', '<=', 5.5))
+    manager.subscribe('ten', leaf('price', '==', 10))
+    row = {'id': 1, 'price': decimal.Decimal('10')}
+    assert compile_predicate(leaf('price', '>', 5)).matches(row)
+    assert manager.insert(row) == (set(['pricey', 'ten']), set())
+    row = {'id': 1, 'price': decimal.Decimal('4.5')}
+    assert manager.update(row) == (set(['cheap']), set(['pricey', 'ten']))
+    assert manager.matches({'price': complex(1, 1)}) == set()
+
+
+def test_same_as_predicates():
+    rand = random.Random(0)
+    columns = ['age', 'height']
+
+    def random_json(depth=0):
+        if depth < 2 and rand.random() < 0.4:
+            op = rand.choice(['and', 'or', 'not'])
+            if op == 'not':
+                return {'operator': op, 'value': random_json(depth + 1)}
+            return {'operator': op, 'value': [
+                random_json(depth + 1) for _ in range(rand.randint(0, 3))]}
+        op = rand.choice(['==', '<', '<=', '>', '>=', '!=', 'in_'])
+        if op == 'in_':
+            value = [rand.randint(0, 5) for _ in range(rand.randint(0, 3))]
+        else:
+            value = rand.choice([0, 1, 2, 3, 4, 5, None])
+        return leaf(rand.choice(columns), op, value)
+
+    manager = SubscriptionManager()
+    predicates = {}
+    for key in range(200):
+        json = random_json()
+        manager.subscribe(key, json)
+        predicates[key] = compile_predicate(json)
+
+    matches = {}
+    for _ in range(500):
+        row = {'id': rand.randint(0, 20)}
+        for column in columns:
+            row[column] = rand.choice([0, 1, 2, 3, 4, 5, None])
+        before = matches.get(row['id'], set())
+        if rand.random() < 0.2:
+            after = set()
+            change = manager.delete(row)
+        else:
+            after = set(key for key, predicate in predicates.items()
+                        if predicate.matches(row))
+            change = manager.update(row)
+        matches[row['id']] = after
+        assert change == (after - before, before - after)
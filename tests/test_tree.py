@@ -0,0 +1,135 @@
+import json
+import random
+import tracemalloc
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from jsonquery import (
+    jsonquery, compile_predicate, optimize_query, parse_tree, QueryCache,
+    QueryTree)
+
+
+def jsonify(dict):
+    # Easy validation that the test data isn't invalid json
+    return json.loads(json.dumps(dict))
+
+
+def leaf(column, operator, value):
+    return {'column': column, 'operator': operator, 'value': value}
+
+
+QUERY = jsonify({'operator': 'or', 'value': [
+    {'operator': 'and', 'value': [
+        leaf('age', '>=', 10), leaf('name', 'like', 'p%')]},
+    {'operator': 'not', 'value': leaf('age', 'in_', [1, 2, 3])}]})
+
+
+def random_json(rand, depth=0):
+    if depth < 4 and rand.random() < 0.5:
+        op = rand.choice(['and', 'or', 'not'])
+        if op == 'not':
+            return {'operator': op, 'value': random_json(rand, depth + 1)}
+        return {'operator': op, 'value': [
+            random_json(rand, depth + 1) for _ in range(rand.randint(0, 4))]}
+    value = rand.choice([1, 'a', [1, 2], list(range(rand.randint(0, 6)))])
+    return leaf('age', '==', value)
+
+
+@pytest.fixture()
+def user_setup(request):
+    Base = declarative_base()
+
+    class User(Base):
+        __tablename__ = 'users'
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        age = Column(Integer)
+    engine = create_engine("sqlite://", echo=True)
+    Base.metadata.create_all(engine)
+
+    request.cls.model = User
+    request.cls.session = sessionmaker(bind=engine)()
+
+
+@pytest.mark.usefixtures("user_setup")
+class TestTree():
+
+    def test_query(self):
+        for name, age in [('pat', 10), ('sam', 2), ('pete', 3)]:
+            self.session.add(self.model(name=name, age=age))
+        self.session.commit()
+        tree = parse_tree(QUERY)
+        expected = jsonquery(self.session, self.model, QUERY)
+        actual = jsonquery(self.session, self.model, tree)
+        assert str(actual) == str(expected)
+        assert set(actual) == set(expected)
+        cache = QueryCache()
+        assert set(jsonquery(self.session, self.model, tree,
+                             cache=cache)) == set(expected)
+        page = {'filter': tree, 'order_by': ['age']}
+        assert [user.age for user in jsonquery(
+            self.session, self.model, page)] == [10]
+
+
+def test_round_trip():
+    tree = parse_tree(QUERY)
+    assert tree.to_json() == QUERY
+    assert len(tree) == 6
+    empty = {'operator': 'or', 'value': [{'operator': 'and', 'value': []}]}
+    assert parse_tree(empty).to_json() == empty
+    assert QueryTree.loads(tree.dumps()) == tree
+    assert hash(QueryTree.loads(tree.dumps())) == hash(tree)
+    assert len(set([tree, parse_tree(QUERY), QueryTree.loads(
+        tree.dumps())])) == 1
+    assert parse_tree(leaf('age', '==', 1)) != parse_tree(
+        leaf('age', '==', 2))
+    assert QueryTree.loads(tree.dumps()).to_json() == QUERY
+    assert optimize_query(tree) == optimize_query(QUERY)
+
+
+def test_predicate():
+    predicate = compile_predicate(parse_tree(QUERY))
+    assert predicate.matches({'age': 10, 'name': 'pat'})
+    assert not predicate.matches({'age': 2, 'name': 'pat'})
+
+
+def test_constraints_match_json():
+    rand = random.Random(0)
+    for _ in range(300):
+        json = random_json(rand)
+        tree = parse_tree(json, max_elements=None)
+        constraints = {'max_elements': rand.randint(1, 12),
+                       'max_depth': rand.choice([None, 2, 3]),
+                       'max_breadth': rand.choice([None, 2, 4])}
+        try:
+            compile_predicate(json, **constraints)
+            valid = True
+        except ValueError:
+            valid = False
+        try:
+            compile_predicate(tree, **constraints)
+            assert valid
+        except ValueError:
+            assert not valid
+        if not valid:
+            with pytest.raises(ValueError):
+                parse_tree(json, **constraints)
+
+
+def test_smaller_than_json():
+    json = {'operator': 'and', 'value': [
+        {'operator': 'or', 'value': [leaf('age', '==', i), leaf(
+            'name', '==', 'pat')]} for i in range(1000)]}
+
+    def size(build):
+        tracemalloc.start()
+        value = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        assert value
+        return size
+    unlimited = {'max_elements': None}
+    as_json = size(lambda: jsonify(json))
+    as_tree = size(lambda: parse_tree(jsonify(json), **unlimited).dumps())
+    assert as_tree * 2 < as_json